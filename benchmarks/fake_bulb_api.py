@@ -0,0 +1,173 @@
+import asyncio
+import random
+import time
+from collections import Counter
+
+import jwt
+from sber_smart_bulb_api.exceptions import (AuthorizationRequiredSberSmartBulbAPIError,
+                                            ClientConnectorSberSmartBulbAPIError,
+                                            TimeoutSberSmartBulbAPIError)
+from sber_smart_bulb_api.models import (AccessTokenResponse,
+                                        AuthenticateResponse,
+                                        ColorValidation,
+                                        Device,
+                                        DeviceGroup,
+                                        DeviceGroups,
+                                        DeviceGroupTree,
+                                        DeviceName,
+                                        DeviceSceneEnum,
+                                        DeviceStates,
+                                        SceneValidation,
+                                        TimerValidation,
+                                        VerifyResponse,
+                                        WhiteValidation)
+
+
+class FakeCloud:
+    """
+    Shared backend of every FakeSberSmartBulbAPI: lamp states, call counters and the failure model.
+
+    Every call sleeps latency +- jitter and fails with a connection error with probability error_rate. During an
+    offline period, given as (start, end) seconds since reset(), lamps report online=False and reject writes with a
+    timeout.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0.0,
+                 offline: list[tuple[float, float]] | None = None, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.offline = offline or []
+        self.random = random.Random(seed)
+        self.calls: Counter[str] = Counter()
+        self.errors = 0
+        self.devices: dict[str, dict] = {}
+        self.started = time.monotonic()
+
+    def reset(self):
+        self.calls.clear()
+        self.errors = 0
+        self.started = time.monotonic()
+
+    def is_offline(self) -> bool:
+        now = time.monotonic() - self.started
+        return any(start <= now < end for start, end in self.offline)
+
+    async def call(self, method: str):
+        self.calls[method] += 1
+        await asyncio.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0.0))
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            raise ClientConnectorSberSmartBulbAPIError('Fake connection error')
+
+    def get_device(self, device_id: str) -> dict:
+        device = self.devices.get(device_id)
+        if device is None:
+            device = self.devices[device_id] = {
+                'on_off': True, 'work_mode': 'white', 'light_scene': 'candle', 'bright_value_v2': 50,
+                'temp_value_v2': 50, 'colour_data_v2': {'h': 180, 's': 50, 'v': 50}, 'sleep_timer': 0
+            }
+        return device
+
+    async def write(self, method: str, device_id: str, **values):
+        await self.call(method=method)
+        if self.is_offline():
+            self.errors += 1
+            raise TimeoutSberSmartBulbAPIError('Timeout error')
+        self.get_device(device_id=device_id).update(values)
+
+
+class FakeSberSmartBulbAPI:
+    """
+    In-process stand-in for SberSmartBulbAPI with the same public methods and the private token hooks the bot uses.
+    """
+
+    cloud = FakeCloud()
+    token_lifetime = 3600
+
+    def __init__(self, refresh_token: str | None = None, refresh_token_path=None, timeout: int = 30, level=None):
+        self.refresh_token = refresh_token
+        self.refresh_token_path = refresh_token_path
+        self._access_token: str | None = None
+        self._x_auth_jwt: str | None = None
+        self.session = FakeSession()
+
+    def get_token(self, kind: str) -> str:
+        return jwt.encode({'sub': self.refresh_token, 'kind': kind, 'exp': int(time.time()) + self.token_lifetime},
+                          'fake-signing-key-for-local-benchmarks', algorithm='HS256')
+
+    async def _get_access_token(self, refresh_token: str) -> AccessTokenResponse:
+        await self.cloud.call(method='token')
+        self.refresh_token = refresh_token
+        self._access_token = self.get_token(kind='access')
+        return AccessTokenResponse(access_token=self._access_token, token_type='Bearer',
+                                   expires_in=self.token_lifetime, id_token='fake', refresh_token=refresh_token)
+
+    async def _refresh_access_token(self) -> AccessTokenResponse:
+        if not self.refresh_token:
+            raise AuthorizationRequiredSberSmartBulbAPIError()
+        return await self._get_access_token(refresh_token=self.refresh_token)
+
+    async def _set_auth_jwt(self):
+        await self.cloud.call(method='jwt')
+        self._x_auth_jwt = self.get_token(kind='jwt')
+
+    async def authenticate(self, phone: str) -> AuthenticateResponse:
+        await self.cloud.call(method='authenticate')
+        return AuthenticateResponse(authenticator=[], ouid=f'ouid-{phone}')
+
+    async def verify(self, ouid: str, sms_otp: str | int) -> VerifyResponse:
+        await self.cloud.call(method='verify')
+        return VerifyResponse(redirect_uri='companionapp://host', authcode=f'{ouid}-{sms_otp}', state='fake')
+
+    async def get_access_token(self, authcode: str) -> AccessTokenResponse:
+        return await self._get_access_token(refresh_token=f'fake-{authcode}')
+
+    def get_device_ids(self) -> dict[str, str]:
+        return {'Лампа': f'{self.refresh_token}/lamp'}
+
+    async def get_device_groups(self) -> DeviceGroups:
+        await self.cloud.call(method='get_device_groups')
+        return DeviceGroups.model_construct(result=[DeviceGroup.model_construct(id='home')])
+
+    async def get_device_group_tree(self, group_id: str) -> DeviceGroupTree:
+        await self.cloud.call(method='get_device_group_tree')
+        devices = [Device.model_construct(id=device_id, name=DeviceName.model_construct(name=name))
+                   for name, device_id in self.get_device_ids().items()]
+        return DeviceGroupTree.model_construct(devices=devices)
+
+    async def get_device_states(self, device_id: str) -> DeviceStates:
+        await self.cloud.call(method='get_device_states')
+        return DeviceStates(online=not self.cloud.is_offline(), **self.cloud.get_device(device_id=device_id))
+
+    async def set_white(self, device_id: str, brightness: int, temp: int):
+        WhiteValidation(brightness=brightness, temp=temp)
+        await self.cloud.write(method='set_white', device_id=device_id, work_mode='white',
+                               bright_value_v2=brightness, temp_value_v2=temp)
+
+    async def set_color(self, device_id: str, h: int, s: int, v: int):
+        ColorValidation(h=h, s=s, v=v)
+        await self.cloud.write(method='set_color', device_id=device_id, work_mode='colour',
+                               colour_data_v2={'h': h, 's': s, 'v': v})
+
+    async def set_scene(self, device_id: str, scene: DeviceSceneEnum | str):
+        SceneValidation(scene=scene)
+        await self.cloud.write(method='set_scene', device_id=device_id, work_mode='scene', light_scene=scene)
+
+    async def set_timer(self, device_id: str, minutes: int):
+        TimerValidation(minutes=minutes)
+        await self.cloud.write(method='set_timer', device_id=device_id, sleep_timer=minutes)
+
+    async def set_on_off(self, device_id: str, value: bool):
+        await self.cloud.write(method='set_on_off', device_id=device_id, on_off=value)
+
+    async def close(self):
+        pass
+
+
+class FakeSession:
+    def detach(self):
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    """
+    Local Bot API server: serves getUpdates from a queue and records when callbacks are answered and messages edited.
+    """
+
+    def __init__(self):
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.sent: dict[str, float] = {}
+        self.answered: dict[str, float] = {}
+        self.edited: dict[str, float] = {}
+        self.edits: dict[int, list[float]] = {}
+        self.messages = 0
+
+    def get_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        data = dict(await request.post())
+        result = True
+        if method == 'getme':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method == 'getupdates':
+            result = await self.get_updates(timeout=float(data.get('timeout') or 0))
+        elif method == 'answercallbackquery':
+            self.answered.setdefault(data['callback_query_id'], time.perf_counter())
+        elif method in ('editmessagetext', 'editmessagereplymarkup'):
+            now = time.perf_counter()
+            for callback_query_id in self.sent:
+                self.edited.setdefault(callback_query_id, now)
+            self.edits.setdefault(int(data['chat_id']), []).append(now)
+            result = get_message(chat_id=int(data['chat_id']), message_id=int(data['message_id']),
+                                 text=data.get('text', ''))
+        elif method == 'sendmessage':
+            self.messages += 1
+            result = get_message(chat_id=int(data['chat_id']), message_id=2, text=data.get('text', ''))
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, timeout: float) -> list[dict]:
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=timeout or 0.01))
+        except asyncio.TimeoutError:
+            return updates
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    def mark_sent(self, update: dict):
+        self.sent[update['callback_query']['id']] = time.perf_counter()
+
+
+def get_message(chat_id: int, message_id: int, text: str = 'Выставь настройки') -> dict:
+    return {'message_id': message_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Benchmark'}}
+
+
+def get_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'message': get_message(chat_id=user_id, message_id=message_id)
+        }
+    }
+
+
+def get_message_update(update_id: int, user_id: int, text: str) -> dict:
+    message = get_message(chat_id=user_id, message_id=update_id, text=text)
+    message['from'] = {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from bisect import bisect_right
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from aiohttp import web
+
+from benchmarks.fake_bulb_api import (FakeCloud,
+                                      FakeSberSmartBulbAPI)
+from benchmarks.fake_telegram import (FakeTelegram,
+                                      get_update)
+
+TELEGRAM_PORT = 8083
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+MIXED = ('on_off', 'scene:candle', 'scene:sunset', 'up:bright_value_v2', 'down:bright_value_v2', 'up:temp_value_v2',
+         'up:h', 'down:s', 'white', 'colour', 'back')
+
+
+def get_script(scenario: str, taps: int, rng: random.Random) -> list[str]:
+    if scenario == 'mixed':
+        return [rng.choice(MIXED) for _ in range(taps)]
+    key = {'brightness': 'bright_value_v2', 'colour': 'h'}[scenario]
+    # Changes direction every 25 taps so the value never sticks at a bound
+    return [f'{"up" if index // 25 % 2 == 0 else "down"}:{key}' for index in range(taps)]
+
+
+def configure(user_ids: list[int], workdir: str, journal_path: str = '', mode: str = 'webhook'):
+    os.makedirs(os.path.join(workdir, 'tokens'))
+    for user_id in user_ids:
+        path = os.path.join(workdir, 'owner_token' if user_id == user_ids[0] else f'tokens/{user_id}')
+        with open(path, 'w') as f:
+            f.write(f'fake-{user_id}')
+    os.environ.update({
+        'BOT_TOKEN': '1:benchmark',
+        'BOT_USER_IDS': ','.join(map(str, user_ids)),
+        'DEVICES': f'Лампа=fake-{user_ids[0]}/lamp',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{TELEGRAM_PORT}',
+        'REFRESH_TOKEN_PATH': os.path.join(workdir, 'owner_token'),
+        'TOKENS_DIR': os.path.join(workdir, 'tokens'),
+        'TENANTS_PATH': os.path.join(workdir, 'tenants.json'),
+        'OFFLINE_DIR': os.path.join(workdir, 'offline'),
+        'SCHEDULES_PATH': os.path.join(workdir, 'schedules.json'),
+        'FSM_PATH': ':memory:',
+        'METRICS_PORT': '0',
+        'METRICS_LOG_INTERVAL': '0',
+        'JOURNAL_PATH': journal_path,
+        # Updates are dispatched directly like the webhook does, handlers return their answers
+        'MODE': mode
+    })
+
+
+@asynccontextmanager
+async def run_stand(user_ids: list[int], cloud: FakeCloud, error_rate: float, journal_path: str = '',
+                    mode: str = 'webhook') -> AsyncIterator[FakeTelegram]:
+    """
+    Starts the bot against the fake API and a local fake Telegram and loads every user. Errors are only injected
+    after loading, call counters start from zero when the stand is yielded.
+    """
+    workdir = tempfile.mkdtemp(prefix='smart_bulb_bench_')
+    configure(user_ids=user_ids, workdir=workdir, journal_path=journal_path, mode=mode)
+    FakeSberSmartBulbAPI.cloud = cloud
+
+    import tenants as tenants_module
+    tenants_module.SberSmartBulbAPI = FakeSberSmartBulbAPI
+
+    from aiogram import (Bot,
+                         Dispatcher)
+
+    from bot import (bot,
+                     dp,
+                     recover_users,
+                     tenants)
+    from journal import journal
+
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    telegram = FakeTelegram()
+    runner = web.AppRunner(telegram.get_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', TELEGRAM_PORT).start()
+    try:
+        await recover_users()
+        await asyncio.gather(*(tenants.get(user_id=user_id).loader for user_id in user_ids))
+        cloud.error_rate = error_rate
+        cloud.reset()
+        yield telegram
+    finally:
+        await tenants.close()
+        await journal.close()
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await bot.get_session()).close()
+        await runner.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def drain(user_ids: list[int], timeout: float) -> int:
+    """
+    Waits for debounced commands, offline queues and pending edits, returns the number of commands left queued.
+    """
+    from bot import (pipeline,
+                     tenants,
+                     throttler)
+
+    await pipeline.close()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and any(tenants.get(user_id=user_id).offline for user_id in user_ids):
+        await asyncio.sleep(0.1)
+    await throttler.close()
+    return sum(len(tenants.get(user_id=user_id).offline) for user_id in user_ids)
+
+
+async def dispatch(update: dict, answered: dict[str, float], errors: list[Exception]):
+    from aiogram import types
+    from aiogram.dispatcher.webhook import AnswerCallbackQuery
+
+    from bot import dp
+
+    try:
+        results = await dp.process_update(types.Update(**update))
+    except Exception as e:
+        errors.append(e)
+        return
+    if any(isinstance(result, AnswerCallbackQuery) for result in results):
+        answered[update['callback_query']['id']] = time.perf_counter()
+
+
+async def run_user(user_id: int, script: list[str], interval: float, rng: random.Random, update_ids: itertools.count,
+                   taps: list[tuple[int, str, float]], answered: dict[str, float], errors: list[Exception],
+                   tasks: set[asyncio.Task]):
+    for data in script:
+        update = get_update(update_id=next(update_ids), user_id=user_id, data=data)
+        taps.append((user_id, update['callback_query']['id'], time.perf_counter()))
+        task = asyncio.create_task(dispatch(update=update, answered=answered, errors=errors))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        await asyncio.sleep(rng.expovariate(1 / interval))
+
+
+def get_percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {f'p{q}': round(values[min(len(values) - 1, int(len(values) * q / 100))], 3) for q in (50, 95, 99)} | \
+        {'max': round(values[-1], 3)}
+
+
+def get_report(args: argparse.Namespace, cloud: FakeCloud, telegram: FakeTelegram,
+               taps: list[tuple[int, str, float]], answered: dict[str, float], errors: list[Exception],
+               queued: int) -> dict:
+    edits, answers, unrendered = [], [], 0
+    for user_id, callback_query_id, sent in taps:
+        if callback_query_id in answered:
+            answers.append((answered[callback_query_id] - sent) * 1000)
+        times = telegram.edits.get(user_id, [])
+        index = bisect_right(times, sent)
+        if index < len(times):
+            edits.append((times[index] - sent) * 1000)
+        else:
+            unrendered += 1
+    calls = sum(cloud.calls.values())
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'journal')},
+        'taps': len(taps),
+        'answered': len(answers),
+        'dropped': len(taps) - len(answers),
+        'errors': len(errors),
+        'unrendered': unrendered,
+        'tap_to_edit_ms': get_percentiles(edits),
+        'answer_ms': get_percentiles(answers),
+        'edits': sum(map(len, telegram.edits.values())),
+        'notifications': telegram.messages,
+        'offline_left': queued,
+        'upstream': {
+            'calls': dict(sorted(cloud.calls.items())),
+            'errors': cloud.errors,
+            'per_action': round(calls / len(taps), 3) if taps else 0.0
+        }
+    }
+
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    lines = []
+    if report['config'] != baseline.get('config'):
+        lines.append('Warning: the baseline was recorded with a different configuration')
+    rows = [(f'tap_to_edit_ms.{key}', report['tap_to_edit_ms'], baseline.get('tap_to_edit_ms', {}), key)
+            for key in ('p50', 'p95', 'p99')]
+    rows += [('dropped', report, baseline, 'dropped'), ('unrendered', report, baseline, 'unrendered'),
+             ('upstream.per_action', report['upstream'], baseline.get('upstream', {}), 'per_action')]
+    for name, current, previous, key in rows:
+        now, before = current.get(key), previous.get(key)
+        change = f'{(now - before) / before:+.1%}' if now is not None and before else ''
+        lines.append(f'{name:24} {before!s:>10} -> {now!s:>10} {change}')
+    return lines
+
+
+def write_report(report: dict, baseline: str | None, output: str | None):
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    if baseline and os.path.exists(baseline):
+        with open(baseline) as f:
+            print('\n'.join(compare(report=report, baseline=json.load(f))))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+            f.write('\n')
+
+
+async def main(args: argparse.Namespace):
+    user_ids = list(range(1, args.users + 1))
+    cloud = FakeCloud(latency=args.latency, jitter=args.jitter, seed=args.seed,
+                      offline=[tuple(map(float, period.split('-'))) for period in args.offline])
+    rng = random.Random(args.seed)
+    taps, answered, errors, tasks = [], {}, [], set()
+    async with run_stand(user_ids=user_ids, cloud=cloud, error_rate=args.error_rate,
+                         journal_path=args.journal) as telegram:
+        update_ids = itertools.count(1)
+        await asyncio.gather(*(run_user(user_id=user_id, script=get_script(args.scenario, args.taps, rng),
+                                        interval=args.interval, rng=random.Random(rng.random()),
+                                        update_ids=update_ids, taps=taps, answered=answered, errors=errors,
+                                        tasks=tasks)
+                               for user_id in user_ids))
+        await asyncio.gather(*tasks)
+        queued = await drain(user_ids=user_ids, timeout=args.drain)
+    report = get_report(args=args, cloud=cloud, telegram=telegram, taps=taps, answered=answered, errors=errors,
+                        queued=queued)
+    write_report(report=report, baseline=args.baseline, output=args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tap storm load benchmark against a fake Sber API and Telegram')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--taps', type=int, default=40, help='taps per user')
+    parser.add_argument('--interval', type=float, default=0.1, help='mean seconds between taps of a user')
+    parser.add_argument('--scenario', choices=['mixed', 'brightness', 'colour'], default='mixed')
+    parser.add_argument('--latency', type=float, default=0.08, help='fake API latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.03)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--offline', action='append', default=[], metavar='START-END',
+                        help='seconds since the storm started during which the lamps are offline')
+    parser.add_argument('--drain', type=float, default=3, help='seconds to wait for offline queues to flush')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='report to compare with')
+    parser.add_argument('--output', help='where to write the report, e.g. benchmarks/baseline.json')
+    parser.add_argument('--journal', default='', help='record a command journal that benchmarks.replay can replay')
+    asyncio.run(main(args=parser.parse_args()))
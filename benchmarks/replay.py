@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import itertools
+import time
+
+from benchmarks.fake_bulb_api import FakeCloud
+from benchmarks.fake_telegram import (get_message_update,
+                                      get_update)
+from benchmarks.load import (dispatch,
+                             drain,
+                             get_percentiles,
+                             get_report,
+                             run_stand,
+                             write_report)
+
+
+def get_recorded(records: list[dict]) -> dict:
+    actions = [record for record in records if record['kind'] == 'action']
+    # Calls made while the tenants loaded precede the first action, the replay does not count them either
+    calls = [record for record in records if record['kind'] == 'call' and actions and record['ts'] >= actions[0]['ts']]
+    return {
+        'actions': len(actions),
+        'unhandled': sum(not record['handled'] for record in actions),
+        'handler_ms': get_percentiles([record['ms'] for record in actions]),
+        'calls': len(calls),
+        'call_ms': get_percentiles([record['ms'] for record in calls if record['error'] is None]),
+        'call_errors': sum(record['error'] is not None for record in calls),
+        'per_action': round(len(calls) / len(actions), 3) if actions else 0.0
+    }
+
+
+async def main(args: argparse.Namespace):
+    from journal import read_journal
+
+    records = read_journal(path=args.journal)
+    actions = [record for record in records if record['kind'] == 'action']
+    if not actions:
+        raise SystemExit(f'No actions in {args.journal}')
+    user_ids = sorted({record['user_id'] for record in actions})
+    cloud = FakeCloud(latency=args.latency, jitter=args.jitter, seed=args.seed)
+    taps, answered, errors, tasks = [], {}, [], set()
+    async with run_stand(user_ids=user_ids, cloud=cloud, error_rate=args.error_rate) as telegram:
+        update_ids = itertools.count(1)
+        first, started = actions[0]['ts'], time.monotonic()
+        for record in actions:
+            if args.speed:
+                await asyncio.sleep(max((record['ts'] - first) / args.speed - (time.monotonic() - started), 0.0))
+            else:
+                await asyncio.sleep(0)
+            if record['update'] == 'callback_query':
+                update = get_update(update_id=next(update_ids), user_id=record['user_id'], data=record['data'])
+                taps.append((record['user_id'], update['callback_query']['id'], time.perf_counter()))
+            else:
+                # Plain message texts are not journaled, any text opens the main menu like they did
+                update = get_message_update(update_id=next(update_ids), user_id=record['user_id'],
+                                            text=record['text'] or 'menu')
+            task = asyncio.create_task(dispatch(update=update, answered=answered, errors=errors))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        queued = await drain(user_ids=user_ids, timeout=args.drain)
+    report = get_report(args=args, cloud=cloud, telegram=telegram, taps=taps, answered=answered, errors=errors,
+                        queued=queued)
+    report['recorded'] = get_recorded(records=records)
+    write_report(report=report, baseline=args.baseline, output=args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a command journal through the dispatcher against a fake '
+                                                 'Sber API and Telegram')
+    parser.add_argument('journal', help='journal path, rotated backups next to it are replayed first')
+    parser.add_argument('--speed', type=float, default=1, help='1 keeps the recorded pace, 0 replays at full speed')
+    parser.add_argument('--latency', type=float, default=0.08, help='fake API latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.03)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--drain', type=float, default=3, help='seconds to wait for offline queues to flush')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', help='replay report to compare with')
+    parser.add_argument('--output', help='where to write the report')
+    asyncio.run(main(args=parser.parse_args()))
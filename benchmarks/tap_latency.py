@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import json
+import time
+
+from aiohttp import (ClientSession,
+                     web)
+
+from benchmarks.fake_bulb_api import FakeCloud
+from benchmarks.fake_telegram import (FakeTelegram,
+                                      get_update)
+from benchmarks.load import (get_percentiles,
+                             run_stand)
+
+WEBHOOK_PORT = 8082
+USER_ID = 1
+
+
+def get_data(update_id: int, batch: int) -> str:
+    # A batch opens with an on/off tap, which waits for the API, the other taps only change the step
+    if batch > 1 and update_id % batch == 1:
+        return 'on_off'
+    return 'up:step:white' if update_id % 2 else 'down:step:white'
+
+
+def get_batches(taps: int, batch: int) -> list[list[dict]]:
+    updates = [get_update(update_id=update_id, user_id=USER_ID, data=get_data(update_id=update_id, batch=batch))
+               for update_id in range(1, taps + 1)]
+    return [updates[index:index + batch] for index in range(0, taps, batch)]
+
+
+def get_report(mode: str, batch: int, telegram: FakeTelegram, steps: set[str]) -> dict:
+    answers = {key: (telegram.answered[key] - sent) * 1000 for key, sent in telegram.sent.items()
+               if key in telegram.answered}
+    edits = [(telegram.edited[key] - sent) * 1000 for key, sent in telegram.sent.items() if key in telegram.edited]
+    return {
+        'mode': mode,
+        'batch': batch,
+        'taps': len(telegram.sent),
+        'answered': len(answers),
+        'answer_ms': get_percentiles(list(answers.values())),
+        'step_answer_ms': get_percentiles([value for key, value in answers.items() if key in steps]),
+        'edit_ms': get_percentiles(edits)
+    }
+
+
+async def run_polling(telegram: FakeTelegram, batches: list[list[dict]]):
+    from bot import dp
+
+    polling = asyncio.create_task(dp.start_polling(timeout=20, relax=0.1))
+    for updates in batches:
+        # Queued together, the updates of a batch arrive with one getUpdates
+        for update in updates:
+            telegram.mark_sent(update=update)
+            telegram.updates.put_nowait(update)
+        while any(update['callback_query']['id'] not in telegram.answered for update in updates):
+            await asyncio.sleep(0.001)
+    dp.stop_polling()
+    await dp.wait_closed()
+    polling.cancel()
+
+
+async def post(session: ClientSession, url: str, telegram: FakeTelegram, update: dict):
+    telegram.mark_sent(update=update)
+    async with session.post(url, json=update) as response:
+        if response.content_type == 'application/json':
+            body = await response.json()
+            if body.get('method') == 'answerCallbackQuery':
+                telegram.answered.setdefault(body['callback_query_id'], time.perf_counter())
+
+
+async def run_webhook(telegram: FakeTelegram, batches: list[list[dict]]):
+    from aiogram.dispatcher.webhook import configure_app
+
+    from bot import dp
+    from config import Config
+
+    app = web.Application()
+    configure_app(dp, app, path=Config.env.webhook_path)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', WEBHOOK_PORT).start()
+    url = f'http://127.0.0.1:{WEBHOOK_PORT}{Config.env.webhook_path}'
+    async with ClientSession() as session:
+        for updates in batches:
+            await asyncio.gather(*(post(session=session, url=url, telegram=telegram, update=update)
+                                   for update in updates))
+    await runner.cleanup()
+
+
+async def main(mode: str, taps: int, batch: int, latency: float):
+    batches = get_batches(taps=taps, batch=batch)
+    steps = {update['callback_query']['id'] for updates in batches for update in updates
+             if update['callback_query']['data'] != 'on_off'}
+    async with run_stand(user_ids=[USER_ID], cloud=FakeCloud(latency=latency, jitter=0.0), error_rate=0.0,
+                         mode=mode) as telegram:
+        from bot import throttler
+
+        await {'polling': run_polling, 'webhook': run_webhook}[mode](telegram=telegram, batches=batches)
+        await throttler.close()
+    print(json.dumps(get_report(mode=mode, batch=batch, telegram=telegram, steps=steps), ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tap latency benchmark against a local fake Telegram Bot API')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='webhook')
+    parser.add_argument('--taps', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=1,
+                        help='taps sent together, every batch above 1 opens with an on/off tap')
+    parser.add_argument('--latency', type=float, default=0.3, help='fake API latency in seconds')
+    args = parser.parse_args()
+    asyncio.run(main(mode=args.mode, taps=args.taps, batch=args.batch, latency=args.latency))
@@ -1,79 +1,415 @@
+import asyncio
 import logging
-from contextlib import suppress
+from functools import partial
+from typing import (Any,
+                    Callable)
 
 from aiogram import (Bot,
                      Dispatcher,
                      executor,
                      types)
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import (TELEGRAM_PRODUCTION,
+                             TelegramAPIServer)
 from aiogram.dispatcher.storage import FSMContext
-from aiogram.utils.exceptions import MessageNotModified
-from aiogram.utils.markdown import hbold
+from aiogram.dispatcher.webhook import AnswerCallbackQuery
+from aiogram.utils.exceptions import TelegramAPIError
+from aiogram.utils.markdown import (hbold,
+                                    quote_html)
 from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+from sber_smart_bulb_api.models import DeviceStates
 
+from cluster import (LockedSberSmartBulbAPIError,
+                     cluster)
 from config import Config
+from fleet import FleetSberSmartBulbAPIError
+from journal import (JournalMiddleware,
+                     journal)
 from keyboards import (get_auth_keyboard,
                        get_colour_keyboard,
+                       get_devices_keyboard,
                        get_main_keyboard,
                        get_timer_keyboard,
+                       get_usage_keyboard,
                        get_white_keyboard)
+from metrics import (MetricsMiddleware,
+                     metrics)
+from offline import OfflineQueue
+from pipeline import CommandPipeline
+from presets import (Preset,
+                     parse_command,
+                     parse_set,
+                     presets)
+from rendered import RenderedMessages
+from resilience import CircuitOpenSberSmartBulbAPIError
+from scheduler import Scheduler
+from startup import StartupTimer
 from states import States
+from storage import SQLiteStorage
+from synchronizer import StatesSynchronizer
+from tenants import (Tenant,
+                     TenantMiddleware,
+                     TenantRegistry)
 from texts import (get_colour_text,
+                   get_devices_text,
+                   get_main_text,
                    get_timer_text,
                    get_time,
+                   get_usage_text,
                    get_white_text)
+from throttler import EditThrottler
+from usage import usage
 
+startup = StartupTimer()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(name)s %(message)s', style='%')
-bot = Bot(token=Config.env.bot_token, parse_mode='HTML')
-dp = Dispatcher(bot, storage=MemoryStorage())
+bot = Bot(token=Config.env.bot_token, parse_mode='HTML',
+          server=TelegramAPIServer.from_base(Config.env.telegram_api_url) if Config.env.telegram_api_url
+          else TELEGRAM_PRODUCTION)
+dp = Dispatcher(bot, storage=SQLiteStorage(path=Config.env.fsm_path, flush_interval=Config.env.fsm_flush_interval,
+                                           shared=bool(Config.env.cluster_path)))
+throttler = EditThrottler(rendered=RenderedMessages(maxsize=1024), chat_rate=Config.env.edit_chat_rate,
+                          global_rate=Config.env.edit_global_rate)
+
+
+async def set_states(tenant: Tenant):
+    states = (await tenant.states_cache.get_device_states(device_id=tenant.device_id))
+    tenant.states = States(**(states.model_dump() | states.colour_data_v2.model_dump()))
+
+
+async def answer(callback_query: types.CallbackQuery, text: str | None = None) -> AnswerCallbackQuery | None:
+    """
+    Answers the callback query with the webhook response, or right away when polling: aiogram sends the answers polling
+    handlers return only after every update of the getUpdates batch is handled, and drops their errors.
+    """
+    if Config.env.mode == 'webhook':
+        return AnswerCallbackQuery(callback_query_id=callback_query.id, text=text, show_alert=text is not None)
+    try:
+        await callback_query.answer(text=text, show_alert=text is not None)
+    except TelegramAPIError as e:
+        logging.warning('Answering callback query %s failed: %s', callback_query.id, e)
+
+
+def get_main_data(tenant: Tenant) -> tuple[str, types.InlineKeyboardMarkup]:
+    return get_main_text(tenant=tenant), get_main_keyboard(tenant=tenant)
+
+
+def get_devices_data(tenant: Tenant) -> tuple[str, types.InlineKeyboardMarkup]:
+    return get_devices_text(), get_devices_keyboard(tenant=tenant)
+
+
+def get_white_data(tenant: Tenant) -> tuple[str, types.InlineKeyboardMarkup]:
+    return get_white_text(tenant=tenant), get_white_keyboard(tenant=tenant)
+
+
+def get_colour_data(tenant: Tenant) -> tuple[str, types.InlineKeyboardMarkup]:
+    return get_colour_text(tenant=tenant), get_colour_keyboard(tenant=tenant)
 
 
-async def set_states():
-    states = (await Config.bulb_api.get_device_states(device_id=Config.env.device_id))
-    Config.states = States(**(states.model_dump() | states.colour_data_v2.model_dump()))
+def get_timer_data(tenant: Tenant) -> tuple[str, types.InlineKeyboardMarkup]:
+    return get_timer_text(tenant=tenant), get_timer_keyboard(tenant=tenant)
 
 
-def get_white_data() -> tuple[str, types.InlineKeyboardMarkup]:
-    return get_white_text(), get_white_keyboard()
+def get_usage_data(tenant: Tenant) -> tuple[str, types.InlineKeyboardMarkup]:
+    return get_usage_text(tenant=tenant), get_usage_keyboard()
 
 
-def get_colour_data() -> tuple[str, types.InlineKeyboardMarkup]:
-    return get_colour_text(), get_colour_keyboard()
+def show(tenant: Tenant, message: types.Message,
+         get_data: Callable[[Tenant], tuple[str, types.InlineKeyboardMarkup]]):
+    text, keyboard = get_data(tenant)
+    throttler.schedule(message=message, text=text, keyboard=keyboard)
+    tenant.menus[message.chat.id] = (message, get_data)
 
 
-def get_timer_data() -> tuple[str, types.InlineKeyboardMarkup]:
-    return get_timer_text(), get_timer_keyboard()
+def show_offline(tenant: Tenant):
+    tenant.states.update(online=False)
+    for message, _ in list(tenant.menus.values()):
+        show(tenant=tenant, message=message, get_data=get_main_data)
 
 
-async def set_data(callback_query: types.CallbackQuery, value: str) -> tuple[str, types.InlineKeyboardMarkup]:
-    text, keyboard = get_timer_data()
+async def run_command(tenant: Tenant, device_ids: list[str], command: str, **values: Any):
+    """
+    Sends the command to the devices. Commands the offline queue accepts are queued for unreachable devices
+    instead of failing, and sent right away to the queue when the lamp is already known to be offline.
+    """
+    queueable = OfflineQueue.accepts(command)
+    # The menu keeps the values being written even if a poll reads the lamp before the write lands
+    states = tenant.states if command in States.held and tenant.device_id in device_ids else None
+    if states is not None:
+        generation = states.hold(keys=States.held[command])
     try:
-        if value in ('bright_value_v2', 'temp_value_v2'):
-            Config.states.work_mode = 'white'
-            text, keyboard = get_white_data()
-            await Config.bulb_api.set_white(device_id=Config.env.device_id, brightness=Config.states.bright_value_v2,
-                                            temp=Config.states.temp_value_v2)
-        if value in ('h', 's', 'v'):
-            Config.states.work_mode = 'colour'
-            text, keyboard = get_colour_data()
-            await Config.bulb_api.set_color(device_id=Config.env.device_id, h=Config.states.h, s=Config.states.s,
-                                            v=Config.states.v)
+        if queueable and tenant.states is not None and not tenant.states.online and device_ids == tenant.device_ids:
+            await tenant.offline.put(device_ids=device_ids, command=command, **values)
+            return
+        await tenant.fleet.run(device_ids=device_ids,
+                               command=partial(getattr(tenant.states_cache, f'set_{command}'), **values))
     except SberSmartBulbAPIError as e:
-        await callback_query.answer(text=str(e), show_alert=True)
-    return text, keyboard
+        errors = e.errors if isinstance(e, FleetSberSmartBulbAPIError) else {device_ids[0]: e}
+        unreachable = [device_id for device_id, error in errors.items() if isinstance(error, OfflineQueue.errors)]
+        if queueable and unreachable:
+            await tenant.offline.put(device_ids=unreachable, command=command, **values)
+        if tenant.states is not None and tenant.device_id in unreachable:
+            show_offline(tenant=tenant)
+        if not queueable or len(unreachable) < len(errors):
+            raise
+    finally:
+        if states is not None:
+            states.release(keys=States.held[command], generation=generation)
+        if tenant.synchronizer is not None:
+            tenant.synchronizer.touch()
+
+
+async def send_command(key: tuple[int, str], command: str, **values: Any):
+    user_id, target = key
+    tenant = tenants.get(user_id=user_id)
+    await run_command(tenant=tenant, device_ids=tenant.targets[target], command=command, **values)
+
+
+async def send_scheduled(user_id: int, target: str, command: str, **values: Any):
+    if target not in tenants.get(user_id=user_id).targets:
+        logging.warning('Schedule target %s of user %s no longer exists', target, user_id)
+        return
+    await send_command((user_id, target), command, **values)
+
+
+pipeline = CommandPipeline(send=send_command, debounce=Config.env.command_debounce)
+scheduler = Scheduler(send=send_scheduled, tz=Config.tz, path=Config.env.schedules_path,
+                      catch_up=Config.env.schedule_catch_up, rate=Config.env.schedule_rate,
+                      owner=Config.env.bot_user_ids[0])
+
+
+def apply_device_states(tenant: Tenant, states: DeviceStates, generation: int) -> bool:
+    values = {'online': states.online, 'on_off': states.on_off, 'work_mode': states.work_mode,
+              'light_scene': states.light_scene, 'bright_value_v2': states.bright_value_v2,
+              'temp_value_v2': states.temp_value_v2, **states.colour_data_v2.model_dump()}
+    if not states.sleep_timer:
+        values['time'] = None
+    if not states.online:
+        # The values of an offline lamp are the last known ones, they must not overwrite what is queued for it
+        values = {'online': False}
+    if not tenant.states.sync(generation=generation, **values):
+        return False
+    for message, get_data in tenant.menus.values():
+        text, keyboard = get_data(tenant)
+        throttler.schedule(message=message, text=text, keyboard=keyboard)
+    return True
+
+
+async def sync_states(tenant: Tenant) -> tuple[bool, bool]:
+    device_id, generation = tenant.device_id, tenant.states.generation
+    states = await tenant.states_cache.get_device_states(device_id=device_id, max_age=Config.env.sync_fast_interval)
+    if device_id != tenant.device_id:
+        return states.online, True
+    if states.online and tenant.offline:
+        await flush_offline(tenant=tenant)
+        return True, True
+    return states.online, apply_device_states(tenant=tenant, states=states, generation=generation)
+
+
+async def flush_offline(tenant: Tenant):
+    async def send(device_id: str, command: str, values: dict[str, Any]):
+        await tenant.fleet.run(device_ids=[device_id],
+                               command=partial(getattr(tenant.states_cache, f'set_{command}'), **values))
+
+    sent, errors = await tenant.offline.flush(send=send)
+    if not sent and not errors:
+        return
+    names = {device_id: quote_html(name) for name, device_id in tenant.devices.items()}
+    lines = [f'{names.get(device_id, device_id)}: {describe_command(command=command, values=values)}'
+             for device_id, command, values in sent]
+    lines.extend(f'{names.get(device_id, device_id)}: {hbold(str(error))}' for device_id, error in errors.items())
+    if tenant.offline:
+        lines.append('Остальные команды будут отправлены, когда лампы появятся в сети')
+    try:
+        await bot.send_message(chat_id=tenant.user_id, text='Лампа снова в сети\n' + '\n'.join(lines))
+    except TelegramAPIError as e:
+        logging.warning('Offline queue report to user %s failed: %s', tenant.user_id, e)
+
+
+def describe_command(command: str, values: dict[str, Any]) -> str:
+    if command == 'on_off':
+        return 'включена' if values['value'] else 'выключена'
+    if command == 'scene':
+        return f'сцена {values["scene"]}'
+    return f'{command} ' + ' '.join(f'{key}={value}' for key, value in values.items())
+
+
+async def prepare(tenant: Tenant):
+    await tenant.tokens.refresh()
+    if not tenant.targets:
+        tenant.set_devices(devices=await tenant.discover(), device_groups={})
+        await tenants.save(tenant=tenant)
+    if not tenant.targets:
+        raise SberSmartBulbAPIError('Лампы не найдены')
+    await set_states(tenant=tenant)
+    tenant.tokens.start()
+    if tenant.synchronizer is None:
+        tenant.synchronizer = StatesSynchronizer(sync=partial(sync_states, tenant),
+                                                 fast_interval=Config.env.sync_fast_interval,
+                                                 idle_interval=Config.env.sync_idle_interval,
+                                                 offline_interval=Config.env.sync_offline_interval,
+                                                 active_window=Config.env.sync_active_window)
+        tenant.synchronizer.start()
+
+
+async def load_states(tenant: Tenant):
+    while True:
+        try:
+            await prepare(tenant=tenant)
+            return
+        except SberSmartBulbAPIError as e:
+            logging.warning('Loading states of user %s failed: %s', tenant.user_id, e)
+        except Exception:
+            # Errors the client does not wrap, such as a dropped connection, must not leave the lamp loading for good
+            logging.exception('Loading states of user %s failed', tenant.user_id)
+        await asyncio.sleep(Config.env.sync_offline_interval)
+
+
+tenants = TenantRegistry(env=Config.env, load=load_states)
+dp.middleware.setup(MetricsMiddleware())
+dp.middleware.setup(TenantMiddleware(registry=tenants))
+dp.middleware.setup(JournalMiddleware())
+journal.configure(path=Config.env.journal_path, max_bytes=Config.env.journal_max_bytes,
+                  backups=Config.env.journal_backups, buffer_size=Config.env.journal_buffer,
+                  flush_interval=Config.env.journal_flush_interval)
+cluster.configure(path=Config.env.cluster_path, replica_id=Config.env.replica_id,
+                  lease_ttl=Config.env.cluster_lease_ttl, renew_interval=Config.env.cluster_renew_interval,
+                  lock_ttl=Config.env.cluster_lock_ttl, lock_timeout=Config.env.cluster_lock_timeout)
+presets.configure(path=Config.env.presets_path, limit=Config.env.presets_limit)
+usage.configure(path=Config.env.usage_path, changes=Config.env.usage_changes, minutes=Config.env.usage_minutes,
+                hours=Config.env.usage_hours, max_gap=Config.env.usage_max_gap,
+                snapshot_interval=Config.env.usage_snapshot_interval, poll_interval=Config.env.usage_poll_interval,
+                watts=Config.env.usage_lamp_watts)
+
+
+def per_tenant(get: Callable[[Tenant], dict[str, float]]) -> dict[tuple[str, ...], float]:
+    return {(str(tenant.user_id), key): value for tenant in tenants for key, value in get(tenant).items()}
+
+
+def get_breakers() -> dict[tuple[str, ...], float]:
+    return {(device_id, state): breaker.state == state for tenant in tenants
+            for device_id, breaker in tenant.resilient_api.breakers.items()
+            for state in ('closed', 'open', 'half_open')}
+
+
+# Components keep plain counters, they are read when /metrics is scraped
+metrics.collect('states_cache_total', 'States cache lookups by result', 'counter', ('user', 'result'),
+                partial(per_tenant, lambda tenant: tenant.states_cache.stats))
+metrics.collect('bulb_api_resilience_total', 'Bulb API retries, attempt timeouts and calls rejected by open circuits',
+                'counter', ('user', 'event'), partial(per_tenant, lambda tenant: tenant.resilient_api.stats))
+metrics.collect('circuit_breaker_state', 'Current circuit breaker state of each device', 'gauge', ('device', 'state'),
+                get_breakers)
+metrics.collect('circuit_breaker_trips_total', 'Circuit breaker trips of each device', 'counter', ('device',),
+                lambda: {(device_id,): breaker.trips for tenant in tenants
+                         for device_id, breaker in tenant.resilient_api.breakers.items()})
+metrics.collect('token_expiry_seconds', 'Time until the access or auth token expires', 'gauge', ('user',),
+                lambda: {(str(tenant.user_id),): tenant.tokens.time_to_expiry for tenant in tenants})
+metrics.collect('token_refreshes_total', 'Token refreshes by result', 'counter', ('user', 'result'),
+                partial(per_tenant, lambda tenant: {'refreshed': tenant.tokens.refreshes,
+                                                    'failed': tenant.tokens.failures}))
+metrics.collect('offline_commands_total', 'Commands queued for offline lamps by event', 'counter', ('user', 'event'),
+                partial(per_tenant, lambda tenant: {'queued': tenant.offline.queued,
+                                                    'collapsed': tenant.offline.collapsed,
+                                                    'flushed': tenant.offline.flushed}))
+metrics.collect('edits_total', 'Message edits scheduled, coalesced with a pending one and deferred by rate limits',
+                'counter', ('event',), lambda: {('scheduled',): throttler.scheduled,
+                                                ('coalesced',): throttler.coalesced,
+                                                ('deferred',): throttler.deferred})
+metrics.collect('pipeline_commands_total', 'Light commands submitted to the pipeline and sent after coalescing',
+                'counter', ('event',), lambda: {('submitted',): pipeline.submitted, ('sent',): pipeline.sent})
+metrics.collect('journal_records_total', 'Journal records by outcome', 'counter', ('result',),
+                lambda: {('recorded',): journal.recorded, ('dropped',): journal.dropped,
+                         ('written',): journal.written})
+metrics.collect('fsm_storage_total', 'FSM storage writes, flushes and failed flushes', 'counter', ('event',),
+                lambda: {('writes',): dp.storage.writes, ('flushes',): dp.storage.flushes,
+                         ('failures',): dp.storage.failures})
+metrics.collect('schedules_total', 'Schedule fires, fires caught up after downtime and transition steps', 'counter',
+                ('event',), lambda: {('fired',): scheduler.fired, ('caught_up',): scheduler.caught_up,
+                                     ('steps',): scheduler.steps})
+metrics.collect('tenants', 'Loaded tenants', 'gauge', (), lambda: {(): len(tenants)})
+metrics.collect('tenants_total', 'Tenants created and evicted', 'counter', ('event',),
+                lambda: {('created',): tenants.created, ('evicted',): tenants.evicted})
+metrics.collect('cluster_leader', 'Whether this replica holds the leader lease', 'gauge', (),
+                lambda: {(): cluster.is_leader})
+metrics.collect('cluster_total', 'Leader elections won and shared lock attempts that found the lock taken', 'counter',
+                ('event',), lambda: {('elections',): cluster.elections, ('contended',): cluster.contended})
+
+
+def report_failure(tenant: Tenant, message: types.Message,
+                   get_data: Callable[[Tenant], tuple[str, types.InlineKeyboardMarkup]], sent: asyncio.Future):
+    error = None if sent.cancelled() else sent.exception()
+    if isinstance(error, CircuitOpenSberSmartBulbAPIError):
+        get_data = get_main_data
+    if isinstance(error, SberSmartBulbAPIError):
+        text, keyboard = get_data(tenant)
+        throttler.schedule(message=message, text=f'{hbold(str(error))}\n\n{text}', keyboard=keyboard)
+    elif error is not None:
+        logging.error('Command failed', exc_info=error)
+
+
+def clean_states(states: States, command: str, generation: int, _: asyncio.Future):
+    states.clean(command=command, generation=generation)
+
+
+async def set_data(tenant: Tenant, callback_query: types.CallbackQuery, value: str) -> AnswerCallbackQuery | None:
+    get_data, command = get_timer_data, None
+    if value in ('bright_value_v2', 'temp_value_v2'):
+        tenant.states.edit(work_mode='white')
+        get_data, command = get_white_data, 'white'
+    if value in ('h', 's', 'v'):
+        tenant.states.edit(work_mode='colour')
+        get_data, command = get_colour_data, 'color'
+    show(tenant=tenant, message=callback_query.message, get_data=get_data)
+    if command is not None:
+        submit(tenant=tenant, message=callback_query.message, command=command, get_data=get_data)
+    return await answer(callback_query=callback_query)
+
+
+def submit(tenant: Tenant, message: types.Message, command: str,
+           get_data: Callable[[Tenant], tuple[str, types.InlineKeyboardMarkup]]):
+    values = tenant.states.take(command=command)
+    if values is not None:
+        sent = pipeline.submit(key=(tenant.user_id, tenant.target), command=command, **values)
+        sent.add_done_callback(partial(clean_states, tenant.states, command, tenant.states.generation))
+        sent.add_done_callback(partial(report_failure, tenant, message, get_data))
+
+
+async def apply_light(tenant: Tenant, message: types.Message, command: str, fields: dict[str, Any],
+                      get_data: Callable[[Tenant], tuple[str, types.InlineKeyboardMarkup]]):
+    """
+    Applies a whole light setting with one API call and one menu edit. White and colour go through the pipeline and
+    replace whatever taps are still waiting there, a scene is sent right away like a scene tap.
+    """
+    if command == 'scene':
+        await run_command(tenant=tenant, device_ids=tenant.device_ids, command='scene', scene=fields['light_scene'])
+        tenant.states.update(**fields)
+    else:
+        tenant.states.edit(**fields)
+        submit(tenant=tenant, message=message, command=command, get_data=get_data)
+    show(tenant=tenant, message=message, get_data=get_data)
+
+
+def is_loading(callback_query: types.CallbackQuery) -> bool:
+    return callback_query.from_user.id in Config.env.bot_user_ids and callback_query.data != 'auth' and \
+        tenants.get(user_id=callback_query.from_user.id).states is None
+
+
+@dp.callback_query_handler(is_loading, user_id=Config.env.bot_user_ids, state='*')
+async def loading(callback_query: types.CallbackQuery, tenant: Tenant):
+    text = 'Лампа загружается, подожди' if tenant.bulb_api.refresh_token else 'Необходима авторизация'
+    return await answer(callback_query=callback_query, text=text)
 
 
 @dp.callback_query_handler(text='auth', user_id=Config.env.bot_user_ids, state='*')
-async def auth(callback_query: types.CallbackQuery, state: FSMContext):
+async def auth(callback_query: types.CallbackQuery, state: FSMContext, tenant: Tenant):
     await state.set_state('auth_step_2')
-    await callback_query.message.edit_text(text='Отправь номер телефона в формате 79998887766')
-    await callback_query.answer()
+    tenant.menus.pop(callback_query.message.chat.id, None)
+    throttler.schedule(message=callback_query.message, text='Отправь номер телефона в формате 79998887766')
+    return await answer(callback_query=callback_query)
 
 
 @dp.message_handler(user_id=Config.env.bot_user_ids, state='auth_step_2')
-async def auth_step_2(message: types.Message, state: FSMContext):
+async def auth_step_2(message: types.Message, state: FSMContext, tenant: Tenant):
     try:
-        response = await Config.bulb_api.authenticate(phone=message.text)
+        response = await tenant.bulb_api.authenticate(phone=message.text)
         await state.set_data({'ouid': response.ouid})
         await state.set_state('auth_step_3')
         await message.answer(text='На указанный номер отправлен код. Пришли его в ответном сообщении')
@@ -82,183 +418,387 @@ async def auth_step_2(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(user_id=Config.env.bot_user_ids, state='auth_step_3')
-async def auth_step_3(message: types.Message, state: FSMContext):
+async def auth_step_3(message: types.Message, state: FSMContext, tenant: Tenant):
     code = message.text.strip()
     if not code.isdigit() or len(code) != 5:
         await message.answer(text='Неверный код')
     else:
         ouid = (await state.get_data())['ouid']
         try:
-            response = await Config.bulb_api.verify(ouid=ouid, sms_otp=message.text)
-            await Config.bulb_api.get_access_token(authcode=response.authcode)
-            await set_states()
-            Config.states.on_off = (await Config.bulb_api.get_device_states(device_id=Config.env.device_id)).on_off
+            response = await tenant.bulb_api.verify(ouid=ouid, sms_otp=message.text)
+            await tenant.bulb_api.get_access_token(authcode=response.authcode)
+            if tenant.loader is not None:
+                tenant.loader.cancel()
+            await prepare(tenant=tenant)
             await message.answer(text='Авторизация прошла успешно')
-            text = 'Выбери команду' if Config.states.online else 'Лампа оффлайн!'
-            await message.answer(text=hbold(text), reply_markup=get_main_keyboard())
+            await answer_main(tenant=tenant, message=message)
         except SberSmartBulbAPIError as e:
             await message.answer(text=str(e))
         await state.set_state('ready')
 
 
-@dp.message_handler(user_id=Config.env.bot_user_ids, state='*')
-async def main(message: types.Message):
+async def answer_main(tenant: Tenant, message: types.Message,
+                      get_data: Callable[[Tenant], tuple[str, types.InlineKeyboardMarkup]] = get_main_data):
+    text, keyboard = get_data(tenant)
+    sent = await message.answer(text=text, reply_markup=keyboard)
+    throttler.rendered.remember(message=sent, text=text, keyboard=keyboard)
+    tenant.menus[sent.chat.id] = (sent, get_data)
+
+
+async def answer_light(tenant: Tenant, message: types.Message, command: str, fields: dict[str, Any]):
+    """
+    Applies a light setting typed as a command to the open menu of the chat, or to a new one if there is none.
+    """
+    get_data = {'white': get_white_data, 'color': get_colour_data}.get(command, get_main_data)
+    if tenant.states is None:
+        await message.answer(text='Лампа загружается, подожди')
+        return
+    if message.chat.id not in tenant.menus:
+        await answer_main(tenant=tenant, message=message, get_data=get_data)
     try:
-        states = (await Config.bulb_api.get_device_states(device_id=Config.env.device_id))
-        Config.states.on_off = states.on_off
-        text = 'Выбери команду' if states.online else 'Лампа оффлайн!'
-        await message.answer(text=hbold(text), reply_markup=get_main_keyboard())
+        await apply_light(tenant=tenant, message=tenant.menus[message.chat.id][0], command=command, fields=fields,
+                          get_data=get_data)
     except SberSmartBulbAPIError as e:
-        await message.answer(text=str(e))
+        await message.answer(text=quote_html(str(e)))
+
+
+@dp.message_handler(commands='set', user_id=Config.env.bot_user_ids, state='*')
+async def set_values(message: types.Message, tenant: Tenant):
+    try:
+        command, fields = parse_set(text=message.get_args())
+    except ValueError as e:
+        await message.answer(text=quote_html(str(e)))
+        return
+    await answer_light(tenant=tenant, message=message, command=command, fields=fields)
+
+
+@dp.message_handler(commands=['white', 'colour', 'color', 'scene'], user_id=Config.env.bot_user_ids, state='*')
+async def set_light(message: types.Message, tenant: Tenant):
+    try:
+        command, fields = parse_command(words=[message.get_command(pure=True), *message.get_args().split()])
+    except ValueError as e:
+        await message.answer(text=quote_html(str(e)))
+        return
+    await answer_light(tenant=tenant, message=message, command=command, fields=fields)
+
+
+@dp.message_handler(commands='preset', user_id=Config.env.bot_user_ids, state='*')
+async def preset(message: types.Message, tenant: Tenant):
+    words = message.get_args().split()
+    if not words:
+        lines = [item.describe() for item in presets.presets.get(tenant.user_id, [])]
+        await message.answer(text='\n'.join(lines) or quote_html('Пресетов нет. Сохрани текущий свет: /preset <имя> '
+                                                                 'или задай его: /preset <имя> white 70 30'))
+        return
+    try:
+        if len(words[0]) > 32:
+            raise ValueError('Имя пресета не длиннее 32 символов')
+        if len(words) > 1:
+            command, fields = parse_command(words=words[1:])
+            added = Preset(name=words[0], command=command, fields=fields)
+        elif tenant.states is None:
+            raise ValueError('Лампа загружается, подожди')
+        else:
+            added = Preset.from_states(name=words[0], states=tenant.states)
+        await presets.add(user_id=tenant.user_id, preset=added)
+    except (ValueError, LockedSberSmartBulbAPIError) as e:
+        await message.answer(text=quote_html(str(e)))
+        return
+    await message.answer(text=f'Пресет сохранён\n{added.describe()}')
+    refresh_menus(tenant=tenant)
+
+
+@dp.message_handler(commands='unpreset', user_id=Config.env.bot_user_ids, state='*')
+async def unpreset(message: types.Message, tenant: Tenant):
+    removed = await presets.remove(user_id=tenant.user_id, name=message.get_args().strip())
+    await message.answer(text='Пресет удалён' if removed else 'Пресет не найден')
+    refresh_menus(tenant=tenant)
+
+
+def refresh_menus(tenant: Tenant):
+    if tenant.states is not None:
+        for message, get_data in tenant.menus.values():
+            show(tenant=tenant, message=message, get_data=get_data)
+
+
+@dp.message_handler(commands='schedule', user_id=Config.env.bot_user_ids, state='*')
+async def schedule(message: types.Message, tenant: Tenant):
+    try:
+        added = await scheduler.add(user_id=tenant.user_id, target=tenant.target, text=message.get_args())
+        await message.answer(text=f'Расписание добавлено\n{added.describe()}')
+    except (ValueError, LockedSberSmartBulbAPIError) as e:
+        await message.answer(text=quote_html(str(e)))
+
+
+@dp.message_handler(commands='schedules', user_id=Config.env.bot_user_ids, state='*')
+async def schedules(message: types.Message, tenant: Tenant):
+    lines = [item.describe() for item in scheduler.schedules.values() if item.user_id == tenant.user_id]
+    await message.answer(text='\n'.join(lines) or 'Расписаний нет')
+
+
+@dp.message_handler(commands='unschedule', user_id=Config.env.bot_user_ids, state='*')
+async def unschedule(message: types.Message, tenant: Tenant):
+    args = message.get_args()
+    removed = args.isdigit() and await scheduler.remove(user_id=tenant.user_id, id=int(args))
+    await message.answer(text='Расписание удалено' if removed else 'Расписание не найдено')
+
+
+@dp.message_handler(user_id=Config.env.bot_user_ids, state='*')
+async def main(message: types.Message, tenant: Tenant):
+    if tenant.states is None and tenant.bulb_api.refresh_token:
+        await message.answer(text='Лампа загружается, подожди')
+    elif tenant.states is None:
+        await message.answer(text='Необходима авторизация', reply_markup=get_auth_keyboard())
+    else:
+        await answer_main(tenant=tenant, message=message)
 
 
 @dp.callback_query_handler(text='on_off', user_id=Config.env.bot_user_ids, state='ready')
-async def on_off(callback_query: types.CallbackQuery, state: FSMContext):
+async def on_off(callback_query: types.CallbackQuery, state: FSMContext, tenant: Tenant):
     await state.set_state('not_ready')
     try:
-        status = not (await Config.bulb_api.get_device_states(device_id=Config.env.device_id)).on_off
-        Config.states.update(on_off=status, time=None)
-        await Config.bulb_api.set_on_off(device_id=Config.env.device_id, value=Config.states.on_off)
-        with suppress(MessageNotModified):
-            await callback_query.message.edit_reply_markup(reply_markup=get_main_keyboard())
-        await callback_query.answer()
+        on_off = tenant.states.on_off
+        if tenant.states.online:
+            device_states = await tenant.states_cache.get_device_states(device_id=tenant.device_id)
+            on_off = device_states.on_off if device_states.online else on_off
+        tenant.states.update(on_off=not on_off, time=None)
+        await run_command(tenant=tenant, device_ids=tenant.device_ids, command='on_off', value=not on_off)
+        show(tenant=tenant, message=callback_query.message, get_data=get_main_data)
+        return await answer(callback_query=callback_query)
     except SberSmartBulbAPIError as e:
-        await callback_query.answer(text=str(e), show_alert=True)
-    await state.set_state('ready')
+        return await answer(callback_query=callback_query, text=str(e))
+    finally:
+        await state.set_state('ready')
 
 
 @dp.callback_query_handler(text_startswith='scene', user_id=Config.env.bot_user_ids, state='ready')
-async def scene(callback_query: types.CallbackQuery, state: FSMContext):
+async def scene(callback_query: types.CallbackQuery, state: FSMContext, tenant: Tenant):
     await state.set_state('not_ready')
     value = callback_query.data.split(':')[1]
     try:
-        await Config.bulb_api.set_scene(device_id=Config.env.device_id, scene=value)
-        Config.states.update(work_mode='scene', light_scene=value)
-        with suppress(MessageNotModified):
-            await callback_query.message.edit_reply_markup(reply_markup=get_main_keyboard())
-        await callback_query.answer()
+        await run_command(tenant=tenant, device_ids=tenant.device_ids, command='scene', scene=value)
+        tenant.states.update(work_mode='scene', light_scene=value)
+        show(tenant=tenant, message=callback_query.message, get_data=get_main_data)
+        return await answer(callback_query=callback_query)
     except SberSmartBulbAPIError as e:
-        await callback_query.answer(text=str(e), show_alert=True)
-    await state.set_state('ready')
+        return await answer(callback_query=callback_query, text=str(e))
+    finally:
+        await state.set_state('ready')
+
+
+@dp.callback_query_handler(text_startswith='preset:', user_id=Config.env.bot_user_ids, state='ready')
+async def apply_preset(callback_query: types.CallbackQuery, state: FSMContext, tenant: Tenant):
+    item = presets.get(user_id=tenant.user_id, index=int(callback_query.data.split(':')[1]))
+    if item is None:
+        show(tenant=tenant, message=callback_query.message, get_data=get_main_data)
+        return await answer(callback_query=callback_query, text='Пресет не найден')
+    await state.set_state('not_ready')
+    try:
+        await apply_light(tenant=tenant, message=callback_query.message, command=item.command, fields=item.fields,
+                          get_data=get_main_data)
+        return await answer(callback_query=callback_query)
+    except SberSmartBulbAPIError as e:
+        return await answer(callback_query=callback_query, text=str(e))
+    finally:
+        await state.set_state('ready')
 
 
 @dp.callback_query_handler(text='white', user_id=Config.env.bot_user_ids, state='*')
-async def white(callback_query: types.CallbackQuery):
-    await callback_query.message.edit_text(text=get_white_text(),
-                                           reply_markup=get_white_keyboard())
-    await callback_query.answer()
+async def white(callback_query: types.CallbackQuery, tenant: Tenant):
+    show(tenant=tenant, message=callback_query.message, get_data=get_white_data)
+    return await answer(callback_query=callback_query)
 
 
 @dp.callback_query_handler(text='colour', user_id=Config.env.bot_user_ids, state='*')
-async def colour(callback_query: types.CallbackQuery):
-    await callback_query.message.edit_text(text=get_colour_text(),
-                                           reply_markup=get_colour_keyboard())
-    await callback_query.answer()
+async def colour(callback_query: types.CallbackQuery, tenant: Tenant):
+    show(tenant=tenant, message=callback_query.message, get_data=get_colour_data)
+    return await answer(callback_query=callback_query)
 
 
 @dp.callback_query_handler(text='timer', user_id=Config.env.bot_user_ids, state='*')
-async def timer(callback_query: types.CallbackQuery):
-    try:
-        current_states = await Config.bulb_api.get_device_states(device_id=Config.env.device_id)
-        new_states = {'on_off': not current_states.on_off}
-        if not current_states.sleep_timer:
-            new_states['time'] = None
-        Config.states.update(**new_states)
-        text, keyboard = get_timer_data()
-        await callback_query.message.edit_text(text=text, reply_markup=keyboard)
-        await callback_query.answer()
-    except SberSmartBulbAPIError as e:
-        await callback_query.answer(text=str(e), show_alert=True)
+async def timer(callback_query: types.CallbackQuery, tenant: Tenant):
+    show(tenant=tenant, message=callback_query.message, get_data=get_timer_data)
+    return await answer(callback_query=callback_query)
+
+
+@dp.callback_query_handler(text='usage', user_id=Config.env.bot_user_ids, state='*')
+async def usage_menu(callback_query: types.CallbackQuery, tenant: Tenant):
+    show(tenant=tenant, message=callback_query.message, get_data=get_usage_data)
+    return await answer(callback_query=callback_query)
 
 
 @dp.callback_query_handler(text_startswith=['up:step', 'down:step'], user_id=Config.env.bot_user_ids, state='*')
-async def action_step(callback_query: types.CallbackQuery):
+async def action_step(callback_query: types.CallbackQuery, tenant: Tenant):
     action, _, value = callback_query.data.split(':')
     if action == 'up':
-        Config.states + 'step'
+        tenant.states + 'step'
     else:
-        Config.states - 'step'
-    text, keyboard = {'white': get_white_data, 'colour': get_colour_data, 'timer': get_timer_data}[value]()
-    await callback_query.message.edit_text(text=text, reply_markup=keyboard)
-    await callback_query.answer()
+        tenant.states - 'step'
+    show(tenant=tenant, message=callback_query.message,
+         get_data={'white': get_white_data, 'colour': get_colour_data, 'timer': get_timer_data}[value])
+    return await answer(callback_query=callback_query)
 
 
-@dp.callback_query_handler(text_startswith=['up', 'down'], user_id=Config.env.bot_user_ids, state='ready')
-async def up_down(callback_query: types.CallbackQuery, state: FSMContext):
-    await state.set_state('not_ready')
+@dp.callback_query_handler(text_startswith=['up', 'down'], user_id=Config.env.bot_user_ids, state='*')
+async def up_down(callback_query: types.CallbackQuery, tenant: Tenant):
     action, value = callback_query.data.split(':')
     if action == 'up':
-        Config.states + value
+        tenant.states + value
     else:
-        Config.states - value
-    text, keyboard = await set_data(callback_query=callback_query, value=value)
-    await callback_query.message.edit_text(text=text, reply_markup=keyboard)
-    await callback_query.answer()
-    await state.set_state('ready')
+        tenant.states - value
+    return await set_data(tenant=tenant, callback_query=callback_query, value=value)
 
 
-@dp.callback_query_handler(text_startswith='default', user_id=Config.env.bot_user_ids, state='ready')
-async def default(callback_query: types.CallbackQuery, state: FSMContext):
-    await state.set_state('not_ready')
+@dp.callback_query_handler(text_startswith='default', user_id=Config.env.bot_user_ids, state='*')
+async def default(callback_query: types.CallbackQuery, tenant: Tenant):
     values = callback_query.data.split(':')
     if len(values) > 2:
-        value = values[2]
-        Config.states.default('step')
-        text, keyboard = {'white': get_white_data, 'colour': get_colour_data, 'timer': get_timer_data}[value]()
+        tenant.states.default('step')
+        show(tenant=tenant, message=callback_query.message,
+             get_data={'white': get_white_data, 'colour': get_colour_data, 'timer': get_timer_data}[values[2]])
+        return await answer(callback_query=callback_query)
     else:
-        value = values[1]
-        Config.states.default(value)
-        text, keyboard = await set_data(callback_query=callback_query, value=value)
-    with suppress(MessageNotModified):
-        await callback_query.message.edit_text(text=text, reply_markup=keyboard)
-    await callback_query.answer()
-    await state.set_state('ready')
+        tenant.states.default(values[1])
+        return await set_data(tenant=tenant, callback_query=callback_query, value=values[1])
 
 
 @dp.callback_query_handler(text='confirm', user_id=Config.env.bot_user_ids, state='ready')
-async def confirm(callback_query: types.CallbackQuery, state: FSMContext):
+async def confirm(callback_query: types.CallbackQuery, state: FSMContext, tenant: Tenant):
     await state.set_state('not_ready')
     try:
-        status = not (await Config.bulb_api.get_device_states(device_id=Config.env.device_id)).on_off
-        await Config.bulb_api.set_timer(device_id=Config.env.device_id, minutes=Config.states.sleep_timer)
-        Config.states.update(on_off=status, time=get_time())
-        text, keyboard = get_timer_data()
-        with suppress(MessageNotModified):
-            await callback_query.message.edit_text(text=text, reply_markup=keyboard)
-        await callback_query.answer()
+        await run_command(tenant=tenant, device_ids=tenant.device_ids, command='timer',
+                          minutes=tenant.states.sleep_timer)
+        tenant.states.update(time=get_time(tenant=tenant))
+        show(tenant=tenant, message=callback_query.message, get_data=get_timer_data)
+        return await answer(callback_query=callback_query)
     except SberSmartBulbAPIError as e:
-        await callback_query.answer(text=str(e), show_alert=True)
-    await state.set_state('ready')
+        return await answer(callback_query=callback_query, text=str(e))
+    finally:
+        await state.set_state('ready')
 
 
-@dp.callback_query_handler(text='back', user_id=Config.env.bot_user_ids, state='*')
-async def back(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(text='devices', user_id=Config.env.bot_user_ids, state='*')
+async def devices(callback_query: types.CallbackQuery, tenant: Tenant):
+    show(tenant=tenant, message=callback_query.message, get_data=get_devices_data)
+    return await answer(callback_query=callback_query)
+
+
+@dp.callback_query_handler(text_startswith='device:', user_id=Config.env.bot_user_ids, state='*')
+async def device(callback_query: types.CallbackQuery, tenant: Tenant):
+    tenant.target = list(tenant.targets)[int(callback_query.data.split(':')[1])]
     try:
-        states = (await Config.bulb_api.get_device_states(device_id=Config.env.device_id))
-        Config.states.on_off = states.on_off
-        text = 'Выбери команду' if states.online else 'Лампа оффлайн!'
-        await callback_query.message.edit_text(text=hbold(text), reply_markup=get_main_keyboard())
-        await callback_query.answer()
+        await set_states(tenant=tenant)
+        tenant.synchronizer.touch()
+        show(tenant=tenant, message=callback_query.message, get_data=get_main_data)
+        return await answer(callback_query=callback_query)
     except SberSmartBulbAPIError as e:
-        await callback_query.answer(text=str(e), show_alert=True)
+        return await answer(callback_query=callback_query, text=str(e))
 
 
-async def on_startup(_):
+@dp.callback_query_handler(text='back', user_id=Config.env.bot_user_ids, state='*')
+async def back(callback_query: types.CallbackQuery, tenant: Tenant):
+    show(tenant=tenant, message=callback_query.message, get_data=get_main_data)
+    return await answer(callback_query=callback_query)
+
+
+async def recover_users():
+    # An unfinished auth flow survives a restart, a command interrupted mid-flight must not stay locked
     for user_id in Config.env.bot_user_ids:
-        await dp.current_state(user=user_id).set_state('ready')
-    await Config.init()
-    if not Config.bulb_api.refresh_token:
-        await dp.bot.send_message(chat_id=Config.env.bot_user_ids[0], text='Необходима авторизация',
+        state = dp.current_state(user=user_id)
+        if await state.get_state() in (None, 'not_ready'):
+            await state.set_state('ready')
+
+
+def report_startup(_: asyncio.Future):
+    startup.mark('ready')
+    logging.info(startup.report())
+
+
+async def poll_usage():
+    # Reads go through the states cache, which records them, a lamp the synchronizer polls anyway is a cache hit.
+    # Tenants are not touched, so polling neither keeps them loaded nor stops when they are evicted
+    for user_id in Config.env.bot_user_ids:
+        tenant = tenants.get(user_id=user_id, touch=False)
+        if not tenant.bulb_api.refresh_token:
+            continue
+        for device_id in tenant.devices.values():
+            try:
+                await tenant.states_cache.get_device_states(device_id=device_id, max_age=usage.poll_interval)
+            except SberSmartBulbAPIError as e:
+                logging.warning('Usage poll of %s failed: %s', device_id, e)
+
+
+async def lead():
+    # Background work runs on the replica holding the leader lease, right away when there is a single replica
+    if Config.env.mode == 'webhook':
+        # Pending updates are kept, replicas starting in a rolling deploy must not drop what the others queued
+        try:
+            await startup.run('webhook', bot.set_webhook(url=f'{Config.env.webhook_url}{Config.env.webhook_path}'))
+        except TelegramAPIError as e:
+            logging.error('Setting the webhook failed: %s', e)
+    await recover_users()
+    scheduler.refresh()
+    scheduler.start()
+    tenants.load_offline()
+    usage.start(poll=poll_usage)
+    owner = tenants.get(user_id=tenants.owner)
+    if owner.loader is None:
+        await dp.bot.send_message(chat_id=owner.user_id, text='Необходима авторизация',
                                   reply_markup=get_auth_keyboard())
+
+
+async def follow():
+    await scheduler.stop()
+    await usage.close()
+
+
+async def refresh_shared():
+    scheduler.refresh()
+    presets.refresh()
+    if not cluster.is_leader:
+        await usage.refresh()
+
+
+async def on_startup(_):
+    steps = [startup.run('scheduler', asyncio.to_thread(scheduler.load)),
+             startup.run('presets', asyncio.to_thread(presets.load)),
+             startup.run('usage', asyncio.to_thread(usage.load)),
+             startup.run('metrics', metrics.start(host=Config.env.metrics_host, port=Config.env.metrics_port,
+                                                  log_interval=Config.env.metrics_log_interval))]
+    await asyncio.gather(*steps)
+    owner = tenants.get(user_id=tenants.owner)
+    tenants.start()
+    await startup.run('cluster', cluster.start(lead=lead, follow=follow, refresh=refresh_shared))
+    startup.mark('serving')
+    if owner.loader is None:
+        logging.info(startup.report())
     else:
-        await set_states()
+        owner.loader.add_done_callback(report_startup)
 
 
 async def on_shutdown(_):
-    await Config.stop()
+    await metrics.stop()
+    await scheduler.stop()
+    await pipeline.close()
+    await throttler.close()
+    await tenants.close()
+    await usage.close()
+    await journal.close()
+    await cluster.stop()
 
 
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True,
-                           on_startup=on_startup,
-                           on_shutdown=on_shutdown)
+    if Config.env.cluster_path and Config.env.mode != 'webhook':
+        # Telegram hands getUpdates to one client at a time, replicas can only share a webhook
+        raise SystemExit('CLUSTER_PATH requires MODE=webhook')
+    if Config.env.mode == 'webhook':
+        # skip_updates would delete the webhook and drop the pending updates every time a replica starts
+        executor.start_webhook(dp, webhook_path=Config.env.webhook_path, skip_updates=False,
+                               on_startup=on_startup,
+                               on_shutdown=on_shutdown,
+                               host=Config.env.webapp_host,
+                               port=Config.env.webapp_port)
+    else:
+        executor.start_polling(dp, skip_updates=True,
+                               on_startup=on_startup,
+                               on_shutdown=on_shutdown)
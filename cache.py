@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from sber_smart_bulb_api import SberSmartBulbAPI
+from sber_smart_bulb_api.models import (DeviceSceneEnum,
+                                        DeviceStates)
+
+from cluster import cluster
+from resilience import ResilientBulbAPI
+from usage import usage
+
+
+class StatesCache:
+    def __init__(self, bulb_api: SberSmartBulbAPI | ResilientBulbAPI, ttl: float):
+        self.bulb_api = bulb_api
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._values: dict[str, tuple[float, DeviceStates]] = {}
+        self._fetches: dict[str, asyncio.Task] = {}
+        self._generations: dict[str, int] = {}
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+    async def get_device_states(self, device_id: str, max_age: float | None = None) -> DeviceStates:
+        max_age = self.ttl if max_age is None else max_age
+        cached = self._values.get(device_id)
+        if cached is not None and time.monotonic() - cached[0] <= max_age:
+            self.hits += 1
+            return cached[1]
+        fetch = self._fetches.get(device_id)
+        if fetch is None:
+            self.misses += 1
+            fetch = asyncio.create_task(self._fetch(device_id=device_id))
+            self._fetches[device_id] = fetch
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(fetch)
+
+    async def _fetch(self, device_id: str) -> DeviceStates:
+        generation = self._generations.get(device_id, 0)
+        try:
+            states = await self.bulb_api.get_device_states(device_id=device_id)
+        finally:
+            if self._fetches.get(device_id) is asyncio.current_task():
+                del self._fetches[device_id]
+        usage.observe(device_id=device_id, states=states)
+        if self._generations.get(device_id, 0) == generation:
+            self._values[device_id] = (time.monotonic(), states)
+        return states
+
+    def invalidate(self, device_id: str):
+        self._generations[device_id] = self._generations.get(device_id, 0) + 1
+        self._values.pop(device_id, None)
+        self._fetches.pop(device_id, None)
+
+    async def set_on_off(self, device_id: str, value: bool):
+        async with cluster.lock(name=f'device:{device_id}'):
+            try:
+                await self.bulb_api.set_on_off(device_id=device_id, value=value)
+                usage.update(device_id=device_id, on=value)
+            finally:
+                self.invalidate(device_id=device_id)
+
+    async def set_scene(self, device_id: str, scene: DeviceSceneEnum | str):
+        async with cluster.lock(name=f'device:{device_id}'):
+            try:
+                await self.bulb_api.set_scene(device_id=device_id, scene=scene)
+                usage.update(device_id=device_id, mode=getattr(scene, 'value', scene))
+            finally:
+                self.invalidate(device_id=device_id)
+
+    async def set_white(self, device_id: str, brightness: int, temp: int):
+        async with cluster.lock(name=f'device:{device_id}'):
+            try:
+                await self.bulb_api.set_white(device_id=device_id, brightness=brightness, temp=temp)
+                usage.update(device_id=device_id, brightness=brightness, mode='white')
+            finally:
+                self.invalidate(device_id=device_id)
+
+    async def set_color(self, device_id: str, h: int, s: int, v: int):
+        async with cluster.lock(name=f'device:{device_id}'):
+            try:
+                await self.bulb_api.set_color(device_id=device_id, h=h, s=s, v=v)
+                usage.update(device_id=device_id, brightness=v, mode='colour')
+            finally:
+                self.invalidate(device_id=device_id)
+
+    async def set_timer(self, device_id: str, minutes: int):
+        async with cluster.lock(name=f'device:{device_id}'):
+            try:
+                await self.bulb_api.set_timer(device_id=device_id, minutes=minutes)
+            finally:
+                self.invalidate(device_id=device_id)
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import (AsyncIterator,
+                    Awaitable,
+                    Callable)
+
+from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+
+from metrics import wait_latency
+
+logger = logging.getLogger(__name__)
+
+
+class LockedSberSmartBulbAPIError(SberSmartBulbAPIError):
+    """"""
+
+
+class Cluster:
+    """
+    Coordinates replicas that share a data volume through leases in one SQLite file.
+
+    The replica holding the leader lease runs the background work, the others only serve webhook updates. A lease is
+    renewed every renew_interval and lapses lease_ttl after the last renewal, so a crashed or partitioned leader is
+    replaced within lease_ttl. The same leases serve as named locks with a shorter ttl. Without a path there is a
+    single replica: it leads from the start and locks are only local.
+    """
+
+    def __init__(self):
+        self.path: str | None = None
+        self.replica_id = f'{socket.gethostname()}-{os.getpid()}'
+        self.lease_ttl = 15.0
+        self.renew_interval = 5.0
+        self.lock_ttl = 15.0
+        self.lock_timeout = 10.0
+        self.leading = False
+        self.elections = 0
+        self.contended = 0
+        self._renewed = 0.0
+        self._lock = threading.Lock()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._connection: sqlite3.Connection | None = None
+        self._task: asyncio.Task | None = None
+
+    def configure(self, path: str, replica_id: str, lease_ttl: float, renew_interval: float, lock_ttl: float,
+                  lock_timeout: float):
+        self.path = path or None
+        self.replica_id = replica_id or self.replica_id
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self.lock_ttl = lock_ttl
+        self.lock_timeout = lock_timeout
+
+    @property
+    def is_leader(self) -> bool:
+        return self.path is None or self.leading
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=self.lock_timeout)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, '
+                                     'expires REAL)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS shared (name TEXT PRIMARY KEY, value TEXT)')
+        return self._connection
+
+    def _acquire(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            cursor = connection.execute('INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE '
+                                        'SET owner = excluded.owner, expires = excluded.expires '
+                                        'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                                        (name, self.replica_id, now + ttl, now))
+            return cursor.rowcount == 1
+
+    def _release(self, name: str):
+        with self._lock, self._connect() as connection:
+            connection.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, self.replica_id))
+
+    def _get(self, name: str) -> str | None:
+        with self._lock:
+            row = self._connect().execute('SELECT value FROM shared WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _put(self, name: str, value: str):
+        with self._lock, self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO shared VALUES (?, ?)', (name, value))
+
+    async def get(self, name: str) -> str | None:
+        """
+        Returns a value another replica shared, always None for a single replica.
+        """
+        if self.path is None:
+            return None
+        try:
+            return await asyncio.to_thread(self._get, name)
+        except sqlite3.Error as e:
+            logger.warning('Reading shared %s failed: %s', name, e)
+            return None
+
+    async def put(self, name: str, value: str):
+        if self.path is None:
+            return
+        try:
+            await asyncio.to_thread(self._put, name, value)
+        except sqlite3.Error as e:
+            logger.warning('Sharing %s failed: %s', name, e)
+
+    async def start(self, lead: Callable[[], Awaitable[None]], follow: Callable[[], Awaitable[None]],
+                    refresh: Callable[[], Awaitable[None]]):
+        """
+        Calls lead() whenever this replica becomes the leader and follow() when it loses the lease. Every replica
+        calls refresh() after each renewal round to pick up files changed by the others.
+        """
+        if self.path is None:
+            await lead()
+        elif self._task is None:
+            self._task = asyncio.create_task(self._run(lead=lead, follow=follow, refresh=refresh))
+
+    async def _run(self, lead: Callable[[], Awaitable[None]], follow: Callable[[], Awaitable[None]],
+                   refresh: Callable[[], Awaitable[None]]):
+        while True:
+            try:
+                leader = await asyncio.to_thread(self._acquire, 'leader', self.lease_ttl)
+                if leader:
+                    self._renewed = time.time()
+            except sqlite3.Error as e:
+                logger.warning('Renewing the leader lease failed: %s', e)
+                # Another replica may take over once the lease lapses, the work has to stop before that
+                leader = self.leading and time.time() - self._renewed < self.lease_ttl - self.renew_interval
+            if leader != self.leading:
+                self.leading = leader
+                logger.info('Replica %s is %s', self.replica_id, 'the leader' if leader else 'a follower')
+                try:
+                    if leader:
+                        self.elections += 1
+                        await lead()
+                    else:
+                        await follow()
+                except Exception:
+                    logger.exception('Switching the replica role failed')
+            try:
+                await refresh()
+            except Exception:
+                logger.exception('Refreshing shared state failed')
+            await asyncio.sleep(self.renew_interval)
+
+    @asynccontextmanager
+    async def lock(self, name: str) -> AsyncIterator[None]:
+        """
+        Holds the named lock across replicas, waiting for it at most lock_timeout. Waiters of the same replica queue
+        on a local lock first, so only one of them polls the shared lease.
+        """
+        local = self._locks.setdefault(name, asyncio.Lock())
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(local.acquire(), timeout=self.lock_timeout)
+        except asyncio.TimeoutError:
+            raise LockedSberSmartBulbAPIError('Лампа занята другой командой, повтори позже') from None
+        try:
+            if self.path is not None:
+                await self._acquire_shared(name=f'lock:{name}')
+            # Names are labelled by their kind, device ids and token paths would make a label value each
+            wait_latency.get(f'lock:{name.partition(":")[0]}').observe(time.perf_counter() - started)
+            try:
+                yield
+            finally:
+                if self.path is not None:
+                    await self._release_shared(name=f'lock:{name}')
+        finally:
+            local.release()
+
+    async def _acquire_shared(self, name: str):
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.01
+        while True:
+            try:
+                if await asyncio.to_thread(self._acquire, name, self.lock_ttl):
+                    return
+            except sqlite3.Error as e:
+                raise LockedSberSmartBulbAPIError(f'Блокировка недоступна: {e}') from e
+            self.contended += 1
+            if time.monotonic() + delay > deadline:
+                raise LockedSberSmartBulbAPIError('Лампа занята другой командой, повтори позже')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    async def _release_shared(self, name: str):
+        try:
+            await asyncio.to_thread(self._release, name)
+        except sqlite3.Error as e:
+            logger.warning('Releasing %s failed, it lapses in %ss: %s', name, self.lock_ttl, e)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.leading:
+            # Handing the lease over right away lets the next leader start without waiting for it to lapse
+            await self._release_shared(name='leader')
+        self.leading = False
+        if self._connection is not None:
+            with self._lock:
+                self._connection.close()
+            self._connection = None
+
+
+cluster = Cluster()
@@ -1,29 +1,84 @@
 import os
+from zoneinfo import ZoneInfo
 
-from sber_smart_bulb_api import SberSmartBulbAPI
-from states import States
+
+def parse_mapping(value: str | None) -> dict[str, str]:
+    return dict(item.strip().split('=', 1) for item in (value or '').split(',') if item.strip())
 
 
 class Environment:
     bot_token = os.getenv('BOT_TOKEN')
     bot_user_ids = [int(uid) for uid in os.getenv('BOT_USER_IDS').split(',')]
     device_id = os.getenv('DEVICE_ID')
+    devices = parse_mapping(os.getenv('DEVICES')) or {'Лампа': device_id}
+    device_groups = {name: members.split('+') for name, members in parse_mapping(os.getenv('DEVICE_GROUPS')).items()}
     timezone = os.getenv('TIMEZONE', 'Europe/Moscow')
+    refresh_token_path = os.getenv('REFRESH_TOKEN_PATH', 'data/sber_refresh_token')
+    token_refresh_margin = float(os.getenv('TOKEN_REFRESH_MARGIN', '300'))
+    token_retry_interval = float(os.getenv('TOKEN_RETRY_INTERVAL', '30'))
+    tokens_dir = os.getenv('TOKENS_DIR', 'data/tokens')
+    tenants_path = os.getenv('TENANTS_PATH', 'data/tenants.json')
+    offline_dir = os.getenv('OFFLINE_DIR', 'data/offline')
+    tenant_idle_timeout = float(os.getenv('TENANT_IDLE_TIMEOUT', '1800'))
+    http_pool_size = int(os.getenv('HTTP_POOL_SIZE', '100'))
+    states_ttl = float(os.getenv('STATES_TTL', '5'))
+    command_debounce = float(os.getenv('COMMAND_DEBOUNCE', '0.3'))
+    edit_chat_rate = float(os.getenv('EDIT_CHAT_RATE', '3'))
+    edit_global_rate = float(os.getenv('EDIT_GLOBAL_RATE', '30'))
+    sync_fast_interval = float(os.getenv('SYNC_FAST_INTERVAL', '1'))
+    sync_idle_interval = float(os.getenv('SYNC_IDLE_INTERVAL', '30'))
+    sync_offline_interval = float(os.getenv('SYNC_OFFLINE_INTERVAL', '60'))
+    sync_active_window = float(os.getenv('SYNC_ACTIVE_WINDOW', '30'))
+    fleet_concurrency = int(os.getenv('FLEET_CONCURRENCY', '8'))
+    fleet_timeout = float(os.getenv('FLEET_TIMEOUT', '10'))
+    api_read_budget = float(os.getenv('API_READ_BUDGET', '4'))
+    api_write_budget = float(os.getenv('API_WRITE_BUDGET', '8'))
+    api_attempt_timeout = float(os.getenv('API_ATTEMPT_TIMEOUT', '3'))
+    api_retries = int(os.getenv('API_RETRIES', '2'))
+    api_retry_backoff = float(os.getenv('API_RETRY_BACKOFF', '0.2'))
+    breaker_threshold = int(os.getenv('BREAKER_THRESHOLD', '3'))
+    breaker_reset = float(os.getenv('BREAKER_RESET', '30'))
+    schedules_path = os.getenv('SCHEDULES_PATH', 'data/schedules.json')
+    schedule_catch_up = float(os.getenv('SCHEDULE_CATCH_UP', '3600'))
+    schedule_rate = float(os.getenv('SCHEDULE_RATE', '1'))
+    fsm_path = os.getenv('FSM_PATH', 'data/fsm.sqlite3')
+    fsm_flush_interval = float(os.getenv('FSM_FLUSH_INTERVAL', '0.5'))
+    metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+    metrics_port = int(os.getenv('METRICS_PORT', '9100'))
+    metrics_log_interval = float(os.getenv('METRICS_LOG_INTERVAL', '300'))
+    journal_path = os.getenv('JOURNAL_PATH', 'data/journal.jsonl')
+    journal_max_bytes = int(os.getenv('JOURNAL_MAX_BYTES', '10485760'))
+    journal_backups = int(os.getenv('JOURNAL_BACKUPS', '5'))
+    journal_buffer = int(os.getenv('JOURNAL_BUFFER', '10000'))
+    journal_flush_interval = float(os.getenv('JOURNAL_FLUSH_INTERVAL', '1'))
+    presets_path = os.getenv('PRESETS_PATH', 'data/presets.json')
+    presets_limit = int(os.getenv('PRESETS_LIMIT', '6'))
+    usage_path = os.getenv('USAGE_PATH', 'data/usage.json')
+    usage_changes = int(os.getenv('USAGE_CHANGES', '256'))
+    usage_minutes = int(os.getenv('USAGE_MINUTES', '1440'))
+    usage_hours = int(os.getenv('USAGE_HOURS', '840'))
+    usage_max_gap = float(os.getenv('USAGE_MAX_GAP', '3600'))
+    usage_snapshot_interval = float(os.getenv('USAGE_SNAPSHOT_INTERVAL', '300'))
+    usage_poll_interval = float(os.getenv('USAGE_POLL_INTERVAL', '300'))
+    usage_lamp_watts = float(os.getenv('USAGE_LAMP_WATTS', '9'))
+    cluster_path = os.getenv('CLUSTER_PATH', '')
+    replica_id = os.getenv('REPLICA_ID', '')
+    cluster_lease_ttl = float(os.getenv('CLUSTER_LEASE_TTL', '15'))
+    cluster_renew_interval = float(os.getenv('CLUSTER_RENEW_INTERVAL', '5'))
+    cluster_lock_ttl = float(os.getenv('CLUSTER_LOCK_TTL', '15'))
+    cluster_lock_timeout = float(os.getenv('CLUSTER_LOCK_TIMEOUT', '10'))
+    mode = os.getenv('MODE', 'polling')
+    telegram_api_url = os.getenv('TELEGRAM_API_URL')
+    webhook_url = os.getenv('WEBHOOK_URL')
+    webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+    webapp_host = os.getenv('WEBAPP_HOST', '0.0.0.0')
+    webapp_port = int(os.getenv('WEBAPP_PORT', '8080'))
 
 
 class _Config:
     def __init__(self, env: Environment):
         self.env = env
-        self.bulb_api: SberSmartBulbAPI | None = None
-        self.states: States | None = None
-
-    async def init(self):
-        with open('sber_refresh_token') as f:
-            refresh_token = f.read()
-        self.bulb_api = SberSmartBulbAPI(refresh_token=refresh_token.strip())
-
-    async def stop(self):
-        await self.bulb_api.close()
+        self.tz = ZoneInfo(env.timezone)
 
 
 Config = _Config(env=Environment())
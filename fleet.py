@@ -0,0 +1,45 @@
+import asyncio
+from typing import (Any,
+                    Awaitable,
+                    Callable)
+
+from sber_smart_bulb_api.exceptions import (SberSmartBulbAPIError,
+                                            TimeoutSberSmartBulbAPIError)
+
+from metrics import wait_latency
+
+
+class FleetSberSmartBulbAPIError(SberSmartBulbAPIError):
+    def __init__(self, message: str, errors: dict[str, Exception]):
+        super().__init__(message)
+        self.errors = errors
+
+
+class Fleet:
+    def __init__(self, names: dict[str, str], concurrency: int, timeout: float):
+        self.names = names
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wait = wait_latency.get('fleet')
+
+    async def _run_one(self, device_id: str, command: Callable[..., Awaitable[Any]]) -> Any:
+        started = asyncio.get_running_loop().time()
+        async with self._semaphore:
+            self._wait.observe(asyncio.get_running_loop().time() - started)
+            try:
+                return await asyncio.wait_for(command(device_id=device_id), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutSberSmartBulbAPIError('Timeout error')
+
+    async def run(self, device_ids: list[str], command: Callable[..., Awaitable[Any]]) -> list[Any]:
+        if len(device_ids) == 1:
+            return [await self._run_one(device_id=device_ids[0], command=command)]
+        results = await asyncio.gather(*(self._run_one(device_id=device_id, command=command)
+                                         for device_id in device_ids), return_exceptions=True)
+        errors = {device_id: result for device_id, result in zip(device_ids, results)
+                  if isinstance(result, Exception)}
+        if errors:
+            lines = [f'{self.names.get(device_id, device_id)}: {error}' for device_id, error in errors.items()]
+            message = f'Ошибка на {len(errors)} из {len(device_ids)}\n' + '\n'.join(lines)
+            raise FleetSberSmartBulbAPIError(message=message[:200], errors=errors)
+        return results
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Append-only JSONL record of user actions and bulb API calls.
+
+    record() only appends to a bounded in-memory buffer, records that do not fit are counted and dropped so the
+    journal never slows a tap down. A background task writes the buffer every flush_interval from a worker thread and
+    rotates the file to path.1 ... path.<backups> once it exceeds max_bytes.
+    """
+
+    def __init__(self):
+        self.path: str | None = None
+        self.max_bytes = 0
+        self.backups = 0
+        self.buffer_size = 0
+        self.flush_interval = 0.0
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self._buffer: list[dict[str, Any]] = []
+        self._task: asyncio.Task | None = None
+
+    def configure(self, path: str, max_bytes: int, backups: int, buffer_size: int, flush_interval: float):
+        self.path = path or None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+    def record(self, kind: str, **fields: Any):
+        if self.path is None:
+            return
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self.recorded += 1
+        self._buffer.append({'ts': time.time(), 'kind': kind, **fields})
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        records, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, records)
+        except OSError as e:
+            logger.warning('Writing %s journal records failed: %s', len(records), e)
+
+    def _write(self, records: list[dict[str, Any]]):
+        data = ''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n' for record in records)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, 'a') as f:
+            f.write(data)
+        self.written += len(records)
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{index}'):
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+def read_journal(path: str) -> list[dict[str, Any]]:
+    """
+    Returns the records of the journal and its rotated backups, oldest first.
+    """
+    paths = [path]
+    while os.path.exists(f'{path}.{len(paths)}'):
+        paths.append(f'{path}.{len(paths)}')
+    records = []
+    for name in reversed(paths):
+        if os.path.exists(name):
+            with open(name) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+journal = Journal()
+
+
+class JournalMiddleware(BaseMiddleware):
+    """
+    Records every update with the lamp states before and after its handler, including updates no handler took. Texts
+    of plain messages are not recorded, they carry phone numbers and SMS codes during authorization.
+    """
+
+    async def on_pre_process_message(self, _: types.Message, data: dict):
+        self._start(context=data)
+
+    async def on_process_message(self, _: types.Message, data: dict):
+        self._snapshot(context=data)
+
+    async def on_post_process_message(self, message: types.Message, _: list, data: dict):
+        text = message.text if message.is_command() else None
+        self._finish(context=data, user_id=message.from_user.id, chat_id=message.chat.id, update='message', text=text)
+
+    async def on_pre_process_callback_query(self, _: types.CallbackQuery, data: dict):
+        self._start(context=data)
+
+    async def on_process_callback_query(self, _: types.CallbackQuery, data: dict):
+        self._snapshot(context=data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, _: list, data: dict):
+        self._finish(context=data, user_id=callback_query.from_user.id, chat_id=callback_query.message.chat.id,
+                     update='callback_query', data=callback_query.data)
+
+    @staticmethod
+    def _start(context: dict):
+        if journal.path is not None:
+            context['journal_started'] = time.perf_counter()
+
+    @staticmethod
+    def _snapshot(context: dict):
+        tenant = context.get('tenant')
+        if 'journal_started' in context and 'journal_before' not in context:
+            context['journal_before'] = None if tenant is None or tenant.states is None else tenant.states.snapshot()
+
+    @staticmethod
+    def _finish(context: dict, **fields: Any):
+        if 'journal_started' not in context:
+            return
+        tenant = context.get('tenant')
+        journal.record('action', **fields, target=None if tenant is None else tenant.target,
+                       handled='journal_before' in context,
+                       ms=round((time.perf_counter() - context['journal_started']) * 1000, 3),
+                       before=context.get('journal_before'),
+                       after=None if tenant is None or tenant.states is None else tenant.states.snapshot())
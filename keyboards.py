@@ -1,15 +1,19 @@
+from functools import lru_cache
+
 from aiogram import types
 
-from config import Config
+from presets import presets
+from states import States
+from tenants import Tenant
 from texts import get_time
 
 
-def get_sc_button(text: str, scene: str) -> str:
-    return f'{"✅ " if Config.states.work_mode == "scene" and Config.states.light_scene == scene else ""}{text}'
+def get_sc_button(text: str, scene: str, work_mode: str, light_scene: str) -> str:
+    return f'{"✅ " if work_mode == "scene" and light_scene == scene else ""}{text}'
 
 
-def get_md_button(text: str, mode: str) -> str:
-    return f'{"✅ " if Config.states.work_mode == mode else ""}{text}'
+def get_md_button(text: str, mode: str, work_mode: str) -> str:
+    return f'{"✅ " if work_mode == mode else ""}{text}'
 
 
 def get_keyboard(row_width: int, buttons: list[list[tuple[str, str]]]) -> types.InlineKeyboardMarkup:
@@ -22,99 +26,151 @@ def get_keyboard(row_width: int, buttons: list[list[tuple[str, str]]]) -> types.
     return keyboard
 
 
-def get_main_keyboard() -> types.InlineKeyboardMarkup:
+def get_main_keyboard(tenant: Tenant) -> types.InlineKeyboardMarkup:
+    return render_main_keyboard(on_off=tenant.states.on_off, work_mode=tenant.states.work_mode,
+                                light_scene=tenant.states.light_scene, target=tenant.target,
+                                targets=tuple(tenant.targets), presets=presets.names(user_id=tenant.user_id))
+
+
+@lru_cache(maxsize=256)
+def render_main_keyboard(on_off: bool, work_mode: str, light_scene: str, target: str, targets: tuple[str, ...],
+                         presets: tuple[str, ...] = ()) -> types.InlineKeyboardMarkup:
     buttons = [
         [
-            ('Выключить' if Config.states.on_off else 'Включить', 'on_off'),
-            (get_sc_button('Свеча', 'candle'), 'scene:candle')
+            ('Выключить' if on_off else 'Включить', 'on_off'),
+            (get_sc_button('Свеча', 'candle', work_mode, light_scene), 'scene:candle')
         ],
         [
-            (get_sc_button('Северное сияние', 'arctic'), 'scene:arctic'),
-            (get_sc_button('Романтика', 'romantic'), 'scene:romantic')
+            (get_sc_button('Северное сияние', 'arctic', work_mode, light_scene), 'scene:arctic'),
+            (get_sc_button('Романтика', 'romantic', work_mode, light_scene), 'scene:romantic')
         ],
         [
-            (get_sc_button('Рассвет', 'dawn'), 'scene:dawn'),
-            (get_sc_button('Закат', 'sunset'), 'scene:sunset')
+            (get_sc_button('Рассвет', 'dawn', work_mode, light_scene), 'scene:dawn'),
+            (get_sc_button('Закат', 'sunset', work_mode, light_scene), 'scene:sunset')
         ],
         [
-            (get_sc_button('Новогодний', 'christmas'), 'scene:christmas'),
-            (get_sc_button('Фитосвет', 'fito'), 'scene:fito')
+            (get_sc_button('Новогодний', 'christmas', work_mode, light_scene), 'scene:christmas'),
+            (get_sc_button('Фитосвет', 'fito', work_mode, light_scene), 'scene:fito')
         ],
         [
-            (get_md_button('Белый', 'white'), 'white'),
-            (get_md_button('Цветной', 'colour'), 'colour')
+            (get_md_button('Белый', 'white', work_mode), 'white'),
+            (get_md_button('Цветной', 'colour', work_mode), 'colour')
         ],
         [
-            ('Таймер', 'timer')
+            ('Таймер', 'timer'),
+            ('Статистика', 'usage')
         ]
     ]
+    for index in range(0, len(presets), 2):
+        buttons.insert(-1, [(f'⭐ {name}', f'preset:{index + offset}')
+                            for offset, name in enumerate(presets[index:index + 2])])
+    if len(targets) > 1:
+        buttons.insert(0, [(f'💡 {target}', 'devices')])
     return get_keyboard(row_width=2, buttons=buttons)
 
 
-def get_white_keyboard() -> types.InlineKeyboardMarkup:
+def get_devices_keyboard(tenant: Tenant) -> types.InlineKeyboardMarkup:
+    return render_devices_keyboard(target=tenant.target, targets=tuple(tenant.targets))
+
+
+@lru_cache(maxsize=64)
+def render_devices_keyboard(target: str, targets: tuple[str, ...]) -> types.InlineKeyboardMarkup:
+    buttons = [[(f'{"✅ " if target == name else ""}{name}', f'device:{index}')]
+               for index, name in enumerate(targets)]
+    buttons.append([('⤴️ Назад', 'back')])
+    return get_keyboard(row_width=1, buttons=buttons)
+
+
+def get_white_keyboard(tenant: Tenant) -> types.InlineKeyboardMarkup:
+    return render_white_keyboard(bright_value_v2=tenant.states.bright_value_v2,
+                                 temp_value_v2=tenant.states.temp_value_v2, step_index=tenant.states.step_index)
+
+
+@lru_cache(maxsize=256)
+def render_white_keyboard(bright_value_v2: int, temp_value_v2: int, step_index: int) -> types.InlineKeyboardMarkup:
     buttons = [[], [], [], []]
-    if Config.states.bright_value_v2 > 1:
+    if bright_value_v2 > States.minimals['bright_value_v2']:
         buttons[0].append(('◀️', 'down:bright_value_v2'))
     buttons[0].append(('Яркость', 'default:bright_value_v2'))
-    if Config.states.bright_value_v2 < 100:
+    if bright_value_v2 < States.maximals['bright_value_v2']:
         buttons[0].append(('▶️', 'up:bright_value_v2'))
-    if Config.states.temp_value_v2 > 1:
+    if temp_value_v2 > States.minimals['temp_value_v2']:
         buttons[1].append(('◀️', 'down:temp_value_v2'))
     buttons[1].append(('Температура', 'default:temp_value_v2'))
-    if Config.states.temp_value_v2 < 100:
+    if temp_value_v2 < States.maximals['temp_value_v2']:
         buttons[1].append(('▶️', 'up:temp_value_v2'))
-    if Config.states.step_index > 0:
+    if step_index > 0:
         buttons[2].append(('◀️', 'down:step:white'))
     buttons[2].append(('Шаг', 'default:step:white'))
-    if Config.states.step_index < 4:
+    if step_index < 4:
         buttons[2].append(('▶️', 'up:step:white'))
     buttons[3].append(('⤴️ Назад', 'back'))
     return get_keyboard(row_width=3, buttons=buttons)
 
 
-def get_colour_keyboard() -> types.InlineKeyboardMarkup:
+def get_colour_keyboard(tenant: Tenant) -> types.InlineKeyboardMarkup:
+    return render_colour_keyboard(h=tenant.states.h, s=tenant.states.s, v=tenant.states.v,
+                                  step_index=tenant.states.step_index)
+
+
+@lru_cache(maxsize=256)
+def render_colour_keyboard(h: int, s: int, v: int, step_index: int) -> types.InlineKeyboardMarkup:
     buttons = [[], [], [], [], []]
-    if Config.states.h > 0:
+    if h > States.minimals['h']:
         buttons[0].append(('◀️', 'down:h'))
     buttons[0].append(('Тон', 'default:h'))
-    if Config.states.h < 360:
+    if h < States.maximals['h']:
         buttons[0].append(('▶️', 'up:h'))
-    if Config.states.s > 0:
+    if s > States.minimals['s']:
         buttons[1].append(('◀️', 'down:s'))
     buttons[1].append(('Насыщенность', 'default:s'))
-    if Config.states.s < 100:
+    if s < States.maximals['s']:
         buttons[1].append(('▶️', 'up:s'))
-    if Config.states.v > 0:
+    if v > States.minimals['v']:
         buttons[2].append(('◀️', 'down:v'))
     buttons[2].append(('Яркость', 'default:v'))
-    if Config.states.v < 100:
+    if v < States.maximals['v']:
         buttons[2].append(('▶️', 'up:v'))
-    if Config.states.step_index > 0:
+    if step_index > 0:
         buttons[3].append(('◀️', 'down:step:colour'))
     buttons[3].append(('Шаг', 'default:step:colour'))
-    if Config.states.step_index < 4:
+    if step_index < 4:
         buttons[3].append(('▶️', 'up:step:colour'))
     buttons[4].append(('⤴️ Назад', 'back'))
     return get_keyboard(row_width=3, buttons=buttons)
 
 
-def get_timer_keyboard() -> types.InlineKeyboardMarkup:
+def get_timer_keyboard(tenant: Tenant) -> types.InlineKeyboardMarkup:
+    return render_timer_keyboard(sleep_timer=tenant.states.sleep_timer, step_index=tenant.states.step_index,
+                                 turn_on=not tenant.states.on_off, time=get_time(tenant=tenant))
+
+
+@lru_cache(maxsize=256)
+def render_timer_keyboard(sleep_timer: int, step_index: int, turn_on: bool,
+                          time: str) -> types.InlineKeyboardMarkup:
     buttons = [[], [], [], []]
-    if Config.states.sleep_timer > 1:
+    if sleep_timer > States.minimals['sleep_timer']:
         buttons[0].append(('◀️', f'down:sleep_timer'))
     buttons[0].append(('Минуты', f'default:sleep_timer'))
-    if Config.states.sleep_timer < 1440:
+    if sleep_timer < States.maximals['sleep_timer']:
         buttons[0].append(('▶️', f'up:sleep_timer'))
-    if Config.states.step_index > 0:
+    if step_index > 0:
         buttons[1].append(('◀️', f'down:step:timer'))
     buttons[1].append(('Шаг', f'default:step:timer'))
-    if Config.states.step_index < 4:
+    if step_index < 4:
         buttons[1].append(('▶️', f'up:step:timer'))
-    buttons[2].append((f"{'Включить' if Config.states.on_off else 'Выключить'} в {get_time()}", f'confirm'))
+    buttons[2].append((f"{'Включить' if turn_on else 'Выключить'} в {time}", f'confirm'))
     buttons[3].append(('⤴️ Назад', 'back'))
     return get_keyboard(row_width=3, buttons=buttons)
 
 
+@lru_cache(maxsize=1)
+def get_usage_keyboard() -> types.InlineKeyboardMarkup:
+    buttons = [[('⤴️ Назад', 'back')]]
+    return get_keyboard(row_width=1, buttons=buttons)
+
+
+@lru_cache(maxsize=1)
 def get_auth_keyboard() -> types.InlineKeyboardMarkup:
     buttons = [[('Авторизоваться', 'auth')]]
     return get_keyboard(row_width=1, buttons=buttons)
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from bisect import bisect_left
+from typing import Callable
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value) if isinstance(value, bool) else value)
+
+
+class Histogram:
+    __slots__ = ('labels', 'counts', 'sum', 'count', '_last')
+
+    def __init__(self, labels: str):
+        self.labels = labels
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._last = self.counts[:]
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str) -> list[str]:
+        lines = []
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{self.labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{self.labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{self.labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{self.labels}}} {self.count}')
+        return lines
+
+    def take(self) -> dict[str, float] | None:
+        """
+        Returns the count and approximate quantiles of the events observed since the previous call.
+        """
+        counts = [count - last for count, last in zip(self.counts, self._last)]
+        self._last = self.counts[:]
+        total = sum(counts)
+        if not total:
+            return None
+        return {'count': total, 'p50': self.quantile(counts, 0.5), 'p95': self.quantile(counts, 0.95),
+                'p99': self.quantile(counts, 0.99)}
+
+    @staticmethod
+    def quantile(counts: list[int], q: float) -> float:
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[index - 1] if index else 0.0
+                return round(lower + (BUCKETS[index] - lower) * (rank - seen) / count, 4)
+            seen += count
+        return 0.0
+
+
+class Counter:
+    __slots__ = ('labels', 'value', '_last')
+
+    def __init__(self, labels: str):
+        self.labels = labels
+        self.value = 0
+        self._last = 0
+
+    def inc(self):
+        self.value += 1
+
+    def render(self, name: str) -> list[str]:
+        return [f'{name}{{{self.labels}}} {self.value}']
+
+    def take(self) -> dict[str, int] | None:
+        count, self._last = self.value - self._last, self.value
+        return {'count': count} if count else None
+
+
+class Family:
+    """
+    One metric split by a single label. Children are created on the first lookup of a label value, after that
+    recording is a dict lookup and in-place updates of preallocated slots.
+    """
+
+    def __init__(self, name: str, help: str, kind: type[Histogram] | type[Counter], label: str):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label = label
+        self.children: dict[str, Histogram | Counter] = {}
+
+    def get(self, value: str) -> Histogram | Counter:
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = self.kind(labels=f'{self.label}="{escape(value)}"')
+        return child
+
+    def render(self) -> list[str]:
+        kind = 'histogram' if self.kind is Histogram else 'counter'
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {kind}']
+        for child in self.children.values():
+            lines.extend(child.render(name=self.name))
+        return lines
+
+
+class Collected:
+    """
+    A metric kept as plain counters by the component it describes. collect() is called on every render and returns
+    the value of every label combination, so recording it costs nothing.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, labels: tuple[str, ...],
+                 collect: Callable[[], dict[tuple[str, ...], float]]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, value in self.collect().items():
+            labels = ','.join(f'{label}="{escape(str(item))}"' for label, item in zip(self.labels, values))
+            lines.append(f'{self.name}{{{labels}}} {format_value(value)}' if labels else
+                         f'{self.name} {format_value(value)}')
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.families: list[Family] = []
+        self.collected: list[Collected] = []
+        self._runner: web.AppRunner | None = None
+        self._task: asyncio.Task | None = None
+
+    def histogram(self, name: str, help: str, label: str) -> Family:
+        self.families.append(Family(name=name, help=help, kind=Histogram, label=label))
+        return self.families[-1]
+
+    def counter(self, name: str, help: str, label: str) -> Family:
+        self.families.append(Family(name=name, help=help, kind=Counter, label=label))
+        return self.families[-1]
+
+    def collect(self, name: str, help: str, kind: str, labels: tuple[str, ...],
+                collect: Callable[[], dict[tuple[str, ...], float]]):
+        self.collected.append(Collected(name=name, help=help, kind=kind, labels=labels, collect=collect))
+
+    def render(self) -> str:
+        lines = [line for family in self.families for line in family.render()]
+        for collected in self.collected:
+            try:
+                lines.extend(collected.render())
+            except Exception:
+                logger.exception('Collecting %s failed', collected.name)
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict[str, dict[str, dict]]:
+        summary = {}
+        for family in self.families:
+            children = {value: taken for value, child in family.children.items() if (taken := child.take())}
+            if children:
+                summary[family.name] = children
+        return summary
+
+    async def _handle(self, _: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self, host: str, port: int, log_interval: float):
+        if port:
+            app = web.Application()
+            app.router.add_get('/metrics', self._handle)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host=host, port=port).start()
+        if log_interval:
+            self._task = asyncio.create_task(self._run(interval=log_interval))
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            summary = self.summary()
+            if summary:
+                logger.info('Metrics %s', json.dumps(summary, ensure_ascii=False, separators=(',', ':')))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = Metrics()
+handler_latency = metrics.histogram('bot_handler_seconds', 'Update handling time by handler', 'handler')
+api_latency = metrics.histogram('bulb_api_seconds', 'Bulb API call time including retries', 'method')
+api_errors = metrics.counter('bulb_api_errors_total', 'Failed bulb API calls', 'method')
+edit_latency = metrics.histogram('telegram_edit_seconds', 'Telegram message edit time', 'kind')
+wait_latency = metrics.histogram('wait_seconds', 'Time spent waiting in queues and for locks', 'queue')
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Times every update from before the filters run until the handler returns. Callback queries are labelled with
+    the callback data prefix, the label of each distinct callback data is resolved once and cached.
+    """
+
+    labels_limit = 1024
+    prefixes_limit = 64
+
+    def __init__(self):
+        super().__init__()
+        self._labels: dict[str, Histogram] = {}
+        self._command = handler_latency.get('command')
+        self._message = handler_latency.get('message')
+
+    async def on_pre_process_message(self, _: types.Message, data: dict):
+        data['started'] = time.perf_counter()
+
+    async def on_post_process_message(self, message: types.Message, _: list, data: dict):
+        histogram = self._command if message.text and message.text[0] == '/' else self._message
+        histogram.observe(time.perf_counter() - data['started'])
+
+    async def on_pre_process_callback_query(self, _: types.CallbackQuery, data: dict):
+        data['started'] = time.perf_counter()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, _: list, data: dict):
+        histogram = self._labels.get(callback_query.data)
+        if histogram is None:
+            histogram = self._resolve(data=callback_query.data or '')
+        histogram.observe(time.perf_counter() - data['started'])
+
+    def _resolve(self, data: str) -> Histogram:
+        prefix = data.partition(':')[0]
+        if prefix not in handler_latency.children and len(handler_latency.children) >= self.prefixes_limit:
+            prefix = 'other'
+        histogram = handler_latency.get(prefix)
+        if len(self._labels) < self.labels_limit:
+            self._labels[data] = histogram
+        return histogram
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+from typing import (Any,
+                    Awaitable,
+                    Callable)
+
+from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+
+from cluster import cluster
+from resilience import (CircuitOpenSberSmartBulbAPIError,
+                        ResilientBulbAPI)
+from tokens import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineQueue:
+    """
+    Commands for unreachable devices, collapsed to the final desired state of every device.
+
+    A device has two slots: power holds the last on/off, light holds the last scene, white or colour command, which
+    replace each other. A flush sends at most two calls per device, the light first so that a final "off" wins.
+    """
+
+    slots = {'on_off': 'power', 'scene': 'light', 'white': 'light', 'color': 'light'}
+    order = ('light', 'power')
+    errors = (CircuitOpenSberSmartBulbAPIError, *ResilientBulbAPI.transient_errors)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.queued = 0
+        self.collapsed = 0
+        self.flushed = 0
+        self.pending: dict[str, dict[str, tuple[str, dict[str, Any]]]] = self._read()
+
+    def _read(self) -> dict[str, dict[str, tuple[str, dict[str, Any]]]]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return {device_id: {slot: tuple(command) for slot, command in slots.items()}
+                    for device_id, slots in json.load(f).items()}
+
+    async def reload(self):
+        """
+        Rereads the queue other replicas may have changed, a single replica is the only writer of its file.
+        """
+        if cluster.path is not None:
+            self.pending = await asyncio.to_thread(self._read)
+
+    def __len__(self) -> int:
+        return sum(map(len, self.pending.values()))
+
+    @classmethod
+    def accepts(cls, command: str) -> bool:
+        return command in cls.slots
+
+    async def save(self):
+        if self.pending:
+            data = json.dumps(self.pending, ensure_ascii=False, indent=1)
+            await asyncio.to_thread(write_atomic, self.path, data)
+        elif os.path.exists(self.path):
+            await asyncio.to_thread(os.remove, self.path)
+
+    async def put(self, device_ids: list[str], command: str, **values: Any):
+        async with cluster.lock(name=f'offline:{self.path}'):
+            await self.reload()
+            for device_id in device_ids:
+                slots = self.pending.setdefault(device_id, {})
+                self.queued += 1
+                self.collapsed += self.slots[command] in slots
+                slots[self.slots[command]] = (command, values)
+            await self.save()
+
+    async def flush(self, send: Callable[[str, str, dict[str, Any]], Awaitable[None]]) \
+            -> tuple[list[tuple[str, str, dict[str, Any]]], dict[str, Exception]]:
+        """
+        Sends the queued state of every device concurrently. Devices that are still unreachable keep their commands
+        unless newer ones were queued meanwhile, other errors drop the device's commands and are returned.
+        """
+        async with cluster.lock(name=f'offline:{self.path}'):
+            await self.reload()
+            pending, self.pending = self.pending, {}
+            if cluster.path is not None and pending:
+                # Other replicas must not flush the same commands while these are being sent
+                await self.save()
+        results = await asyncio.gather(*(self._flush_one(device_id=device_id, slots=slots, send=send)
+                                         for device_id, slots in pending.items()))
+        sent, errors = [], {}
+        async with cluster.lock(name=f'offline:{self.path}'):
+            await self.reload()
+            for device_id, (done, error) in zip(pending, results):
+                sent.extend((device_id, command, values) for command, values in done)
+                if isinstance(error, self.errors):
+                    rest = {slot: value for slot, value in pending[device_id].items() if value not in done}
+                    self.pending[device_id] = rest | self.pending.get(device_id, {})
+                elif error is not None:
+                    errors[device_id] = error
+            self.flushed += len(sent)
+            await self.save()
+        return sent, errors
+
+    async def _flush_one(self, device_id: str, slots: dict[str, tuple[str, dict[str, Any]]],
+                         send: Callable[[str, str, dict[str, Any]], Awaitable[None]]) \
+            -> tuple[list[tuple[str, dict[str, Any]]], SberSmartBulbAPIError | None]:
+        done = []
+        for slot in self.order:
+            if slot in slots:
+                command, values = slots[slot]
+                try:
+                    await send(device_id, command, values)
+                except SberSmartBulbAPIError as e:
+                    logger.warning('Queued %s for %s failed: %s', command, device_id, e)
+                    return done, e
+                done.append((command, values))
+        return done, None
@@ -0,0 +1,57 @@
+import asyncio
+from typing import (Any,
+                    Awaitable,
+                    Callable,
+                    Hashable)
+
+from metrics import wait_latency
+
+
+class CommandPipeline:
+    def __init__(self, send: Callable[..., Awaitable[None]], debounce: float):
+        self.send = send
+        self.debounce = debounce
+        self.submitted = 0
+        self.sent = 0
+        self._pending: dict[Hashable, tuple[str, dict[str, Any]]] = {}
+        self._waiters: dict[Hashable, list[asyncio.Future]] = {}
+        self._workers: dict[Hashable, asyncio.Task] = {}
+        self._queued: dict[Hashable, float] = {}
+        self._wait = wait_latency.get('pipeline')
+
+    def submit(self, key: Hashable, command: str, **values: Any) -> asyncio.Future:
+        self.submitted += 1
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        if key not in self._pending:
+            self._queued[key] = loop.time()
+        self._pending[key] = (command, values)
+        self._waiters.setdefault(key, []).append(waiter)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key=key))
+        return waiter
+
+    async def _work(self, key: Hashable):
+        try:
+            while key in self._pending:
+                await asyncio.sleep(self.debounce)
+                command, values = self._pending.pop(key)
+                waiters = self._waiters.pop(key)
+                self._wait.observe(asyncio.get_running_loop().time() - self._queued.pop(key))
+                try:
+                    await self.send(key, command, **values)
+                    self.sent += 1
+                except Exception as e:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                else:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_result(None)
+        finally:
+            del self._workers[key]
+
+    async def close(self):
+        if self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
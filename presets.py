@@ -0,0 +1,171 @@
+import asyncio
+import html
+import json
+import os
+from typing import Any
+
+from sber_smart_bulb_api.models import DeviceSceneEnum
+
+from cluster import cluster
+from states import States
+from tokens import write_atomic
+
+SCENES = tuple(scene.value for scene in DeviceSceneEnum)
+ALIASES = {
+    'brightness': 'bright_value_v2',
+    'b': 'bright_value_v2',
+    'temp': 'temp_value_v2',
+    't': 'temp_value_v2',
+    'h': 'h',
+    's': 's',
+    'v': 'v'
+}
+NAMES = {'bright_value_v2': 'brightness', 'temp_value_v2': 'temp'}
+MODES = {
+    'white': ('white', 'white', ('bright_value_v2', 'temp_value_v2')),
+    'colour': ('color', 'colour', ('h', 's', 'v')),
+    'color': ('color', 'colour', ('h', 's', 'v'))
+}
+SET_USAGE = 'Формат: /set h=<тон> s=<насыщенность> v=<яркость> или /set brightness=<яркость> temp=<температура>'
+
+
+def validate(fields: dict[str, int]) -> dict[str, int]:
+    for key, value in fields.items():
+        if not States.minimals[key] <= value <= States.maximals[key]:
+            raise ValueError(f'{NAMES.get(key, key)} должно быть от {States.minimals[key]} до {States.maximals[key]}')
+    return fields
+
+
+def parse_command(words: list[str]) -> tuple[str, dict[str, Any]]:
+    """
+    Parses "white <brightness> <temp>", "colour <h> <s> <v>" or "scene <scene>" into the pipeline command and the
+    States fields it sets.
+    """
+    if len(words) == 2 and words[0] == 'scene':
+        if words[1] not in SCENES:
+            raise ValueError(f'Сцены: {", ".join(SCENES)}')
+        return 'scene', {'work_mode': 'scene', 'light_scene': words[1]}
+    if not words or words[0] not in MODES:
+        raise ValueError('Команды: white <яркость> <температура>, colour <h> <s> <v>, scene <сцена>')
+    command, work_mode, keys = MODES[words[0]]
+    if len(words) != len(keys) + 1 or not all(word.isdigit() for word in words[1:]):
+        raise ValueError(f'Формат: {words[0]} ' + ' '.join(f'<{key}>' for key in keys))
+    return command, {'work_mode': work_mode, **validate(dict(zip(keys, map(int, words[1:]))))}
+
+
+def parse_set(text: str) -> tuple[str, dict[str, Any]]:
+    """
+    Parses "h=210 s=80 v=40" or "brightness=70 temp=30", fields left out keep their current values.
+    """
+    fields = {}
+    for word in text.split():
+        key, _, value = word.partition('=')
+        if key not in ALIASES or not value.isdigit():
+            raise ValueError(SET_USAGE)
+        fields[ALIASES[key]] = int(value)
+    if not fields:
+        raise ValueError(SET_USAGE)
+    for command, work_mode, keys in (MODES['white'], MODES['colour']):
+        if fields.keys() <= set(keys):
+            return command, {'work_mode': work_mode, **validate(fields)}
+    raise ValueError('Яркость и температуру нельзя задавать вместе с тоном, насыщенностью и яркостью цвета')
+
+
+class Preset:
+    """
+    A named light setting, stored as the pipeline command and the States fields it sets so that applying one is a
+    single States.edit() or scene call.
+    """
+
+    __slots__ = ('name', 'command', 'fields')
+
+    def __init__(self, name: str, command: str, fields: dict[str, Any]):
+        self.name = name
+        self.command = command
+        self.fields = fields
+
+    @classmethod
+    def from_states(cls, name: str, states: States) -> 'Preset':
+        if states.work_mode == 'scene':
+            return cls(name=name, command='scene', fields={'work_mode': 'scene', 'light_scene': states.light_scene})
+        if states.work_mode not in MODES:
+            raise ValueError(f'Режим {states.work_mode} нельзя сохранить')
+        command, work_mode, keys = MODES[states.work_mode]
+        return cls(name=name, command=command, fields={'work_mode': work_mode, **{key: states[key] for key in keys}})
+
+    def describe(self) -> str:
+        values = ' '.join(str(value) for key, value in self.fields.items() if key != 'work_mode')
+        return f'{html.escape(self.name)}: {self.fields["work_mode"]} {values}'
+
+
+class PresetStore:
+    """
+    Presets of every user, in the order they were saved.
+    """
+
+    def __init__(self):
+        self.path: str | None = None
+        self.limit = 0
+        self.presets: dict[int, list[Preset]] = {}
+        self._names: dict[int, tuple[str, ...]] = {}
+        self._mtime = 0.0
+
+    def configure(self, path: str, limit: int):
+        self.path = path
+        self.limit = limit
+
+    def load(self):
+        if os.path.exists(self.path):
+            self._mtime = os.path.getmtime(self.path)
+            with open(self.path) as f:
+                records = json.load(f)
+            self.presets = {int(user_id): [Preset(**item) for item in items] for user_id, items in records.items()}
+        self._names.clear()
+
+    async def save(self):
+        data = json.dumps({user_id: [{'name': preset.name, 'command': preset.command, 'fields': preset.fields}
+                                     for preset in items] for user_id, items in self.presets.items()},
+                          ensure_ascii=False, indent=1)
+        await asyncio.to_thread(write_atomic, self.path, data)
+        self._mtime = os.path.getmtime(self.path)
+
+    def refresh(self):
+        """
+        Reloads the presets if another replica changed them.
+        """
+        if os.path.exists(self.path) and os.path.getmtime(self.path) != self._mtime:
+            self.load()
+
+    def names(self, user_id: int) -> tuple[str, ...]:
+        names = self._names.get(user_id)
+        if names is None:
+            names = self._names[user_id] = tuple(preset.name for preset in self.presets.get(user_id, []))
+        return names
+
+    def get(self, user_id: int, index: int) -> Preset | None:
+        items = self.presets.get(user_id, [])
+        return items[index] if 0 <= index < len(items) else None
+
+    async def add(self, user_id: int, preset: Preset):
+        async with cluster.lock(name='presets'):
+            self.refresh()
+            items = [item for item in self.presets.get(user_id, []) if item.name != preset.name]
+            if len(items) >= self.limit:
+                raise ValueError(f'Можно сохранить не больше {self.limit} пресетов')
+            self.presets[user_id] = items + [preset]
+            self._names.pop(user_id, None)
+            await self.save()
+
+    async def remove(self, user_id: int, name: str) -> bool:
+        async with cluster.lock(name='presets'):
+            self.refresh()
+            items = self.presets.get(user_id, [])
+            if name not in self.names(user_id=user_id):
+                return False
+            self.presets[user_id] = [item for item in items if item.name != name]
+            self._names.pop(user_id, None)
+            await self.save()
+            return True
+
+
+presets = PresetStore()
@@ -0,0 +1,28 @@
+from collections import OrderedDict
+
+from aiogram import types
+
+
+class RenderedMessages:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.skipped = 0
+        self._messages: OrderedDict[tuple[int, int], tuple[str | None, types.InlineKeyboardMarkup | None]] = \
+            OrderedDict()
+
+    def is_rendered(self, message: types.Message, text: str | None,
+                    keyboard: types.InlineKeyboardMarkup | None) -> bool:
+        previous = self._messages.get((message.chat.id, message.message_id))
+        if previous is not None and previous[1] is keyboard and (text is None or previous[0] == text):
+            self.skipped += 1
+            return True
+        return False
+
+    def remember(self, message: types.Message, text: str | None, keyboard: types.InlineKeyboardMarkup | None):
+        key = (message.chat.id, message.message_id)
+        if text is None and key in self._messages:
+            text = self._messages[key][0]
+        self._messages[key] = (text, keyboard)
+        self._messages.move_to_end(key)
+        if len(self._messages) > self.maxsize:
+            self._messages.popitem(last=False)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import random
+from functools import partial
+from typing import (Any,
+                    Awaitable,
+                    Callable)
+
+from sber_smart_bulb_api import SberSmartBulbAPI
+from sber_smart_bulb_api.exceptions import (ClientConnectorSberSmartBulbAPIError,
+                                            SberSmartBulbAPIError,
+                                            TimeoutSberSmartBulbAPIError)
+from sber_smart_bulb_api.models import (DeviceSceneEnum,
+                                        DeviceStates)
+
+from journal import journal
+from metrics import (api_errors,
+                     api_latency)
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenSberSmartBulbAPIError(SberSmartBulbAPIError):
+    """"""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, threshold: int, reset_timeout: float):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and asyncio.get_running_loop().time() - self._opened_at >= self.reset_timeout:
+            self._set_state('half_open')
+        if self.state == 'half_open' and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self._probing = False
+        self.failures = 0
+        if self.state != 'closed':
+            self._set_state('closed')
+
+    def record_failure(self, trip: bool = False):
+        self._probing = False
+        self.failures += 1
+        if self.state == 'half_open' or trip or self.failures >= self.threshold:
+            self._opened_at = asyncio.get_running_loop().time()
+            if self.state != 'open':
+                self.trips += 1
+                self._set_state('open')
+
+    def release(self):
+        self._probing = False
+
+    def _set_state(self, state: str):
+        logger.warning('Circuit %s: %s -> %s', self.name, self.state, state)
+        self.state = state
+
+
+class ResilientBulbAPI:
+    transient_errors = (TimeoutSberSmartBulbAPIError, ClientConnectorSberSmartBulbAPIError)
+
+    def __init__(self, bulb_api: SberSmartBulbAPI, read_budget: float, write_budget: float, attempt_timeout: float,
+                 retries: int, backoff: float, breaker_threshold: int, breaker_reset: float):
+        self.bulb_api = bulb_api
+        self.read_budget = read_budget
+        self.write_budget = write_budget
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.retried = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._last: dict[str, DeviceStates] = {}
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {'retried': self.retried, 'timeouts': self.timeouts, 'rejected': self.rejected}
+
+    @property
+    def breakers(self) -> dict[str, CircuitBreaker]:
+        return self._breakers
+
+    def get_breaker(self, device_id: str) -> CircuitBreaker:
+        breaker = self._breakers.get(device_id)
+        if breaker is None:
+            breaker = CircuitBreaker(name=device_id, threshold=self.breaker_threshold,
+                                     reset_timeout=self.breaker_reset)
+            self._breakers[device_id] = breaker
+        return breaker
+
+    async def _call(self, device_id: str, call: Callable[[], Awaitable[Any]], budget: float, idempotent: bool) -> Any:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + budget
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            try:
+                return await asyncio.wait_for(call(), timeout=min(self.attempt_timeout, remaining))
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                error = TimeoutSberSmartBulbAPIError('Timeout error')
+            except self.transient_errors as e:
+                error = e
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            attempt += 1
+            if not idempotent or attempt > self.retries or loop.time() + delay >= deadline:
+                raise error
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    async def _guard(self, method: str, device_id: str, budget: float, idempotent: bool, **values: Any) -> Any:
+        breaker = self.get_breaker(device_id=device_id)
+        if not breaker.allow():
+            self.rejected += 1
+            journal.record('call', method=method, device_id=device_id, values=values, ms=0.0, error='circuit open')
+            raise CircuitOpenSberSmartBulbAPIError('Лампа недоступна, повтори позже')
+        call = partial(getattr(self.bulb_api, method), device_id=device_id, **values)
+        started = asyncio.get_running_loop().time()
+        error = None
+        try:
+            result = await self._call(device_id=device_id, call=call, budget=budget, idempotent=idempotent)
+        except SberSmartBulbAPIError as e:
+            error = repr(e)
+            api_errors.get(method).inc()
+            breaker.record_failure()
+            raise
+        except BaseException:
+            error = 'cancelled'
+            breaker.release()
+            raise
+        finally:
+            elapsed = asyncio.get_running_loop().time() - started
+            api_latency.get(method).observe(elapsed)
+            journal.record('call', method=method, device_id=device_id, values=values, ms=round(elapsed * 1000, 3),
+                           error=error)
+        if isinstance(result, DeviceStates) and not result.online:
+            breaker.record_failure(trip=True)
+        else:
+            breaker.record_success()
+        return result
+
+    async def get_device_states(self, device_id: str) -> DeviceStates:
+        try:
+            states = await self._guard(method='get_device_states', device_id=device_id, budget=self.read_budget,
+                                       idempotent=True)
+        except CircuitOpenSberSmartBulbAPIError:
+            last = self._last.get(device_id)
+            if last is None:
+                raise
+            return last.model_copy(update={'online': False})
+        self._last[device_id] = states
+        return states
+
+    async def set_on_off(self, device_id: str, value: bool):
+        await self._guard(method='set_on_off', device_id=device_id, budget=self.write_budget, idempotent=True,
+                          value=value)
+
+    async def set_scene(self, device_id: str, scene: DeviceSceneEnum | str):
+        await self._guard(method='set_scene', device_id=device_id, budget=self.write_budget, idempotent=True,
+                          scene=scene)
+
+    async def set_white(self, device_id: str, brightness: int, temp: int):
+        await self._guard(method='set_white', device_id=device_id, budget=self.write_budget, idempotent=True,
+                          brightness=brightness, temp=temp)
+
+    async def set_color(self, device_id: str, h: int, s: int, v: int):
+        await self._guard(method='set_color', device_id=device_id, budget=self.write_budget, idempotent=True,
+                          h=h, s=s, v=v)
+
+    async def set_timer(self, device_id: str, minutes: int):
+        await self._guard(method='set_timer', device_id=device_id, budget=self.write_budget, idempotent=False,
+                          minutes=minutes)
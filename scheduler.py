@@ -0,0 +1,308 @@
+import asyncio
+import heapq
+import html
+import json
+import logging
+import os
+import re
+import time
+from datetime import (date,
+                      datetime,
+                      timedelta,
+                      tzinfo)
+from typing import (Any,
+                    Awaitable,
+                    Callable,
+                    TypeVar)
+
+from pydantic import (BaseModel,
+                      ValidationError)
+from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+from sber_smart_bulb_api.models import (ColorValidation,
+                                        DeviceSceneEnum,
+                                        SceneValidation,
+                                        WhiteValidation)
+
+from cluster import cluster
+from metrics import wait_latency
+from synchronizer import wait_event
+from tokens import write_atomic
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class Schedule:
+    ramps = {'white': ('brightness', 5), 'color': ('v', 1)}
+    validations: dict[str, type[BaseModel]] = {'white': WhiteValidation, 'color': ColorValidation,
+                                               'scene': SceneValidation}
+
+    def __init__(self, id: int, user_id: int, target: str, weekdays: list[int], at: str, command: str,
+                 values: dict[str, Any], ramp: int = 0, last_fire: float = 0.0, created: float | None = None):
+        self.id = id
+        self.user_id = user_id
+        self.target = target
+        self.weekdays = weekdays
+        self.at = at
+        self.command = command
+        self.values = values
+        self.ramp = ramp
+        self.last_fire = last_fire
+        self.created = time.time() if created is None else created
+
+    @classmethod
+    def parse(cls, id: int, user_id: int, target: str, text: str) -> 'Schedule':
+        """
+        Parses "<days> <HH:MM> <command> [arguments] [ramp=<minutes>]", for example
+        "1-5 07:00 white 100 50 ramp=30" or "daily 23:30 off".
+        """
+        words = text.split()
+        ramp = 0
+        if words and re.fullmatch(r'ramp=\d+', words[-1]):
+            ramp = int(words.pop()[5:])
+        if len(words) < 3 or not re.fullmatch(r'daily|\d(-\d)?(,\d(-\d)?)*', words[0]) \
+                or not re.fullmatch(r'\d{1,2}:\d{2}', words[1]):
+            raise ValueError('Формат: <дни> <ЧЧ:ММ> <команда> [аргументы] [ramp=<минуты>]')
+        days, at, command, arguments = words[0], words[1], words[2], words[3:]
+        numeric = all(argument.isdigit() for argument in arguments)
+        weekdays = []
+        for part in ('1-7' if days == 'daily' else days).split(','):
+            first, _, last = part.partition('-')
+            weekdays.extend(range(int(first), int(last or first) + 1))
+        if not weekdays or not set(weekdays) <= set(range(1, 8)):
+            raise ValueError('Дни недели задаются числами от 1 до 7')
+        hour, minute = (int(value) for value in at.split(':'))
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError('Неверное время')
+        if command in ('on', 'off') and not arguments:
+            command, values = 'on_off', {'value': command == 'on'}
+        elif command == 'scene' and len(arguments) == 1:
+            values = {'scene': arguments[0]}
+        elif command == 'white' and len(arguments) == 2 and numeric:
+            values = dict(zip(('brightness', 'temp'), map(int, arguments)))
+        elif command in ('colour', 'color') and len(arguments) == 3 and numeric:
+            command, values = 'color', dict(zip(('h', 's', 'v'), map(int, arguments)))
+        else:
+            raise ValueError('Команды: on, off, scene <сцена>, white <яркость> <температура>, colour <h> <s> <v>')
+        if ramp and command not in cls.ramps:
+            raise ValueError('Плавное изменение доступно только для white и colour')
+        cls.validate(command=command, values=values)
+        return cls(id=id, user_id=user_id, target=target, weekdays=sorted(set(weekdays)),
+                   at=f'{hour:02}:{minute:02}', command=command, values=values, ramp=ramp)
+
+    @classmethod
+    def validate(cls, command: str, values: dict[str, Any]):
+        """
+        Checks the values against the models the client validates them with before sending, a schedule it would
+        reject must not be saved only to fail on every fire.
+        """
+        if command not in cls.validations:
+            return
+        try:
+            cls.validations[command](**values)
+        except ValidationError as e:
+            if command == 'scene':
+                raise ValueError(f'Сцены: {", ".join(scene.value for scene in DeviceSceneEnum)}') from None
+            bounds = {'brightness': '5-100', 'temp': '0-100', 'h': '0-360', 's': '0-100', 'v': '0-100'}
+            keys = [str(error['loc'][0]) for error in e.errors()]
+            raise ValueError('Допустимые значения: ' + ', '.join(f'{key} {bounds[key]}' for key in keys)) from None
+
+    def get_fire(self, day: date, tz: tzinfo) -> float:
+        hour, minute = (int(value) for value in self.at.split(':'))
+        return datetime(day.year, day.month, day.day, hour, minute, tzinfo=tz).timestamp()
+
+    def next_fire(self, after: float, tz: tzinfo) -> float:
+        today = datetime.fromtimestamp(after, tz).date()
+        for offset in range(8):
+            day = today + timedelta(days=offset)
+            if day.isoweekday() in self.weekdays and self.get_fire(day=day, tz=tz) > after:
+                return self.get_fire(day=day, tz=tz)
+
+    def previous_fire(self, before: float, tz: tzinfo) -> float:
+        today = datetime.fromtimestamp(before, tz).date()
+        for offset in range(8):
+            day = today - timedelta(days=offset)
+            if day.isoweekday() in self.weekdays and self.get_fire(day=day, tz=tz) <= before:
+                return self.get_fire(day=day, tz=tz)
+
+    def describe(self) -> str:
+        days = 'ежедневно' if len(self.weekdays) == 7 else ','.join(map(str, self.weekdays))
+        values = ' '.join(f'{key}={value}' for key, value in self.values.items())
+        ramp = f' за {self.ramp} мин' if self.ramp else ''
+        return f'#{self.id} {html.escape(self.target)}: {days} {self.at} {self.command} {values}{ramp}'
+
+
+class Scheduler:
+    def __init__(self, send: Callable[..., Awaitable[None]], tz: tzinfo, path: str, catch_up: float,
+                 rate: float, owner: int):
+        self.send = send
+        self.owner = owner
+        self.tz = tz
+        self.path = path
+        self.catch_up = catch_up
+        self.interval = 1 / rate
+        self.fired = 0
+        self.caught_up = 0
+        self.steps = 0
+        self.latency = 0.0
+        self.schedules: dict[int, Schedule] = {}
+        self._mtime = 0.0
+        self._next_id = 1
+        self._heap: list[tuple[float, int]] = []
+        self._slot = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._fires: set[asyncio.Task] = set()
+        self._wait = wait_latency.get('schedule')
+
+    def load(self):
+        if os.path.exists(self.path):
+            self._mtime = os.path.getmtime(self.path)
+            with open(self.path) as f:
+                items = json.load(f)
+            previous, self.schedules = self.schedules, {item['id']: Schedule(**({'user_id': self.owner} | item))
+                                                        for item in items}
+            for id, schedule in self.schedules.items():
+                if id in previous:
+                    schedule.last_fire = max(schedule.last_fire, previous[id].last_fire)
+        self._next_id = max(self.schedules, default=0) + 1
+
+    def refresh(self):
+        """
+        Reloads the schedules if another replica changed them and requeues them when running.
+        """
+        if not os.path.exists(self.path) or os.path.getmtime(self.path) == self._mtime:
+            return
+        self.load()
+        if self._task is not None:
+            self._heap.clear()
+            now = time.time()
+            for schedule in self.schedules.values():
+                self._push(schedule=schedule, after=now)
+
+    async def save(self):
+        data = json.dumps([vars(schedule) for schedule in self.schedules.values()], ensure_ascii=False, indent=1)
+        await asyncio.to_thread(write_atomic, self.path, data)
+        self._mtime = os.path.getmtime(self.path)
+
+    async def _update(self, change: Callable[[], T]) -> T:
+        # Changes are applied on top of what other replicas saved, one replica at a time
+        async with cluster.lock(name='schedules'):
+            self.refresh()
+            result = change()
+            await self.save()
+            return result
+
+    async def add(self, user_id: int, target: str, text: str) -> Schedule:
+        return await self._update(lambda: self._add(user_id=user_id, target=target, text=text))
+
+    def _add(self, user_id: int, target: str, text: str) -> Schedule:
+        schedule = Schedule.parse(id=self._next_id, user_id=user_id, target=target, text=text)
+        self._next_id += 1
+        self.schedules[schedule.id] = schedule
+        if self._task is not None:
+            self._push(schedule=schedule, after=time.time())
+        return schedule
+
+    async def remove(self, user_id: int, id: int) -> bool:
+        return await self._update(lambda: self._remove(user_id=user_id, id=id))
+
+    def _remove(self, user_id: int, id: int) -> bool:
+        if id not in self.schedules or self.schedules[id].user_id != user_id:
+            return False
+        del self.schedules[id]
+        return True
+
+    def _push(self, schedule: Schedule, after: float):
+        heapq.heappush(self._heap, (schedule.next_fire(after=after, tz=self.tz), schedule.id))
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._heap.clear()
+        now = time.time()
+        for schedule in self.schedules.values():
+            missed = schedule.previous_fire(before=now, tz=self.tz)
+            if max(schedule.last_fire, schedule.created) < missed and now - missed <= self.catch_up:
+                self.caught_up += 1
+                self._fire(schedule=schedule, when=missed)
+            self._push(schedule=schedule, after=now)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                await wait_event(self._wakeup, timeout=timeout)
+                continue
+            when, id = heapq.heappop(self._heap)
+            schedule = self.schedules.get(id)
+            if schedule is None:
+                continue
+            # A fire another leader already made, maybe with a clock ahead of this one, is skipped but not the next
+            if schedule.last_fire < when and time.time() - when <= self.catch_up:
+                self._fire(schedule=schedule, when=when)
+            self._push(schedule=schedule, after=max(when, time.time()))
+
+    def _fire(self, schedule: Schedule, when: float):
+        schedule.last_fire = when
+        task = asyncio.create_task(self._execute(schedule=schedule, when=when))
+        self._fires.add(task)
+        task.add_done_callback(self._fires.discard)
+
+    async def _execute(self, schedule: Schedule, when: float):
+        self.fired += 1
+        logger.info('Firing schedule %s', schedule.describe())
+        try:
+            await self._update(lambda: None)
+            if schedule.ramp:
+                await self._transition(schedule=schedule, end=when + schedule.ramp * 60)
+            else:
+                await self._send(schedule, schedule.command, **schedule.values)
+        except (SberSmartBulbAPIError, OSError, ValidationError) as e:
+            logger.warning('Schedule %s failed: %s', schedule.id, e)
+
+    async def _send(self, schedule: Schedule, command: str, **values: Any):
+        loop = asyncio.get_running_loop()
+        start = max(loop.time(), self._slot)
+        self._slot = start + self.interval
+        self._wait.observe(start - loop.time())
+        await asyncio.sleep(start - loop.time())
+        started = loop.time()
+        try:
+            await self.send(schedule.user_id, schedule.target, command, **values)
+        finally:
+            self.latency = 0.8 * self.latency + 0.2 * (loop.time() - started)
+
+    async def _transition(self, schedule: Schedule, end: float):
+        key, first = Schedule.ramps[schedule.command]
+        last = schedule.values[key]
+        start = end - schedule.ramp * 60
+        await self._send(schedule, 'on_off', value=True)
+        sent = None
+        while True:
+            now = time.time()
+            progress = min(max((now - start) / (end - start), 0.0), 1.0)
+            value = round(first + (last - first) * progress)
+            if value != sent:
+                try:
+                    await self._send(schedule, schedule.command, **(schedule.values | {key: value}))
+                    self.steps += 1
+                    sent = value
+                except (SberSmartBulbAPIError, ValidationError) as e:
+                    logger.warning('Schedule %s transition step failed: %s', schedule.id, e)
+            if progress >= 1.0:
+                return
+            await asyncio.sleep(min(max(self.interval, self.latency * 2), max(end - time.time(), 0.0)))
+
+    async def stop(self):
+        tasks = list(self._fires)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
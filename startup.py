@@ -0,0 +1,28 @@
+import time
+from typing import (Awaitable,
+                    TypeVar)
+
+T = TypeVar('T')
+
+
+class StartupTimer:
+    def __init__(self):
+        self.imports = time.process_time()
+        self.started = time.perf_counter()
+        self.phases: dict[str, tuple[float, float]] = {}
+
+    def mark(self, name: str):
+        now = time.perf_counter() - self.started
+        self.phases[name] = (now, now)
+
+    async def run(self, name: str, awaitable: Awaitable[T]) -> T:
+        start = time.perf_counter() - self.started
+        try:
+            return await awaitable
+        finally:
+            self.phases[name] = (start, time.perf_counter() - self.started)
+
+    def report(self) -> str:
+        phases = ', '.join(f'{name} {start:.3f}-{end:.3f}s' if end > start else f'{name} at {end:.3f}s'
+                           for name, (start, end) in self.phases.items())
+        return f'Startup: imports {self.imports:.3f}s cpu, {phases}'
@@ -2,6 +2,48 @@ from typing import Any
 
 
 class States:
+    __slots__ = ('online', 'on_off', 'work_mode', 'light_scene', 'bright_value_v2', 'temp_value_v2', 'h', 's', 'v',
+                 'sleep_timer', 'time', 'step', 'step_index', 'generation', '_stamps', '_dirty')
+
+    steps = (1, 5, 10, 50, 100)
+    maximals = {
+        'bright_value_v2': 100,
+        'temp_value_v2': 100,
+        'h': 360,
+        's': 100,
+        'v': 100,
+        'sleep_timer': 1440
+    }
+    # The API rejects a white brightness below 5
+    minimals = {
+        'bright_value_v2': 5,
+        'temp_value_v2': 0,
+        'h': 0,
+        's': 0,
+        'v': 0,
+        'sleep_timer': 1
+    }
+    defaults = {
+        'bright_value_v2': 50,
+        'temp_value_v2': 50,
+        'h': 180,
+        's': 50,
+        'v': 50,
+        'sleep_timer': 480
+    }
+    commands = {
+        'white': ('white', {'bright_value_v2': 'brightness', 'temp_value_v2': 'temp'}),
+        'color': ('colour', {'h': 'h', 's': 's', 'v': 'v'})
+    }
+    tracked = frozenset(('work_mode', 'bright_value_v2', 'temp_value_v2', 'h', 's', 'v'))
+    held = {
+        'on_off': ('on_off', 'time'),
+        'scene': ('work_mode', 'light_scene'),
+        'timer': ('time',)
+    }
+    snapshotted = ('online', 'on_off', 'work_mode', 'light_scene', 'bright_value_v2', 'temp_value_v2', 'h', 's', 'v',
+                   'sleep_timer', 'time', 'step')
+
     def __init__(self, online: bool, on_off: bool, work_mode: str, light_scene: str, bright_value_v2: int,
                  temp_value_v2: int, h: int, s: int, v: int, sleep_timer: int, **_):
         self.online: bool = online
@@ -17,7 +59,9 @@ class States:
         self.time: str | None = None
         self.step: int = 1
         self.step_index: int = 0
-        self.steps: list[int] = [1, 5, 10, 50, 100]
+        self.generation: int = 0
+        self._stamps: dict[str, int] = {}
+        self._dirty: dict[str, int] = {}
 
     def __setitem__(self, key: str, value: Any):
         setattr(self, key, value)
@@ -27,51 +71,82 @@ class States:
 
     def __add__(self, key: str):
         if key == 'step':
-            self.step_index = self.step_index + 1 if self.step_index + 1 < 6 else 5
-            self.step = self.steps[self.step_index]
+            self.set_step(self.step_index + 1)
         else:
-            maximals = {
-                'bright_value_v2': 100,
-                'temp_value_v2': 100,
-                'h': 360,
-                's': 100,
-                'v': 100,
-                'sleep_timer': 1440
-            }
-            self[key] = self[key] + self.step
-            if self[key] > maximals[key]:
-                self[key] = maximals[key]
+            self.edit(**{key: min(self[key] + self.step, self.maximals[key])})
 
     def __sub__(self, key: str):
         if key == 'step':
-            self.step_index = self.step_index - 1 if self.step_index - 1 > -1 else 0
-            self.step = self.steps[self.step_index]
+            self.set_step(self.step_index - 1)
         else:
-            minimals = {
-                'bright_value_v2': 1,
-                'temp_value_v2': 0,
-                'h': 0,
-                's': 0,
-                'v': 0,
-                'sleep_timer': 1
-            }
-            self[key] = self[key] - self.step
-            if self[key] < minimals[key]:
-                self[key] = minimals[key]
+            self.edit(**{key: max(self[key] - self.step, self.minimals[key])})
+
+    def set_step(self, step_index: int):
+        self.step_index = min(max(step_index, 0), len(self.steps) - 1)
+        self.step = self.steps[self.step_index]
 
     def update(self, **values):
+        self.generation += 1
         for key, value in values.items():
             self[key] = value
+            self._stamps[key] = self.generation
+
+    def edit(self, **values):
+        """
+        Applies a local change that still has to be written to the lamp.
+        """
+        self.update(**{key: value for key, value in values.items() if self[key] != value})
+        for key in values:
+            if key in self.tracked and self._stamps.get(key) == self.generation:
+                self._dirty[key] = self.generation
+
+    def take(self, command: str) -> dict[str, int] | None:
+        """
+        Returns the arguments of the command if any of its fields changed since the last write.
+        """
+        work_mode, fields = self.commands[command]
+        if self.work_mode != work_mode or not (self._dirty.keys() & {'work_mode', *fields}):
+            return None
+        return {argument: self[field] for field, argument in fields.items()}
+
+    def clean(self, command: str, generation: int):
+        _, fields = self.commands[command]
+        self.release(keys=('work_mode', *fields), generation=generation)
+
+    def hold(self, keys: tuple[str, ...]) -> int:
+        """
+        Keeps reads from overwriting the keys while a write of them is in flight, until release().
+        """
+        for key in keys:
+            self._dirty[key] = self.generation
+        return self.generation
+
+    def release(self, keys: tuple[str, ...], generation: int):
+        """
+        Ends a write started at generation. Reads that started before it ended may still return the old values, the
+        released keys are stamped with a new generation so that sync() skips them.
+        """
+        self.generation += 1
+        for key in keys:
+            if self._dirty.get(key, generation + 1) <= generation:
+                del self._dirty[key]
+                self._stamps[key] = self.generation
+
+    def sync(self, generation: int, **values) -> dict[str, Any]:
+        """
+        Applies states read from the lamp, skipping fields changed locally after the read started.
+        """
+        changed = {key: value for key, value in values.items()
+                   if self[key] != value and key not in self._dirty and self._stamps.get(key, 0) <= generation}
+        for key, value in changed.items():
+            self[key] = value
+        return changed
+
+    def snapshot(self) -> dict[str, Any]:
+        return {key: self[key] for key in self.snapshotted}
 
     def default(self, key: str):
         if key == 'step':
-            self.update(step_index=2, step=10)
+            self.set_step(2)
         else:
-            self[key] = {
-                'bright_value_v2': 50,
-                'temp_value_v2': 50,
-                'h': 180,
-                's': 50,
-                'v': 50,
-                'sleep_timer': 480
-            }[key]
+            self.edit(**{key: self.defaults[key]})
@@ -0,0 +1,213 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import typing
+
+from aiogram.dispatcher.storage import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage kept in memory and written behind to SQLite in WAL mode.
+
+    Every record is loaded when the storage is opened, so reads never touch the disk. Changed records are
+    written in one transaction per flush_interval, and close() flushes whatever is left. A shared storage is written
+    by several replicas: the next update of a user may reach any of them, so changes are written through right away,
+    flush_interval only paces retries of failed writes, and every record is re-read on each access.
+    """
+
+    def __init__(self, path: str, flush_interval: float, shared: bool = False):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.writes = 0
+        self.flushes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._dirty: set[tuple[str, str]] = set()
+        self._flushing: set[tuple[str, str]] = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS fsm (chat TEXT, user TEXT, state TEXT, data TEXT, '
+                                 'bucket TEXT, PRIMARY KEY (chat, user))')
+        self.data: dict[tuple[str, str], dict] = {
+            (chat, user): {'state': state, 'data': json.loads(data), 'bucket': json.loads(bucket)}
+            for chat, user, state, data, bucket in self._connection.execute('SELECT * FROM fsm')
+        }
+
+    def resolve_address(self, chat, user) -> tuple[str, str]:
+        return tuple(map(str, self.check_address(chat=chat, user=user)))
+
+    async def _load(self, chat, user) -> dict | None:
+        key = self.resolve_address(chat=chat, user=user)
+        # A record being flushed is newer in memory than in the file until the write commits
+        if self.shared and key not in self._dirty and key not in self._flushing:
+            row = await asyncio.to_thread(self._read, key)
+            if row is None:
+                self.data.pop(key, None)
+            else:
+                state, data, bucket = row
+                self.data[key] = {'state': state, 'data': json.loads(data), 'bucket': json.loads(bucket)}
+        return self.data.get(key)
+
+    def _read(self, key: tuple[str, str]) -> tuple[str | None, str, str] | None:
+        with self._lock:
+            return self._connection.execute('SELECT state, data, bucket FROM fsm WHERE chat = ? AND user = ?',
+                                            key).fetchone()
+
+    def _get(self, chat, user) -> dict:
+        key = self.resolve_address(chat=chat, user=user)
+        record = self.data.get(key)
+        if record is None:
+            record = self.data[key] = {'state': None, 'data': {}, 'bucket': {}}
+        return record
+
+    async def _set(self, chat, user, field: str, value: typing.Any):
+        key = self.resolve_address(chat=chat, user=user)
+        self._get(chat=chat, user=user)[field] = value
+        self.writes += 1
+        self._dirty.add(key)
+        if self.shared:
+            try:
+                await self.flush()
+                return
+            except sqlite3.Error as e:
+                self.failures += 1
+                logger.warning('Writing FSM record %s failed, retrying in %ss: %s', key, self.flush_interval, e)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                try:
+                    await self.flush()
+                except sqlite3.Error as e:
+                    self.failures += 1
+                    logger.warning('Writing FSM records failed, retrying in %ss: %s', self.flush_interval, e)
+        finally:
+            self._task = None
+
+    async def flush(self):
+        # Records are serialized when a flush starts, a later flush must not commit before an earlier one
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self._dirty:
+            return
+        upserts, deletes = [], []
+        for chat, user in self._dirty:
+            record = self.data.get((chat, user))
+            if record is None or record == {'state': None, 'data': {}, 'bucket': {}}:
+                self.data.pop((chat, user), None)
+                deletes.append((chat, user))
+            else:
+                upserts.append((chat, user, record['state'], json.dumps(record['data'], ensure_ascii=False),
+                                json.dumps(record['bucket'], ensure_ascii=False)))
+        keys = set(self._dirty)
+        self._flushing.update(keys)
+        self._dirty.clear()
+        try:
+            await asyncio.to_thread(self._write, upserts, deletes)
+        except sqlite3.Error:
+            # The records are written with the next flush, along with whatever changed meanwhile
+            self._dirty.update(keys)
+            raise
+        finally:
+            self._flushing.difference_update(keys)
+        self.flushes += 1
+
+    def _write(self, upserts: list[tuple], deletes: list[tuple[str, str]]):
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?, ?)', upserts)
+            self._connection.executemany('DELETE FROM fsm WHERE chat = ? AND user = ?', deletes)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        with self._lock:
+            self._connection.close()
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._load(chat=chat, user=user)
+        state = None if record is None else record['state']
+        return self.resolve_state(default) if state is None else state
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._load(chat=chat, user=user)
+        return copy.deepcopy(record['data'] if record is not None else default or {})
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        await self._load(chat=chat, user=user)
+        merged = dict(self._get(chat=chat, user=user)['data'], **(data or {}), **kwargs)
+        await self._set(chat=chat, user=user, field='data', value=copy.deepcopy(merged))
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        await self._set(chat=chat, user=user, field='state', value=self.resolve_state(state))
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        await self._set(chat=chat, user=user, field='data', value=copy.deepcopy(data or {}))
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        await self.set_state(chat=chat, user=user, state=None)
+        if with_data:
+            await self.set_data(chat=chat, user=user, data={})
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._load(chat=chat, user=user)
+        return copy.deepcopy(record['bucket'] if record is not None else default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        await self._set(chat=chat, user=user, field='bucket', value=copy.deepcopy(bucket or {}))
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        await self._load(chat=chat, user=user)
+        merged = dict(self._get(chat=chat, user=user)['bucket'], **(bucket or {}), **kwargs)
+        await self._set(chat=chat, user=user, field='bucket', value=copy.deepcopy(merged))
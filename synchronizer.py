@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from typing import (Awaitable,
+                    Callable)
+
+from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+
+from cluster import cluster
+
+logger = logging.getLogger(__name__)
+
+
+async def wait_event(event: asyncio.Event, timeout: float | None) -> bool:
+    """
+    Waits for the event at most timeout seconds and tells whether it was set. Unlike wait_for(), a cancel that arrives
+    together with the event is never swallowed, so a loop waiting here always ends on cancel.
+    """
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        done, _ = await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+    return bool(done)
+
+
+class StatesSynchronizer:
+    def __init__(self, sync: Callable[[], Awaitable[tuple[bool, bool]]], fast_interval: float, idle_interval: float,
+                 offline_interval: float, active_window: float):
+        self.sync = sync
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.offline_interval = offline_interval
+        self.active_window = active_window
+        self.interval = fast_interval
+        self.polls = 0
+        self.changes = 0
+        self._active_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def touch(self):
+        self._active_until = asyncio.get_running_loop().time() + self.active_window
+        self.interval = self.fast_interval
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if await wait_event(self._wakeup, timeout=self.interval):
+                self._wakeup.clear()
+                continue
+            if not cluster.is_leader and asyncio.get_running_loop().time() >= self._active_until:
+                # The leader keeps every lamp in sync, a follower only polls while its own users are active
+                self.interval = self.idle_interval
+                continue
+            try:
+                online, changed = await self.sync()
+            except SberSmartBulbAPIError as e:
+                logger.warning('States sync failed: %s', e)
+                self.interval = self.offline_interval
+                continue
+            except Exception:
+                logger.exception('States sync failed')
+                self.interval = self.offline_interval
+                continue
+            self.polls += 1
+            self.changes += changed
+            if not online:
+                self.interval = self.offline_interval
+            elif changed or asyncio.get_running_loop().time() < self._active_until:
+                self.interval = self.fast_interval
+            else:
+                self.interval = min(self.interval * 2, self.idle_interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
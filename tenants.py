@@ -0,0 +1,204 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import (Awaitable,
+                    Callable,
+                    Iterator)
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import (ClientSession,
+                     ClientTimeout,
+                     TCPConnector)
+from sber_smart_bulb_api import SberSmartBulbAPI
+
+from cache import StatesCache
+from config import Environment
+from fleet import Fleet
+from offline import OfflineQueue
+from resilience import ResilientBulbAPI
+from states import States
+from synchronizer import StatesSynchronizer
+from tokens import (TokenManager,
+                    write_atomic)
+
+logger = logging.getLogger(__name__)
+
+
+class Tenant:
+    def __init__(self, user_id: int, bulb_api: SberSmartBulbAPI, env: Environment, token_path: str,
+                 devices: dict[str, str], device_groups: dict[str, list[str]]):
+        self.user_id = user_id
+        self.env = env
+        self.bulb_api = bulb_api
+        self.tokens = TokenManager(bulb_api=bulb_api, path=token_path, margin=env.token_refresh_margin,
+                                   retry_interval=env.token_retry_interval)
+        self.resilient_api = ResilientBulbAPI(bulb_api=bulb_api, read_budget=env.api_read_budget,
+                                              write_budget=env.api_write_budget,
+                                              attempt_timeout=env.api_attempt_timeout, retries=env.api_retries,
+                                              backoff=env.api_retry_backoff, breaker_threshold=env.breaker_threshold,
+                                              breaker_reset=env.breaker_reset)
+        self.states_cache = StatesCache(bulb_api=self.resilient_api, ttl=env.states_ttl)
+        self.offline = OfflineQueue(path=os.path.join(env.offline_dir, f'{user_id}.json'))
+        self.states: States | None = None
+        self.synchronizer: StatesSynchronizer | None = None
+        self.loader: asyncio.Task | None = None
+        self.menus: dict[int, tuple[types.Message, Callable[['Tenant'], tuple[str, types.InlineKeyboardMarkup]]]] = {}
+        self.last_used = time.monotonic()
+        self.set_devices(devices=devices, device_groups=device_groups)
+
+    def set_devices(self, devices: dict[str, str], device_groups: dict[str, list[str]]):
+        self.devices = devices
+        self.device_groups = device_groups
+        self.targets: dict[str, list[str]] = {name: [device_id] for name, device_id in devices.items()}
+        for name, members in device_groups.items():
+            self.targets[name] = [devices[member] for member in members]
+        self.target: str | None = next(iter(self.targets), None)
+        self.fleet = Fleet(names={device_id: name for name, device_id in devices.items()},
+                           concurrency=self.env.fleet_concurrency, timeout=self.env.fleet_timeout)
+
+    @property
+    def device_ids(self) -> list[str]:
+        return self.targets[self.target]
+
+    @property
+    def device_id(self) -> str:
+        return self.device_ids[0]
+
+    async def discover(self) -> dict[str, str]:
+        devices = {}
+        for group in (await self.bulb_api.get_device_groups()).result:
+            for device in (await self.bulb_api.get_device_group_tree(group_id=group.id)).devices:
+                devices.setdefault(device.name.name, device.id)
+        return devices
+
+    async def close(self):
+        if self.loader is not None:
+            self.loader.cancel()
+            await asyncio.gather(self.loader, return_exceptions=True)
+        if self.synchronizer is not None:
+            await self.synchronizer.stop()
+        await self.tokens.stop()
+
+
+class TenantRegistry:
+    def __init__(self, env: Environment, load: Callable[[Tenant], Awaitable[None]]):
+        self.env = env
+        self.load = load
+        self.created = 0
+        self.evicted = 0
+        self._tenants: dict[int, Tenant] = {}
+        self._records: dict[str, dict] | None = None
+        self._session: ClientSession | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def owner(self) -> int:
+        return self.env.bot_user_ids[0]
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(list(self._tenants.values()))
+
+    def get(self, user_id: int, touch: bool = True) -> Tenant:
+        """
+        Returns the tenant of the user, loading it if needed. Background work passes touch=False: it neither keeps
+        an idle tenant from being evicted nor loads its states and synchronizer, the API client alone is enough.
+        """
+        tenant = self._tenants.get(user_id)
+        if tenant is None:
+            tenant = self._create(user_id=user_id)
+            self._tenants[user_id] = tenant
+            self.created += 1
+        if not touch:
+            return tenant
+        tenant.last_used = time.monotonic()
+        if tenant.states is None and tenant.loader is None and tenant.bulb_api.refresh_token:
+            tenant.loader = asyncio.create_task(self.load(tenant))
+        return tenant
+
+    def _create(self, user_id: int) -> Tenant:
+        if self._session is None:
+            self._session = ClientSession(connector=TCPConnector(ssl=False, limit=self.env.http_pool_size),
+                                          timeout=ClientTimeout(total=30))
+        if user_id == self.owner:
+            token_path = self.env.refresh_token_path
+            devices, device_groups = self.env.devices, self.env.device_groups
+        else:
+            token_path = os.path.join(self.env.tokens_dir, str(user_id))
+            record = self.get_records().get(str(user_id), {})
+            devices, device_groups = record.get('devices', {}), record.get('device_groups', {})
+        refresh_token = None
+        if os.path.exists(token_path):
+            with open(token_path) as f:
+                refresh_token = f.read().strip() or None
+        bulb_api = SberSmartBulbAPI(refresh_token=refresh_token, refresh_token_path=None)
+        bulb_api.session.detach()
+        bulb_api.session = self._session
+        return Tenant(user_id=user_id, bulb_api=bulb_api, env=self.env, token_path=token_path, devices=devices,
+                      device_groups=device_groups)
+
+    def get_records(self) -> dict[str, dict]:
+        if self._records is None:
+            self._records = {}
+            if os.path.exists(self.env.tenants_path):
+                with open(self.env.tenants_path) as f:
+                    self._records = json.load(f)
+        return self._records
+
+    async def save(self, tenant: Tenant):
+        records = self.get_records()
+        records[str(tenant.user_id)] = {'devices': tenant.devices, 'device_groups': tenant.device_groups}
+        data = json.dumps(records, ensure_ascii=False, indent=1)
+        await asyncio.to_thread(write_atomic, self.env.tenants_path, data)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def load_offline(self):
+        # Tenants with queued offline commands are loaded right away so the commands reach the lamps
+        if os.path.isdir(self.env.offline_dir):
+            for name in os.listdir(self.env.offline_dir):
+                if name.endswith('.json'):
+                    self.get(user_id=int(name.removesuffix('.json')))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.env.tenant_idle_timeout / 2)
+            deadline = time.monotonic() - self.env.tenant_idle_timeout
+            idle = [tenant for tenant in self._tenants.values() if tenant.last_used < deadline and not tenant.offline]
+            for tenant in idle:
+                del self._tenants[tenant.user_id]
+                await tenant.close()
+            if idle:
+                self.evicted += len(idle)
+                logger.info('Tenants: %s active, %s created, %s evicted', len(self._tenants), self.created,
+                            self.evicted)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*(tenant.close() for tenant in self._tenants.values()))
+        self._tenants.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class TenantMiddleware(BaseMiddleware):
+    def __init__(self, registry: TenantRegistry):
+        super().__init__()
+        self.registry = registry
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        data['tenant'] = self.registry.get(user_id=message.from_user.id)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['tenant'] = self.registry.get(user_id=callback_query.from_user.id)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Config is read on import, modules that reach it need the required variables
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('BOT_USER_IDS', '1')
+os.environ.setdefault('FSM_PATH', ':memory:')
+os.environ.setdefault('JOURNAL_PATH', '')
@@ -0,0 +1,93 @@
+import asyncio
+import random
+import time
+
+import jwt
+import pytest
+from pydantic import ValidationError
+from sber_smart_bulb_api.exceptions import (ClientConnectorSberSmartBulbAPIError,
+                                            TimeoutSberSmartBulbAPIError)
+
+from benchmarks.fake_bulb_api import (FakeCloud,
+                                      FakeSberSmartBulbAPI)
+from benchmarks.fake_telegram import (FakeTelegram,
+                                      get_update)
+from benchmarks.load import (compare,
+                             get_percentiles,
+                             get_script)
+
+
+@pytest.fixture
+def cloud(monkeypatch) -> FakeCloud:
+    cloud = FakeCloud(latency=0.0, jitter=0.0)
+    monkeypatch.setattr(FakeSberSmartBulbAPI, 'cloud', cloud)
+    return cloud
+
+
+def test_fake_api_writes_states(cloud):
+    async def main():
+        bulb_api = FakeSberSmartBulbAPI(refresh_token='token')
+        await bulb_api.set_color(device_id='lamp', h=10, s=20, v=30)
+        await bulb_api.set_on_off(device_id='lamp', value=False)
+        states = await bulb_api.get_device_states(device_id='lamp')
+        assert (states.online, states.on_off, states.work_mode) == (True, False, 'colour')
+        assert states.colour_data_v2.model_dump() == {'h': 10, 's': 20, 'v': 30}
+        with pytest.raises(ValidationError):
+            await bulb_api.set_white(device_id='lamp', brightness=2, temp=50)
+        await bulb_api._refresh_access_token()
+        assert jwt.decode(bulb_api._access_token, options={'verify_signature': False})['sub'] == 'token'
+
+    asyncio.run(main())
+    assert cloud.calls == {'set_color': 1, 'set_on_off': 1, 'get_device_states': 1, 'token': 1}
+
+
+def test_fake_cloud_failures():
+    async def main():
+        cloud = FakeCloud(latency=0.0, jitter=0.0, error_rate=1.0)
+        with pytest.raises(ClientConnectorSberSmartBulbAPIError):
+            await cloud.call(method='get_device_states')
+        cloud = FakeCloud(latency=0.0, jitter=0.0, offline=[(0.0, 60.0)])
+        with pytest.raises(TimeoutSberSmartBulbAPIError):
+            await cloud.write(method='set_on_off', device_id='lamp', on_off=False)
+        assert cloud.get_device(device_id='lamp')['on_off']
+        assert cloud.errors == 1
+
+    asyncio.run(main())
+
+
+def test_fake_telegram_batches_queued_updates():
+    async def main():
+        telegram = FakeTelegram()
+        for update_id in (1, 2, 3):
+            telegram.updates.put_nowait(get_update(update_id=update_id, user_id=1, data='on_off'))
+        assert [update['update_id'] for update in await telegram.get_updates(timeout=1)] == [1, 2, 3]
+        started = time.monotonic()
+        assert await telegram.get_updates(timeout=0.05) == []
+        assert time.monotonic() - started >= 0.05
+
+    asyncio.run(main())
+
+
+def test_get_script():
+    assert get_script('brightness', 60, random.Random(1)) == ['up:bright_value_v2'] * 25 + \
+        ['down:bright_value_v2'] * 25 + ['up:bright_value_v2'] * 10
+    assert len(get_script('mixed', 40, random.Random(1))) == 40
+
+
+def test_get_percentiles():
+    assert get_percentiles([]) == {}
+    assert get_percentiles([float(value) for value in range(100, 0, -1)]) == {'p50': 51.0, 'p95': 96.0,
+                                                                                'p99': 100.0, 'max': 100.0}
+
+
+def test_compare():
+    report = {'config': {'users': 2}, 'tap_to_edit_ms': {'p50': 30.0, 'p95': 60.0, 'p99': 90.0}, 'dropped': 1,
+              'unrendered': 0, 'upstream': {'per_action': 0.5}}
+    baseline = {'config': {'users': 1}, 'tap_to_edit_ms': {'p50': 20.0, 'p95': 60.0}, 'dropped': 2,
+                'unrendered': 0, 'upstream': {'per_action': 1.0}}
+    lines = compare(report=report, baseline=baseline)
+    assert lines[0] == 'Warning: the baseline was recorded with a different configuration'
+    assert lines[1].split() == ['tap_to_edit_ms.p50', '20.0', '->', '30.0', '+50.0%']
+    assert lines[3].split() == ['tap_to_edit_ms.p99', 'None', '->', '90.0']
+    assert lines[4].split() == ['dropped', '2', '->', '1', '-50.0%']
+    assert lines[6].split() == ['upstream.per_action', '1.0', '->', '0.5', '-50.0%']
@@ -0,0 +1,27 @@
+from keyboards import (render_colour_keyboard,
+                       render_timer_keyboard,
+                       render_white_keyboard)
+
+
+def get_rows(keyboard) -> list[list[str]]:
+    return [[button.callback_data for button in row] for row in keyboard.inline_keyboard]
+
+
+def test_white_keyboard_bounds():
+    rows = get_rows(render_white_keyboard(bright_value_v2=5, temp_value_v2=1, step_index=0))
+    assert rows[0] == ['default:bright_value_v2', 'up:bright_value_v2']
+    assert rows[1] == ['down:temp_value_v2', 'default:temp_value_v2', 'up:temp_value_v2']
+    rows = get_rows(render_white_keyboard(bright_value_v2=6, temp_value_v2=0, step_index=4))
+    assert rows[0] == ['down:bright_value_v2', 'default:bright_value_v2', 'up:bright_value_v2']
+    assert rows[1] == ['default:temp_value_v2', 'up:temp_value_v2']
+    assert rows[2] == ['down:step:white', 'default:step:white']
+    rows = get_rows(render_white_keyboard(bright_value_v2=100, temp_value_v2=100, step_index=2))
+    assert rows[0] == ['down:bright_value_v2', 'default:bright_value_v2']
+    assert rows[1] == ['down:temp_value_v2', 'default:temp_value_v2']
+
+
+def test_colour_and_timer_keyboard_bounds():
+    rows = get_rows(render_colour_keyboard(h=360, s=0, v=1, step_index=1))
+    assert rows[:3] == [['down:h', 'default:h'], ['default:s', 'up:s'], ['down:v', 'default:v', 'up:v']]
+    rows = get_rows(render_timer_keyboard(sleep_timer=1, step_index=1, turn_on=True, time='07:00'))
+    assert rows[0] == ['default:sleep_timer', 'up:sleep_timer']
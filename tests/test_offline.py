@@ -0,0 +1,24 @@
+import asyncio
+from types import SimpleNamespace
+
+from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+
+import bot
+
+
+def test_offline_report_escapes_device_names(monkeypatch):
+    class Offline:
+        async def flush(self, send):
+            return [('lamp', 'scene', {'scene': 'candle'})], {'desk': SberSmartBulbAPIError('Timeout error')}
+
+        def __bool__(self):
+            return False
+
+    async def send_message(chat_id: int, text: str):
+        sent.append(text)
+
+    sent = []
+    monkeypatch.setattr(bot.bot, 'send_message', send_message)
+    tenant = SimpleNamespace(user_id=1, offline=Offline(), devices={'<Лампа & бра>': 'lamp', 'Стол': 'desk'})
+    asyncio.run(bot.flush_offline(tenant=tenant))
+    assert sent == ['Лампа снова в сети\n&lt;Лампа &amp; бра&gt;: сцена candle\nСтол: <b>Timeout error</b>']
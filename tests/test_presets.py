@@ -0,0 +1,49 @@
+import pytest
+
+from presets import (SET_USAGE,
+                     Preset,
+                     parse_command,
+                     parse_set)
+from states import States
+
+
+def test_parse_set():
+    assert parse_set('h=210 s=80 v=40') == ('color', {'work_mode': 'colour', 'h': 210, 's': 80, 'v': 40})
+    assert parse_set('brightness=70 t=30') == ('white', {'work_mode': 'white', 'bright_value_v2': 70,
+                                                          'temp_value_v2': 30})
+    assert parse_set('v=5') == ('color', {'work_mode': 'colour', 'v': 5})
+
+
+@pytest.mark.parametrize('text', ['', '   ', 'h=', 'x=1', 'h=-1'])
+def test_parse_set_usage(text: str):
+    with pytest.raises(ValueError, match=SET_USAGE):
+        parse_set(text)
+
+
+@pytest.mark.parametrize('text', ['b=2', 'b=101', 'h=361', 'b=50 h=10'])
+def test_parse_set_rejects(text: str):
+    with pytest.raises(ValueError):
+        parse_set(text)
+
+
+def test_parse_command():
+    assert parse_command(['white', '70', '30']) == ('white', {'work_mode': 'white', 'bright_value_v2': 70,
+                                                             'temp_value_v2': 30})
+    assert parse_command(['scene', 'sunset']) == ('scene', {'work_mode': 'scene', 'light_scene': 'sunset'})
+    for words in (['white', '4', '30'], ['colour', '1', '2'], ['scene', 'disco'], []):
+        with pytest.raises(ValueError):
+            parse_command(words)
+
+
+def test_preset_from_states():
+    states = States(online=True, on_off=True, work_mode='colour', light_scene='candle', bright_value_v2=50,
+                    temp_value_v2=50, h=10, s=20, v=30, sleep_timer=0)
+    preset = Preset.from_states(name='red', states=states)
+    assert (preset.command, preset.fields) == ('color', {'work_mode': 'colour', 'h': 10, 's': 20, 'v': 30})
+    assert preset.describe() == 'red: colour 10 20 30'
+
+
+def test_describe_escapes_the_name():
+    preset = Preset(name='<Вечер & ночь>', command='white', fields={'work_mode': 'white', 'bright_value_v2': 70,
+                                                                     'temp_value_v2': 30})
+    assert preset.describe() == '&lt;Вечер &amp; ночь&gt;: white 70 30'
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from datetime import (datetime,
+                      timezone)
+
+import pytest
+
+from scheduler import (Schedule,
+                       Scheduler)
+
+
+def parse(text: str) -> Schedule:
+    return Schedule.parse(id=1, user_id=1, target='Лампа', text=text)
+
+
+def test_parse_white_with_ramp():
+    schedule = parse('1-5 7:00 white 100 50 ramp=30')
+    assert schedule.weekdays == [1, 2, 3, 4, 5]
+    assert schedule.at == '07:00'
+    assert schedule.command == 'white'
+    assert schedule.values == {'brightness': 100, 'temp': 50}
+    assert schedule.ramp == 30
+
+
+def test_parse_commands():
+    assert (parse('daily 23:30 off').command, parse('daily 23:30 off').values) == ('on_off', {'value': False})
+    assert parse('1,3,6-7 08:15 colour 200 80 40').values == {'h': 200, 's': 80, 'v': 40}
+    assert parse('daily 08:15 color 200 80 40').command == 'color'
+    assert parse('daily 21:00 scene candle').values == {'scene': 'candle'}
+
+
+@pytest.mark.parametrize('text', [
+    'daily 07:00 white 500 50',
+    'daily 07:00 white 2 50',
+    'daily 07:00 white 50 101',
+    'daily 07:00 colour 361 50 50',
+    'daily 07:00 scene disco',
+    'daily 07:00 off ramp=10',
+    'daily 24:00 on',
+    '0 07:00 on',
+    '1-8 07:00 on',
+    'daily 07:00 dim',
+    'daily on'
+])
+def test_parse_rejects(text: str):
+    with pytest.raises(ValueError):
+        parse(text)
+
+
+def test_fires():
+    schedule = parse('1 07:00 on')
+    monday = datetime(2024, 1, 1, 7, 0, tzinfo=timezone.utc).timestamp()
+    assert schedule.next_fire(after=monday - 1, tz=timezone.utc) == monday
+    assert schedule.next_fire(after=monday, tz=timezone.utc) == monday + 7 * 86400
+    assert schedule.previous_fire(before=monday + 86400, tz=timezone.utc) == monday
+
+
+def test_fired_elsewhere_is_requeued(tmp_path):
+    async def send(*args, **values):
+        sent.append(values)
+
+    async def main():
+        scheduler = Scheduler(send=send, tz=timezone.utc, path=str(tmp_path / 'schedules.json'), catch_up=3600,
+                              rate=100, owner=1)
+        schedule = scheduler.schedules[1] = parse('daily 07:00 on')
+        # Another leader with a clock a minute ahead fired it already
+        now = time.time()
+        schedule.last_fire = now + 60
+        scheduler._heap = [(now - 1, 1)]
+        scheduler._task = asyncio.create_task(scheduler._run())
+        await asyncio.sleep(0.05)
+        assert scheduler.fired == 0
+        assert scheduler._heap == [(schedule.next_fire(after=now, tz=timezone.utc), 1)]
+        await scheduler.stop()
+
+    sent = []
+    asyncio.run(main())
+    assert not sent
+
+
+def test_describe_escapes_the_target():
+    schedule = Schedule.parse(id=3, user_id=1, target='<Спальня & кухня>', text='1-5 7:00 white 100 50 ramp=30')
+    assert schedule.describe() == '#3 &lt;Спальня &amp; кухня&gt;: 1,2,3,4,5 07:00 white brightness=100 temp=50 ' \
+                                  'за 30 мин'
@@ -0,0 +1,21 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiohttp import ServerDisconnectedError
+from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+
+import bot
+from config import Config
+
+
+def test_loader_retries_unwrapped_errors(monkeypatch):
+    errors = [SberSmartBulbAPIError('Лампы не найдены'), ServerDisconnectedError(), asyncio.TimeoutError()]
+
+    async def prepare(tenant):
+        if errors:
+            raise errors.pop(0)
+
+    monkeypatch.setattr(bot, 'prepare', prepare)
+    monkeypatch.setattr(Config.env, 'sync_offline_interval', 0.0)
+    asyncio.run(asyncio.wait_for(bot.load_states(tenant=SimpleNamespace(user_id=1)), timeout=5))
+    assert not errors
@@ -0,0 +1,60 @@
+from states import States
+
+
+def get_states() -> States:
+    return States(online=True, on_off=True, work_mode='white', light_scene='candle', bright_value_v2=50,
+                  temp_value_v2=50, h=180, s=50, v=50, sleep_timer=0)
+
+
+def test_take_and_clean():
+    states = get_states()
+    assert states.take(command='white') is None
+    states + 'bright_value_v2'
+    assert states.take(command='white') == {'brightness': 51, 'temp': 50}
+    assert states.take(command='color') is None
+    generation = states.generation
+    states.clean(command='white', generation=generation)
+    assert states.take(command='white') is None
+
+
+def test_clean_keeps_later_edits():
+    states = get_states()
+    states.edit(bright_value_v2=60)
+    generation = states.generation
+    states.edit(temp_value_v2=70)
+    states.clean(command='white', generation=generation)
+    assert states.take(command='white') == {'brightness': 60, 'temp': 70}
+
+
+def test_edit_to_bounds():
+    states = get_states()
+    states.set_step(4)
+    states - 'bright_value_v2'
+    assert states.bright_value_v2 == States.minimals['bright_value_v2'] == 5
+    states + 'h'
+    states + 'h'
+    assert states.h == 360
+
+
+def test_sync_skips_dirty_and_newer_fields():
+    states = get_states()
+    generation = states.generation
+    states.edit(bright_value_v2=80)
+    assert states.sync(generation=generation, bright_value_v2=50, temp_value_v2=40) == {'temp_value_v2': 40}
+    assert states.bright_value_v2 == 80
+    states.clean(command='white', generation=states.generation)
+    # A read started before the write finished still returns the old value
+    assert states.sync(generation=generation, bright_value_v2=50) == {}
+    assert states.sync(generation=states.generation, bright_value_v2=50) == {'bright_value_v2': 50}
+
+
+def test_held_write():
+    states = get_states()
+    states.update(on_off=False)
+    generation = states.hold(keys=States.held['on_off'])
+    started = states.generation
+    assert states.sync(generation=started, on_off=True) == {}
+    states.release(keys=States.held['on_off'], generation=generation)
+    assert states.sync(generation=started, on_off=True) == {}
+    assert not states.on_off
+    assert states.sync(generation=states.generation, on_off=True) == {'on_off': True}
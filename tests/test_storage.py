@@ -0,0 +1,157 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from storage import SQLiteStorage
+
+
+def get_rows(path: str) -> list[tuple]:
+    with sqlite3.connect(path) as connection:
+        return connection.execute('SELECT chat, user, state FROM fsm ORDER BY chat').fetchall()
+
+
+def test_flush_round_trip(tmp_path):
+    path = str(tmp_path / 'fsm.db')
+
+    async def main():
+        storage = SQLiteStorage(path=path, flush_interval=60.0)
+        await storage.set_state(chat=1, user=1, state='waiting')
+        await storage.update_data(chat=1, user=1, target='Лампа')
+        await storage.set_state(chat=2, user=2, state='waiting')
+        await storage.reset_state(chat=2, user=2)
+        await storage.close()
+        await storage.wait_closed()
+        assert storage.flushes == 1
+        reopened = SQLiteStorage(path=path, flush_interval=60.0)
+        assert await reopened.get_data(chat=1, user=1) == {'target': 'Лампа'}
+        await reopened.wait_closed()
+
+    asyncio.run(main())
+    assert get_rows(path) == [('1', '1', 'waiting')]
+
+
+def test_failed_flush_is_retried(tmp_path, monkeypatch):
+    path = str(tmp_path / 'fsm.db')
+    write = SQLiteStorage._write
+    calls = []
+
+    def fail_once(self, upserts, deletes):
+        calls.append(len(upserts))
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        write(self, upserts, deletes)
+
+    monkeypatch.setattr(SQLiteStorage, '_write', fail_once)
+
+    async def main():
+        storage = SQLiteStorage(path=path, flush_interval=0.01)
+        await storage.set_state(chat=1, user=1, state='first')
+        while not calls:
+            await asyncio.sleep(0.01)
+        await storage.set_state(chat=2, user=2, state='second')
+        while storage.flushes == 0:
+            await asyncio.sleep(0.01)
+        assert storage.failures == 1
+        assert storage._task is not None
+        await storage.close()
+        await storage.wait_closed()
+
+    asyncio.run(main())
+    assert calls[:2] == [1, 2]
+    assert get_rows(path) == [('1', '1', 'first'), ('2', '2', 'second')]
+
+
+def test_close_raises_a_failed_flush(tmp_path, monkeypatch):
+    def fail(self, upserts, deletes):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    async def main():
+        storage = SQLiteStorage(path=str(tmp_path / 'fsm.db'), flush_interval=60.0)
+        await storage.set_state(chat=1, user=1, state='waiting')
+        monkeypatch.setattr(SQLiteStorage, '_write', fail)
+        with pytest.raises(sqlite3.OperationalError):
+            await storage.close()
+        assert storage._dirty == {('1', '1')}
+        assert storage._flushing == set()
+
+    asyncio.run(main())
+
+
+def test_shared_writes_through(tmp_path):
+    path = str(tmp_path / 'fsm.db')
+
+    async def main():
+        storage = SQLiteStorage(path=path, flush_interval=60.0, shared=True)
+        other = SQLiteStorage(path=path, flush_interval=60.0, shared=True)
+        await storage.set_state(chat=1, user=1, state='auth_step_2')
+        await storage.update_data(chat=1, user=1, ouid='ouid')
+        assert await other.get_state(chat=1, user=1) == 'auth_step_2'
+        assert await other.get_data(chat=1, user=1) == {'ouid': 'ouid'}
+        await other.set_state(chat=1, user=1, state='auth_step_3')
+        assert await storage.get_state(chat=1, user=1) == 'auth_step_3'
+        assert (storage.flushes, storage._task) == (2, None)
+        for each in (storage, other):
+            await each.close()
+            await each.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_shared_write_failure_is_retried(tmp_path, monkeypatch):
+    path = str(tmp_path / 'fsm.db')
+    write = SQLiteStorage._write
+    calls = []
+
+    def fail_once(self, upserts, deletes):
+        calls.append(len(upserts))
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        write(self, upserts, deletes)
+
+    monkeypatch.setattr(SQLiteStorage, '_write', fail_once)
+
+    async def main():
+        storage = SQLiteStorage(path=path, flush_interval=0.01, shared=True)
+        await storage.set_state(chat=1, user=1, state='waiting')
+        assert (storage.failures, storage.flushes) == (1, 0)
+        while storage.flushes == 0:
+            await asyncio.sleep(0.01)
+        await storage.close()
+        await storage.wait_closed()
+
+    asyncio.run(main())
+    assert get_rows(path) == [('1', '1', 'waiting')]
+
+
+def test_shared_keeps_records_in_flight(tmp_path, monkeypatch):
+    path = str(tmp_path / 'fsm.db')
+    write = SQLiteStorage._write
+
+    async def main():
+        storage = SQLiteStorage(path=path, flush_interval=60.0, shared=True)
+        other = SQLiteStorage(path=path, flush_interval=60.0, shared=True)
+        await storage.set_state(chat=1, user=1, state='first')
+        assert await other.get_state(chat=1, user=1) == 'first'
+        started, resume = asyncio.Event(), asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def slow(self, upserts, deletes):
+            loop.call_soon_threadsafe(started.set)
+            asyncio.run_coroutine_threadsafe(resume.wait(), loop).result()
+            write(self, upserts, deletes)
+
+        monkeypatch.setattr(SQLiteStorage, '_write', slow)
+        written = asyncio.create_task(storage.set_state(chat=1, user=1, state='second'))
+        await started.wait()
+        # The row in the file is older than the one being written
+        assert await storage.get_state(chat=1, user=1) == 'second'
+        resume.set()
+        await written
+        assert await other.get_state(chat=1, user=1) == 'second'
+        monkeypatch.setattr(SQLiteStorage, '_write', write)
+        for each in (storage, other):
+            await each.close()
+            await each.wait_closed()
+
+    asyncio.run(main())
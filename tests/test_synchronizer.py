@@ -0,0 +1,37 @@
+import asyncio
+
+from synchronizer import (StatesSynchronizer,
+                          wait_event)
+
+
+def test_wait_event():
+    async def main():
+        event = asyncio.Event()
+        assert not await wait_event(event, timeout=0.01)
+        asyncio.get_running_loop().call_later(0.01, event.set)
+        assert await wait_event(event, timeout=5)
+
+    asyncio.run(main())
+
+
+def test_stop_after_touch():
+    async def sync() -> tuple[bool, bool]:
+        polls.append(asyncio.get_running_loop().time())
+        return True, False
+
+    async def main():
+        synchronizer = StatesSynchronizer(sync=sync, fast_interval=0.01, idle_interval=0.05, offline_interval=0.05,
+                                          active_window=1.0)
+        synchronizer.start()
+        for _ in range(20):
+            await asyncio.sleep(0.003)
+            # The wakeup and the cancel land in the same tick
+            synchronizer.touch()
+            await asyncio.wait_for(synchronizer.stop(), timeout=1)
+            synchronizer.start()
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(synchronizer.stop(), timeout=1)
+
+    polls = []
+    asyncio.run(main())
+    assert polls
@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+import pytest
+
+from benchmarks.fake_bulb_api import (FakeCloud,
+                                      FakeSberSmartBulbAPI)
+from tokens import (TokenManager,
+                    write_atomic)
+
+
+def test_write_atomic(tmp_path):
+    path = str(tmp_path / 'data' / 'sber_refresh_token')
+    write_atomic(path, 'first')
+    write_atomic(path, 'second')
+    with open(path) as f:
+        assert f.read() == 'second'
+    assert os.listdir(tmp_path / 'data') == ['sber_refresh_token']
+
+
+def test_write_atomic_failure_leaves_no_temp_file(tmp_path):
+    os.mkdir(tmp_path / 'sber_refresh_token')
+    with pytest.raises(OSError):
+        write_atomic(str(tmp_path / 'sber_refresh_token'), 'token')
+    assert os.listdir(tmp_path) == ['sber_refresh_token']
+
+
+def test_rotated_token_is_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeSberSmartBulbAPI, 'cloud', FakeCloud(latency=0.0, jitter=0.0))
+    path = str(tmp_path / 'sber_refresh_token')
+
+    async def main():
+        bulb_api = FakeSberSmartBulbAPI(refresh_token='first')
+        tokens = TokenManager(bulb_api=bulb_api, path=path, margin=60.0, retry_interval=1.0)
+        await tokens.refresh()
+        assert tokens.refreshes == 1
+        assert tokens.time_to_expiry > 3000
+        assert not os.path.exists(path)
+        bulb_api.refresh_token = 'second'
+        bulb_api._save_refresh_token('second')
+        await tokens.stop()
+
+    asyncio.run(main())
+    with open(path) as f:
+        assert f.read() == 'second'
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fake_bulb_api import (FakeCloud,
+                                      FakeSberSmartBulbAPI)
+from cache import StatesCache
+from usage import (History,
+                   UsageStore,
+                   usage)
+
+START = 1_700_000_000 // 3600 * 3600
+
+
+def get_store(path: str, max_gap: float = 600.0) -> UsageStore:
+    store = UsageStore()
+    store.configure(path=path, changes=16, minutes=180, hours=48, max_gap=max_gap, snapshot_interval=60.0,
+                    poll_interval=60.0, watts=10.0)
+    return store
+
+
+def observe(store: UsageStore, ts: float, on: bool, brightness: int, mode: int = 0):
+    store.get(device_id='lamp').observe(ts=ts, state=(on, brightness, mode), max_gap=store.max_gap)
+
+
+def test_report(tmp_path):
+    store = get_store(path=str(tmp_path / 'usage.json'))
+    for minute in range(0, 150, 5):
+        observe(store, ts=START + minute * 60, on=minute < 120, brightness=50 if minute < 60 else 100)
+    report = store.report(device_ids=['lamp'], start=START, end=START + 150 * 60)
+    assert report['hours'] == pytest.approx(2.0)
+    assert report['brightness'] == pytest.approx(75.0)
+    assert report['energy'] == pytest.approx(15.0)
+    assert report['mode'] == 'white'
+    assert store.report(device_ids=['lamp'], start=START + 3600, end=START + 150 * 60)['hours'] == pytest.approx(1.0)
+    assert store.report(device_ids=['other'], start=START)['mode'] is None
+
+
+def test_gap_is_not_carried_over(tmp_path):
+    store = get_store(path=str(tmp_path / 'usage.json'), max_gap=300.0)
+    observe(store, ts=START, on=True, brightness=100)
+    assert store.report(device_ids=['lamp'], start=START, end=START + 3600)['hours'] == pytest.approx(300 / 3600)
+
+
+def test_update_carries_the_last_state(tmp_path):
+    store = get_store(path=str(tmp_path / 'usage.json'))
+    store.update(device_id='lamp', on=True, ts=START)
+    assert 'lamp' not in store.histories
+    observe(store, ts=START, on=True, brightness=40)
+    store.update(device_id='lamp', brightness=80, mode='colour', ts=START + 600)
+    store.update(device_id='lamp', on=False, ts=START + 1200)
+    assert store.histories['lamp'].state == (False, 80, 1)
+    report = store.report(device_ids=['lamp'], start=START, end=START + 1800)
+    assert report['hours'] == pytest.approx(1 / 3)
+    assert report['brightness'] == pytest.approx(60.0)
+
+
+def test_ring_buffers_wrap():
+    history = History(changes=4, minutes=120, hours=3)
+    for hour in range(6):
+        history.observe(ts=START + hour * 3600, state=(True, 100, 0), max_gap=3600)
+    for index in range(6):
+        history.observe(ts=START + 6 * 3600 + index, state=(bool(index % 2), 100, 0), max_gap=3600)
+    assert history.changes.count == 7
+    assert history.changes.dump()['on'] == [0, 1, 0, 1]
+    # Only the last 3 completed hours are left in the hour buckets
+    assert history.totals(start=START, end=START + 6 * 3600 - 1)[0] == pytest.approx(3 * 3600)
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'usage.json')
+    store = get_store(path=path)
+    for minute in range(0, 90, 5):
+        observe(store, ts=START + minute * 60, on=True, brightness=60)
+    store._dirty = True
+    asyncio.run(store.save())
+    follower = get_store(path=path)
+    follower.load()
+    expected = store.report(device_ids=['lamp'], start=START, end=START + 85 * 60)
+    assert follower.report(device_ids=['lamp'], start=START, end=START + 85 * 60) == expected
+    observe(store, ts=START + 90 * 60, on=False, brightness=60)
+    store._dirty = True
+    asyncio.run(store.save())
+    asyncio.run(follower.refresh())
+    assert follower.histories['lamp'].state is None
+    assert follower.histories['lamp'].since == START + 90 * 60
+
+
+@pytest.fixture
+def cloud(monkeypatch) -> FakeCloud:
+    cloud = FakeCloud(latency=0.01, jitter=0.0)
+    monkeypatch.setattr(FakeSberSmartBulbAPI, 'cloud', cloud)
+    return cloud
+
+
+@pytest.fixture
+def recording(monkeypatch, tmp_path):
+    for key, value in vars(get_store(path=str(tmp_path / 'usage.json'))).items():
+        monkeypatch.setattr(usage, key, value)
+
+
+def test_cache_records_reads_and_writes(cloud, recording):
+    async def main():
+        cache = StatesCache(bulb_api=FakeSberSmartBulbAPI(refresh_token='token'), ttl=60.0)
+        await asyncio.gather(*(cache.get_device_states(device_id='lamp') for _ in range(5)))
+        assert (cloud.calls['get_device_states'], cache.misses, cache.coalesced) == (1, 1, 4)
+        assert usage.histories['lamp'].state == (True, 50, 0)
+        await cache.set_color(device_id='lamp', h=10, s=20, v=30)
+        assert usage.histories['lamp'].state == (True, 30, 1)
+        await cache.set_on_off(device_id='lamp', value=False)
+        assert usage.histories['lamp'].state == (False, 30, 1)
+        states = await cache.get_device_states(device_id='lamp')
+        assert (states.on_off, cloud.calls['get_device_states']) == (False, 2)
+
+    asyncio.run(main())
@@ -1,42 +1,110 @@
 from datetime import (datetime,
                       timedelta)
+from functools import lru_cache
 
 from aiogram.utils.markdown import (hbold,
                                     hcode,
                                     hide_link)
-from pytz import timezone
 
 from config import Config
+from tenants import Tenant
+from usage import usage
 
+MODE_NAMES = {
+    'white': 'Белый',
+    'colour': 'Цветной',
+    'candle': 'Свеча',
+    'arctic': 'Северное сияние',
+    'romantic': 'Романтика',
+    'dawn': 'Рассвет',
+    'sunset': 'Закат',
+    'christmas': 'Новогодний',
+    'fito': 'Фитосвет'
+}
 
-def get_white_text() -> str:
+
+def get_main_text(tenant: Tenant) -> str:
+    return render_main_text(online=tenant.states.online, queued=bool(tenant.offline))
+
+
+@lru_cache(maxsize=4)
+def render_main_text(online: bool, queued: bool) -> str:
+    text = hbold('Выбери команду' if online else 'Лампа оффлайн!')
+    return f'{text}\nКоманды будут отправлены, когда лампа появится в сети' if queued else text
+
+
+@lru_cache(maxsize=1)
+def get_devices_text() -> str:
+    return hbold('Выбери лампу или группу')
+
+
+def get_white_text(tenant: Tenant) -> str:
+    return render_white_text(bright_value_v2=tenant.states.bright_value_v2, temp_value_v2=tenant.states.temp_value_v2,
+                             step=tenant.states.step)
+
+
+@lru_cache(maxsize=256)
+def render_white_text(bright_value_v2: int, temp_value_v2: int, step: int) -> str:
     return f'{hbold("Выстави настройки")}\n' \
-           f'Яркость: {hcode(Config.states.bright_value_v2, "100", sep="/")}\n' \
-           f'Температура: {hcode(Config.states.temp_value_v2, "100", sep="/")}\n' \
-           f'Шаг: {hcode(Config.states.step, "100", sep="/")}'
+           f'Яркость: {hcode(bright_value_v2, "100", sep="/")}\n' \
+           f'Температура: {hcode(temp_value_v2, "100", sep="/")}\n' \
+           f'Шаг: {hcode(step, "100", sep="/")}'
 
 
-def get_colour_text() -> str:
+def get_colour_text(tenant: Tenant) -> str:
+    return render_colour_text(h=tenant.states.h, s=tenant.states.s, v=tenant.states.v, step=tenant.states.step)
+
+
+@lru_cache(maxsize=256)
+def render_colour_text(h: int, s: int, v: int, step: int) -> str:
     url = 'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ad/HueScale.svg/1920px-HueScale.svg.png'
     return f'{hbold("Выстави настройки")}\n' \
-           f'Тон: {hcode(Config.states.h, "360", sep="/")}\n' \
-           f'Насыщенность: {hcode(Config.states.s, "100", sep="/")}\n' \
-           f'Яркость: {hcode(Config.states.v, "100", sep="/")}\n' \
-           f'Шаг: {hcode(Config.states.step, "100", sep="/")}' \
+           f'Тон: {hcode(h, "360", sep="/")}\n' \
+           f'Насыщенность: {hcode(s, "100", sep="/")}\n' \
+           f'Яркость: {hcode(v, "100", sep="/")}\n' \
+           f'Шаг: {hcode(step, "100", sep="/")}' \
            f'{hide_link(url)}'
 
 
-def get_timer_text() -> str:
-    on_off = 'Включить' if Config.states.on_off else 'Выключить'
+def get_timer_text(tenant: Tenant) -> str:
+    return render_timer_text(turn_on=not tenant.states.on_off, time=tenant.states.time,
+                             sleep_timer=tenant.states.sleep_timer, step=tenant.states.step)
+
+
+@lru_cache(maxsize=256)
+def render_timer_text(turn_on: bool, time: str | None, sleep_timer: int, step: int) -> str:
+    action = 'Включить' if turn_on else 'Выключить'
     current = ''
-    if Config.states.time is not None:
-        current = f'Таймер {"выключения" if not Config.states.on_off else "включения"} ' \
-                  f'установлен на {hcode(Config.states.time)}'
-    return f'{hbold("Выстави настройки и нажми кнопку", on_off, sep=" ")}\n' \
-           f'Минуты:  {hcode(f"{Config.states.sleep_timer}", "1440", sep="/")}\n' \
-           f'Шаг:  {hcode(Config.states.step, "100", sep="/")}\n{current}'
+    if time is not None:
+        current = f'Таймер {"выключения" if not turn_on else "включения"} ' \
+                  f'установлен на {hcode(time)}'
+    return f'{hbold("Выстави настройки и нажми кнопку", action, sep=" ")}\n' \
+           f'Минуты:  {hcode(f"{sleep_timer}", "1440", sep="/")}\n' \
+           f'Шаг:  {hcode(step, "100", sep="/")}\n{current}'
+
+
+def get_time(tenant: Tenant) -> str:
+    return (datetime.now(tz=Config.tz) +
+            timedelta(minutes=tenant.states.sleep_timer)).strftime('%H:%M')
+
+
+def get_usage_text(tenant: Tenant) -> str:
+    today = datetime.now(tz=Config.tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    reports = (usage.report(device_ids=tenant.device_ids, start=today.timestamp()),
+               usage.report(device_ids=tenant.device_ids, start=(today - timedelta(days=6)).timestamp()))
+    return render_usage_text(target=tenant.target, reports=tuple((round(report['hours'], 1),
+                                                                  round(report['brightness']),
+                                                                  round(report['energy']),
+                                                                  report['mode']) for report in reports))
 
 
-def get_time() -> str:
-    return (datetime.now(tz=timezone(Config.env.timezone)) +
-            timedelta(minutes=Config.states.sleep_timer)).strftime('%H:%M')
+@lru_cache(maxsize=64)
+def render_usage_text(target: str, reports: tuple[tuple[float, int, int, str | None], ...]) -> str:
+    lines = [hbold(f'Статистика: {target}')]
+    for title, (hours, brightness, energy, mode) in zip(('Сегодня', 'За 7 дней'), reports):
+        lines.append(f'\n{hbold(title)}\n'
+                     f'Горела: {hcode(hours)} ч\n'
+                     f'Средняя яркость: {hcode(brightness)}%\n'
+                     f'Энергия: ~{hcode(energy)} Вт·ч\n'
+                     f'Режим: {hcode(MODE_NAMES.get(mode, mode or "—"))}')
+    return '\n'.join(lines)
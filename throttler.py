@@ -0,0 +1,83 @@
+import asyncio
+import logging
+
+from aiogram import types
+from aiogram.utils.exceptions import (MessageNotModified,
+                                      RetryAfter,
+                                      TelegramAPIError)
+
+from metrics import (edit_latency,
+                     wait_latency)
+from rendered import RenderedMessages
+
+logger = logging.getLogger(__name__)
+
+
+class EditThrottler:
+    def __init__(self, rendered: RenderedMessages, chat_rate: float, global_rate: float):
+        self.rendered = rendered
+        self.chat_interval = 1 / chat_rate
+        self.global_interval = 1 / global_rate
+        self.scheduled = 0
+        self.coalesced = 0
+        self.deferred = 0
+        self._pending: dict[tuple[int, int], tuple[types.Message, str | None,
+                                                   types.InlineKeyboardMarkup | None]] = {}
+        self._workers: dict[tuple[int, int], asyncio.Task] = {}
+        self._chat_slots: dict[int, float] = {}
+        self._global_slot = 0.0
+        self._wait = wait_latency.get('edit')
+        self._edit_text = edit_latency.get('text')
+        self._edit_markup = edit_latency.get('markup')
+
+    def schedule(self, message: types.Message, text: str | None = None,
+                 keyboard: types.InlineKeyboardMarkup | None = None):
+        key = (message.chat.id, message.message_id)
+        self.scheduled += 1
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = (message, text, keyboard)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key=key))
+
+    def _reserve(self, chat_id: int) -> float:
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._chat_slots.get(chat_id, 0.0), self._global_slot)
+        self._chat_slots[chat_id] = start + self.chat_interval
+        self._global_slot = start + self.global_interval
+        self._wait.observe(start - now)
+        return start - now
+
+    async def _work(self, key: tuple[int, int]):
+        try:
+            while key in self._pending:
+                await asyncio.sleep(self._reserve(chat_id=key[0]))
+                message, text, keyboard = self._pending.pop(key)
+                if self.rendered.is_rendered(message=message, text=text, keyboard=keyboard):
+                    continue
+                started = asyncio.get_running_loop().time()
+                try:
+                    if text is None:
+                        await message.edit_reply_markup(reply_markup=keyboard)
+                    else:
+                        await message.edit_text(text=text, reply_markup=keyboard)
+                except MessageNotModified:
+                    pass
+                except RetryAfter as e:
+                    self.deferred += 1
+                    self._pending.setdefault(key, (message, text, keyboard))
+                    self._chat_slots[key[0]] = asyncio.get_running_loop().time() + e.timeout
+                    continue
+                except TelegramAPIError as e:
+                    logger.warning('Edit of message %s in chat %s failed: %s', key[1], key[0], e)
+                    continue
+                finally:
+                    histogram = self._edit_markup if text is None else self._edit_text
+                    histogram.observe(asyncio.get_running_loop().time() - started)
+                self.rendered.remember(message=message, text=text, keyboard=keyboard)
+        finally:
+            del self._workers[key]
+
+    async def close(self):
+        if self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
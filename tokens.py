@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+import jwt
+from sber_smart_bulb_api import SberSmartBulbAPI
+from sber_smart_bulb_api.exceptions import SberSmartBulbAPIError
+
+from cluster import cluster
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path: str, data: str):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class TokenManager:
+    def __init__(self, bulb_api: SberSmartBulbAPI, path: str, margin: float, retry_interval: float):
+        self.bulb_api = bulb_api
+        self.path = path
+        self.margin = margin
+        self.retry_interval = retry_interval
+        self.refreshes = 0
+        self.failures = 0
+        self._persisted = bulb_api.refresh_token
+        self._refresh: asyncio.Task | None = None
+        self._saving: asyncio.Task | None = None
+        self._task: asyncio.Task | None = None
+        # The client rotates the refresh token inline whenever a request finds the access token expired and calls
+        # this hook right after, the new token is saved then instead of on the next wake-up of the refresh loop
+        bulb_api._save_refresh_token = self._rotated
+
+    @staticmethod
+    def get_expiry(token: str | None) -> float:
+        try:
+            return float(jwt.decode(token, options={'verify_signature': False}).get('exp') or 'inf')
+        except (jwt.DecodeError, TypeError):
+            return 0.0
+
+    @property
+    def time_to_expiry(self) -> float:
+        return min(self.get_expiry(self.bulb_api._access_token),
+                   self.get_expiry(self.bulb_api._x_auth_jwt)) - time.time()
+
+    async def refresh(self):
+        if self._refresh is None:
+            self._refresh = asyncio.create_task(self._do_refresh())
+        await asyncio.shield(self._refresh)
+
+    async def _do_refresh(self):
+        # Replicas refresh one at a time and take over tokens another one refreshed meanwhile, a refresh token
+        # rotated by one replica would otherwise be invalid for the others
+        try:
+            async with cluster.lock(name=f'tokens:{self.path}'):
+                if await self.adopt() and self.time_to_expiry > self.margin:
+                    return
+                if self.get_expiry(self.bulb_api._access_token) - time.time() <= self.margin:
+                    await self.bulb_api._refresh_access_token()
+                await self.bulb_api._set_auth_jwt()
+                self.refreshes += 1
+                await self.persist()
+                await self.share()
+        finally:
+            self._refresh = None
+
+    def _rotated(self, refresh_token: str):
+        if self._saving is None:
+            self._saving = asyncio.create_task(self._save())
+
+    async def _save(self):
+        try:
+            while self.bulb_api.refresh_token and self.bulb_api.refresh_token != self._persisted:
+                await self.persist()
+                await self.share()
+        except OSError as e:
+            self.failures += 1
+            logger.warning('Saving the rotated refresh token failed: %s', e)
+        finally:
+            self._saving = None
+
+    async def share(self):
+        await cluster.put(name=f'tokens:{self.path}', value=json.dumps({
+            'refresh_token': self.bulb_api.refresh_token,
+            'access_token': self.bulb_api._access_token,
+            'x_auth_jwt': self.bulb_api._x_auth_jwt
+        }))
+
+    async def adopt(self) -> bool:
+        """
+        Takes over the tokens another replica shared if they expire later than the current ones.
+        """
+        value = await cluster.get(name=f'tokens:{self.path}')
+        if value is None:
+            return False
+        tokens = json.loads(value)
+        if min(self.get_expiry(tokens['access_token']), self.get_expiry(tokens['x_auth_jwt'])) - time.time() <= \
+                self.time_to_expiry:
+            return False
+        self.bulb_api.refresh_token = self._persisted = tokens['refresh_token']
+        self.bulb_api._access_token = tokens['access_token']
+        self.bulb_api._x_auth_jwt = tokens['x_auth_jwt']
+        return True
+
+    async def persist(self):
+        refresh_token = self.bulb_api.refresh_token
+        if refresh_token and refresh_token != self._persisted:
+            await asyncio.to_thread(write_atomic, self.path, refresh_token)
+            self._persisted = refresh_token
+            logger.info('Rotated refresh token saved to %s', self.path)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(max(self.time_to_expiry - self.margin, self.retry_interval), 3600))
+            try:
+                if self.time_to_expiry > self.margin:
+                    await self.persist()
+                elif cluster.is_leader or not await self.adopt():
+                    # Followers only refresh themselves when the leader has not shared fresh tokens in time
+                    await self.refresh()
+            except (SberSmartBulbAPIError, OSError) as e:
+                self.failures += 1
+                logger.warning('Token refresh failed: %s', e)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._saving is not None:
+            await asyncio.gather(self._saving, return_exceptions=True)
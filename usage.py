@@ -0,0 +1,347 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+from array import array
+from typing import (Awaitable,
+                    Callable)
+
+from sber_smart_bulb_api.models import (DeviceSceneEnum,
+                                        DeviceStates)
+
+from tokens import write_atomic
+
+logger = logging.getLogger(__name__)
+
+MODES = ('white', 'colour', *(scene.value for scene in DeviceSceneEnum))
+MODE_INDEXES = {mode: index for index, mode in enumerate(MODES)}
+
+
+def get_state(states: DeviceStates) -> tuple[bool, int, int]:
+    mode = states.light_scene if states.work_mode == 'scene' else states.work_mode
+    brightness = states.colour_data_v2.v if states.work_mode == 'colour' else states.bright_value_v2
+    return states.online and states.on_off, brightness, MODE_INDEXES.get(mode, 0)
+
+
+class Series:
+    """
+    Ring buffer of fixed width time buckets with one float32 array per measure: seconds on, brightness times seconds
+    on and seconds on in every mode. Advancing to a new bucket zeroes the buckets skipped since the previous one, so
+    the last capacity buckets are always contiguous and a range sum is one or two slice sums.
+    """
+
+    __slots__ = ('width', 'capacity', 'last', 'measures')
+
+    def __init__(self, width: int, capacity: int):
+        self.width = width
+        self.capacity = capacity
+        self.last: int | None = None
+        self.measures = [array('f', bytes(4 * capacity)) for _ in range(2 + len(MODES))]
+
+    def _slots(self, first: int, last: int) -> list[tuple[int, int]]:
+        if last < first:
+            return []
+        start, end = first % self.capacity, last % self.capacity + 1
+        return [(start, end)] if start < end else [(start, self.capacity), (0, end)]
+
+    def advance(self, bucket: int):
+        if self.last is not None and bucket <= self.last:
+            return
+        if self.last is not None:
+            for start, end in self._slots(max(self.last + 1, bucket - self.capacity + 1), bucket):
+                zeros = array('f', bytes(4 * (end - start)))
+                for values in self.measures:
+                    values[start:end] = zeros
+        self.last = bucket
+
+    def add(self, bucket: int, values: list[float]):
+        self.advance(bucket)
+        if bucket > self.last - self.capacity:
+            slot = bucket % self.capacity
+            for measure, value in zip(self.measures, values):
+                measure[slot] += value
+
+    def sums(self, first: int, last: int) -> list[float]:
+        if self.last is None:
+            return [0.0] * len(self.measures)
+        slots = self._slots(max(first, self.last - self.capacity + 1), min(last, self.last))
+        return [sum(sum(values[start:end]) for start, end in slots) for values in self.measures]
+
+    def dump(self) -> dict:
+        data = b''.join(values.tobytes() for values in self.measures)
+        return {'last': self.last, 'capacity': self.capacity, 'data': base64.b64encode(data).decode()}
+
+    def load(self, record: dict):
+        if record['capacity'] != self.capacity:
+            return
+        data = base64.b64decode(record['data'])
+        size = 4 * self.capacity
+        for index, values in enumerate(self.measures):
+            values[:] = array('f', data[index * size:(index + 1) * size])
+        self.last = record['last']
+
+
+class Changes:
+    """
+    Ring buffer of the last raw state changes of a device.
+    """
+
+    __slots__ = ('capacity', 'count', 'times', 'on', 'brightness', 'modes')
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.count = 0
+        self.times = array('d', bytes(8 * capacity))
+        self.on = array('B', bytes(capacity))
+        self.brightness = array('B', bytes(capacity))
+        self.modes = array('B', bytes(capacity))
+
+    def append(self, ts: float, on: bool, brightness: int, mode: int):
+        slot = self.count % self.capacity
+        self.times[slot], self.on[slot], self.brightness[slot], self.modes[slot] = ts, on, brightness, mode
+        self.count += 1
+
+    def latest(self) -> tuple[float, tuple[bool, int, int]] | None:
+        if not self.count:
+            return None
+        slot = (self.count - 1) % self.capacity
+        return self.times[slot], (bool(self.on[slot]), self.brightness[slot], self.modes[slot])
+
+    def dump(self) -> dict:
+        size = min(self.count, self.capacity)
+        order = [(self.count - size + index) % self.capacity for index in range(size)]
+        return {'times': [self.times[slot] for slot in order], 'on': [self.on[slot] for slot in order],
+                'brightness': [self.brightness[slot] for slot in order], 'modes': [self.modes[slot] for slot in order]}
+
+    def load(self, record: dict):
+        for change in zip(record['times'], record['on'], record['brightness'], record['modes']):
+            self.append(*change)
+
+
+class History:
+    """
+    Usage history of one device. Observed states are kept as raw changes, the time between observations is added to
+    per-minute buckets with the earlier state, and every completed hour is summed from its minutes into per-hour
+    buckets.
+    """
+
+    __slots__ = ('changes', 'minutes', 'hours', 'state', 'seen', 'since')
+
+    def __init__(self, changes: int, minutes: int, hours: int):
+        self.changes = Changes(capacity=changes)
+        self.minutes = Series(width=60, capacity=minutes)
+        self.hours = Series(width=3600, capacity=hours)
+        self.state: tuple[bool, int, int] | None = None
+        self.seen = 0.0
+        self.since = 0.0
+
+    def observe(self, ts: float, state: tuple[bool, int, int], max_gap: float):
+        self.advance(ts=ts, max_gap=max_gap)
+        if state != self.state:
+            self.changes.append(ts, *state)
+            self.state = state
+        self.seen = self.since = max(ts, self.since)
+
+    def advance(self, ts: float, max_gap: float):
+        """
+        Carries the last observed state forward to ts, but no further than max_gap after the observation: without
+        fresh observations nobody knows what the lamp did.
+        """
+        end = min(ts, self.seen + max_gap)
+        if self.state is None or end <= self.since:
+            return
+        on, brightness, mode = self.state
+        start = self.since
+        while start < end:
+            bucket = int(start // 60)
+            stop = min(end, (bucket + 1) * 60)
+            values = [0.0] * len(self.minutes.measures)
+            if on:
+                values[0], values[1], values[2 + mode] = stop - start, (stop - start) * brightness, stop - start
+            self.minutes.add(bucket=bucket, values=values)
+            start = stop
+        self.since = end
+        self._roll_up()
+
+    def _roll_up(self):
+        hour = self.minutes.last // 60
+        first = hour - self.minutes.capacity // 60
+        if self.hours.last is not None:
+            first = max(first, self.hours.last + 1)
+        for completed in range(first, hour):
+            self.hours.add(bucket=completed, values=self.minutes.sums(first=completed * 60, last=completed * 60 + 59))
+
+    def totals(self, start: float, end: float) -> list[float]:
+        """
+        Sums the measures from start to end, whole hours from the hour buckets and the current hour from the minutes.
+        """
+        split = int(start // 60)
+        totals = [0.0] * len(self.minutes.measures)
+        if self.hours.last is not None and int(start // 3600) <= self.hours.last:
+            totals = self.hours.sums(first=int(start // 3600), last=self.hours.last)
+            split = (self.hours.last + 1) * 60
+        return list(map(sum, zip(totals, self.minutes.sums(first=split, last=int(end // 60)))))
+
+    def dump(self) -> dict:
+        return {'changes': self.changes.dump(), 'minutes': self.minutes.dump(), 'hours': self.hours.dump(),
+                'since': self.since}
+
+    def load(self, record: dict):
+        self.changes.load(record['changes'])
+        self.minutes.load(record['minutes'])
+        self.hours.load(record['hours'])
+        # The state before a restart is not carried over the downtime, it resumes from the next observation
+        self.seen = self.since = record['since']
+
+
+class UsageStore:
+    """
+    Memory bounded usage history of every observed device, snapshotted to disk every snapshot_interval.
+
+    States are observed whenever a device is read and after every successful write. The leader also polls every
+    poll_interval, so the history keeps going while nobody has the bot open, and the other replicas reload the
+    snapshots it saves.
+    """
+
+    def __init__(self):
+        self.path: str | None = None
+        self.changes = 0
+        self.minutes = 0
+        self.hours = 0
+        self.max_gap = 0.0
+        self.snapshot_interval = 0.0
+        self.poll_interval = 0.0
+        self.watts = 0.0
+        self.histories: dict[str, History] = {}
+        self._mtime = 0.0
+        self._dirty = False
+        self._task: asyncio.Task | None = None
+        self._poller: asyncio.Task | None = None
+
+    def configure(self, path: str, changes: int, minutes: int, hours: int, max_gap: float, snapshot_interval: float,
+                  poll_interval: float, watts: float):
+        self.path = path or None
+        self.changes = changes
+        self.minutes = minutes
+        self.hours = hours
+        self.max_gap = max_gap
+        self.snapshot_interval = snapshot_interval
+        self.poll_interval = poll_interval
+        self.watts = watts
+
+    def get(self, device_id: str) -> History:
+        history = self.histories.get(device_id)
+        if history is None:
+            history = self.histories[device_id] = History(changes=self.changes, minutes=self.minutes,
+                                                          hours=self.hours)
+        return history
+
+    def observe(self, device_id: str, states: DeviceStates, ts: float | None = None):
+        if self.path is None:
+            return
+        self.get(device_id=device_id).observe(ts=time.time() if ts is None else ts, state=get_state(states),
+                                              max_gap=self.max_gap)
+        self._dirty = True
+
+    def update(self, device_id: str, on: bool | None = None, brightness: int | None = None, mode: str | None = None,
+               ts: float | None = None):
+        """
+        Observes the state a successful write left the device in, the values it did not change are carried over from
+        the last observation.
+        """
+        history = self.histories.get(device_id) if self.path is not None else None
+        if history is None or history.state is None:
+            return
+        last_on, last_brightness, last_mode = history.state
+        state = (last_on if on is None else on, last_brightness if brightness is None else brightness,
+                 last_mode if mode is None else MODE_INDEXES.get(mode, 0))
+        history.observe(ts=time.time() if ts is None else ts, state=state, max_gap=self.max_gap)
+        self._dirty = True
+
+    def report(self, device_ids: list[str], start: float, end: float | None = None) -> dict:
+        """
+        Returns lamp hours on, the average brightness while on, the estimated energy in watt hours and the most used
+        mode of the devices from start to end.
+        """
+        end = time.time() if end is None else end
+        totals = [0.0] * (2 + len(MODES))
+        for device_id in device_ids:
+            history = self.histories.get(device_id)
+            if history is not None:
+                history.advance(ts=end, max_gap=self.max_gap)
+                totals = list(map(sum, zip(totals, history.totals(start=start, end=end))))
+        on, bright, *modes = totals
+        return {
+            'hours': on / 3600,
+            'brightness': bright / on if on else 0.0,
+            'energy': self.watts * bright / 100 / 3600,
+            'mode': MODES[modes.index(max(modes))] if on else None
+        }
+
+    def _read(self) -> dict[str, History]:
+        self._mtime = os.path.getmtime(self.path)
+        with open(self.path) as f:
+            records = json.load(f)
+        histories = {}
+        for device_id, record in records.items():
+            history = histories[device_id] = History(changes=self.changes, minutes=self.minutes, hours=self.hours)
+            history.load(record)
+        return histories
+
+    def load(self):
+        if self.path is not None and os.path.exists(self.path):
+            self.histories = self._read()
+
+    async def refresh(self):
+        """
+        Replaces the history with the snapshot the leader saved if it changed, what this replica observed itself
+        since is in there too as long as the leader polls.
+        """
+        if self.path is None or not os.path.exists(self.path) or os.path.getmtime(self.path) == self._mtime:
+            return
+        try:
+            self.histories = await asyncio.to_thread(self._read)
+        except (OSError, ValueError) as e:
+            logger.warning('Reloading usage history failed: %s', e)
+
+    def start(self, poll: Callable[[], Awaitable[None]]):
+        if self.path is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self._poller = asyncio.create_task(self._poll(poll=poll))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save()
+
+    async def _poll(self, poll: Callable[[], Awaitable[None]]):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await poll()
+            except Exception:
+                logger.exception('Polling usage failed')
+
+    async def save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        data = json.dumps({device_id: history.dump() for device_id, history in self.histories.items()})
+        try:
+            await asyncio.to_thread(write_atomic, self.path, data)
+            self._mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logger.warning('Saving usage history failed: %s', e)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._poller.cancel()
+            await asyncio.gather(self._task, self._poller, return_exceptions=True)
+            self._task = self._poller = None
+            await self.save()
+
+
+usage = UsageStore()